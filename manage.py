@@ -8,41 +8,82 @@
     :copyright: (c) 2010 by Dan Jacob.
     :license: BSD, see LICENSE for more details.
 """
+import os
 import sys
-import feedparser
+import time
+import random
+import tempfile
+
+from datetime import datetime, timedelta
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 from flask import current_app
 
-from flaskext.script import Manager, prompt, prompt_pass, \
-    prompt_bool, prompt_choices
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine.reflection import Inspector
 
-from flaskext.mail import Message
+from flaskext.script import Manager, Command, Option, prompt, \
+    prompt_pass, prompt_bool, prompt_choices
 
 from newsmeme import create_app
-from newsmeme.extensions import db, mail
-from newsmeme.models import Post, User, Comment, Tag
+from newsmeme.extensions import db
+from newsmeme.models import Post, User, Comment, Tag, post_tags
+from newsmeme.helpers import slugify, domain, link_hash, gravatar
+from newsmeme.profiler import list_samples, aggregate
+from newsmeme.importer import import_feeds
+from newsmeme.queryplans import check_plans, unchecked_methods
+from newsmeme.seeder import seed as seed_database, SEED_PASSWORD
+from newsmeme import benchmark as benchmarks
+from newsmeme import loadtest as loadtests
+from newsmeme.config import BenchmarkConfig
+from newsmeme.sqlite import checkpoint as wal_checkpoint, optimize, \
+    CHECKPOINT_MODES
+from newsmeme.models.archive import archive_posts
+from newsmeme.models.rankings import refresh_rankings, prune_scores, WINDOWS
+from newsmeme.models.trending import refresh_trending, prune_activity
+from newsmeme.models.related import rebuild_related
+from newsmeme.mailer import process_outbox, send_digests, send_bulk, \
+    Checkpoint
 
 manager = Manager(create_app)
 
-@manager.option("-u", "--url", dest="url", help="Feed URL")
+@manager.option("-u", "--url", dest="urls", action="append", default=[],
+                help="Feed URL or file, may be given more than once")
+@manager.option("-f", "--file", dest="sources_file", required=False,
+                help="File listing feed URLs or files, one per line")
 @manager.option("-n", "--username", dest="username", help="Save to user")
-def importfeed(url, username):
+@manager.option("-w", "--workers", dest="workers", type=int, default=4,
+                help="Number of feeds fetched at once")
+@manager.option("-b", "--batch-size", dest="batch_size", type=int,
+                default=100, help="Entries checked and inserted at once")
+def importfeed(urls, username, sources_file=None, workers=4, batch_size=100):
     """
-    Bulk import news from a feed. For testing only !
+    Bulk import news from feeds. For testing only !
     """
 
     user = User.query.filter_by(username=username).first()
     if not user:
         print "User %s does not exist" % username
         sys.exit(1)
-    d = feedparser.parse(url)
-    for entry in d['entries']:
-        post = Post(author=user,
-                    title=entry.title[:200],
-                    link=entry.link)
 
-        db.session.add(post)
-    db.session.commit()
+    sources = list(urls)
+
+    if sources_file:
+        fp = open(sources_file)
+        try:
+            sources.extend(line.strip() for line in fp if line.strip())
+        finally:
+            fp.close()
+
+    num_posts, num_unmodified, num_failed = \
+        import_feeds(sources, user, workers, batch_size)
+
+    print "%d posts added, %d feeds not modified, %d feeds failed" % (
+          num_posts, num_unmodified, num_failed)
 
 @manager.option('-u', '--username', dest="username", required=False)
 @manager.option('-p', '--password', dest="password", required=False)
@@ -56,7 +97,7 @@ def createuser(username=None, password=None, email=None, role=None):
     if username is None:
         while True:
             username = prompt("Username")
-            user = User.query.filter(User.username==username).first()
+            user = User.query.by_username(username).first()
             if user is not None:
                 print "Username %s is already taken" % username
             else:
@@ -65,7 +106,7 @@ def createuser(username=None, password=None, email=None, role=None):
     if email is None:
         while True:
             email = prompt("Email address")
-            user = User.query.filter(User.email==email).first()
+            user = User.query.by_email(email).first()
             if user is not None:
                 print "Email %s is already taken" % email
             else:
@@ -114,22 +155,518 @@ def dropall():
     if prompt_bool("Are you sure ? You will lose all your data !"):
         db.drop_all()
 
-@manager.command
-def mailall():
+def _add_missing_columns(table):
+    """
+    Adds model columns missing from a table created by an older
+    version of the schema.
+    """
+
+    existing = db.Table(table.name, db.MetaData(), 
+                        autoload=True, 
+                        autoload_with=db.engine)
+
+    names = set(column.name for column in existing.c)
+
+    for column in table.c:
+        if column.name in names:
+            continue
+
+        db.engine.execute("ALTER TABLE %s ADD COLUMN %s %s" % (
+                          table.name, 
+                          column.name, 
+                          column.type.compile(dialect=db.engine.dialect)))
+
+        print "Added column %s.%s" % (table.name, column.name)
+
+
+def _add_missing_indexes(table):
+    """
+    Creates model indexes missing from a table created by an older
+    version of the schema.
+    """
+
+    existing = set(index['name'] for index in \
+                   Inspector.from_engine(db.engine).get_indexes(table.name))
+
+    indexes = [(index.name, index.create) for index in table.indexes]
+
+    # partial indexes are created with DDL statements
+    if db.engine.dialect.name in ("sqlite", "postgresql"):
+        for name, statement in table.info.get('partial_indexes', ()):
+            indexes.append((name, lambda bind, statement=statement: \
+                                  bind.execute(statement)))
+
+    for name, create in indexes:
+        if name in existing:
+            continue
+
+        try:
+            create(db.engine)
+        except IntegrityError, e:
+            print "Cannot create index %s: %s" % (name, e)
+        else:
+            print "Created index %s" % name
+
+
+def _backfill(table, columns, compute, batch_size):
+    """
+    Updates stored derived columns of a table in batches of rows, 
+    ordered by primary key.
+    """
+    
+    update = table.update().where(table.c.id==db.bindparam("_id"))
+
+    last_id = 0
+    num_rows = 0
+
+    while True:
+        rows = db.session.execute(
+            db.select([table.c.id] + [table.c[col] for col in columns]).\
+            where(table.c.id > last_id).\
+            order_by(table.c.id.asc()).\
+            limit(batch_size)).fetchall()
+
+        if not rows:
+            break
+
+        values = []
+        for row in rows:
+            d = compute(*row[1:])
+            d['_id'] = row[0]
+            values.append(d)
+
+        db.session.execute(update, values)
+        db.session.commit()
+
+        last_id = rows[-1][0]
+        num_rows += len(rows)
+
+    return num_rows
+
+
+@manager.option("-b", "--batch-size", dest="batch_size", type=int,
+                default=1000, help="Rows per transaction")
+def backfill(batch_size=1000):
+    "Computes stored derived columns and creates their indexes"
+
+    _add_missing_columns(Post.__table__)
+    _add_missing_columns(User.__table__)
+
+    def compute_post(title, link):
+        return dict(slug=slugify(title or '')[:80],
+                    domain=domain(link) if link else '',
+                    link_hash=link_hash(link) if link else None)
+
+    def compute_user(username, email):
+        return dict(username_lower=username.lower() if username else None,
+                    email_lower=email.lower() if email else None,
+                    gravatar=gravatar(email) if email else None)
+
+    num_posts = _backfill(Post.__table__, ("title", "link"), 
+                          compute_post, batch_size)
+
+    print "%d posts updated" % num_posts
+
+    num_users = _backfill(User.__table__, ("username", "email"), 
+                          compute_user, batch_size)
+
+    print "%d users updated" % num_users
+
+    # unique indexes fail if users differ only in case
+    for table in (Post.__table__, 
+                  User.__table__, 
+                  Comment.__table__, 
+                  post_tags):
+        _add_missing_indexes(table)
+
+
+@manager.option("-k", "--checkpoint", dest="checkpoint", 
+                default="mailall.checkpoint", 
+                help="Progress file, to resume an interrupted mailing")
+@manager.option("-n", "--connections", dest="connections", type=int,
+                default=4, help="Number of SMTP connections")
+@manager.option("-r", "--rate", dest="rate", type=float,
+                default=None, help="Maximum messages per second")
+def mailall(checkpoint="mailall.checkpoint", connections=4, rate=None):
     "Sends an email to all users"
     
-    subject = prompt("Subject")
-    message = prompt("Message")
-    from_address = prompt("From", default="support@thenewsmeme.com")
-    if prompt_bool("Are you sure ? Email will be sent to everyone!"):
-        with mail.connect() as conn:
-            for user in User.query:
-                message = Message(subject=subject,
-                                  body=message,
-                                  sender=from_address,
-                                  recipients=[user.email])
-
-                conn.send(message)
+    checkpoint = Checkpoint(checkpoint)
+
+    resume = checkpoint.exists() and \
+        prompt_bool("Resume unfinished mailing \"%s\" ?" % \
+                    checkpoint.load()['subject'])
+
+    if not resume:
+        subject = prompt("Subject")
+        body = prompt("Message")
+        sender = prompt("From", default="support@thenewsmeme.com")
+        if not prompt_bool("Are you sure ? Email will be sent to everyone!"):
+            return
+        checkpoint.start(subject, body, sender)
+
+    num_sent, num_failed = send_bulk(checkpoint, connections, rate)
+    
+    checkpoint.remove()
+
+    print "%d sent, %d queued for retry" % (num_sent, num_failed)
+
+
+@manager.option("-b", "--batch-size", dest="batch_size", type=int,
+                default=100, help="Messages per batch")
+@manager.option("-i", "--interval", dest="interval", type=int,
+                default=10, help="Seconds to wait when outbox is empty")
+@manager.option("-o", "--once", dest="once", action="store_true",
+                default=False, help="Exit when outbox is empty")
+def mailworker(batch_size=100, interval=10, once=False):
+    "Sends queued email from the outbox"
+
+    while True:
+        num_sent, num_failed = process_outbox(batch_size)
+
+        if num_sent or num_failed:
+            print "%d sent, %d failed" % (num_sent, num_failed)
+
+        if once:
+            break
+
+        if not num_sent:
+            time.sleep(interval)
+
+        # don't hold a transaction open between batches
+        db.session.remove()
+
+
+@manager.option("-d", "--days", dest="days", type=int, required=False,
+                help="Archive posts older than this, default "
+                     "ARCHIVE_AFTER_DAYS")
+@manager.option("-b", "--batch-size", dest="batch_size", type=int,
+                default=500, help="Posts per transaction")
+def archive(days=None, batch_size=500):
+    "Moves old posts and their comments to the archive tables"
+
+    if days is None:
+        days = current_app.config['ARCHIVE_AFTER_DAYS']
+
+    before = datetime.utcnow() - timedelta(days=days)
+
+    print "%d posts archived" % archive_posts(before, batch_size)
+
+
+@manager.option("-i", "--interval", dest="interval", type=int,
+                default=300, help="Seconds between runs")
+@manager.option("-o", "--once", dest="once", action="store_true",
+                default=False, help="Exit after one run")
+def rankings(interval=300, once=False):
+    "Recomputes cached top posts and trending tags, deleting expired counts"
+
+    while True:
+        for window, hours in WINDOWS:
+            print "%s: %d posts" % (window, len(refresh_rankings(window)))
+
+        print "%d trending tags" % len(refresh_trending())
+
+        print "%d hourly scores deleted" % prune_scores()
+        print "%d hourly tag counts deleted" % prune_activity()
+
+        if once:
+            break
+
+        time.sleep(interval)
+
+        db.session.remove()
+
+
+@manager.option("-b", "--batch-size", dest="batch_size", type=int,
+                default=1000, help="Posts per transaction")
+@manager.option("-i", "--interval", dest="interval", type=int,
+                default=3600, help="Seconds between runs")
+@manager.option("-o", "--once", dest="once", action="store_true",
+                default=False, help="Exit after one run")
+def related(batch_size=1000, interval=3600, once=False):
+    "Recomputes related posts from shared tags and voters"
+
+    config = current_app.config
+
+    while True:
+        num_rows = rebuild_related(config['RELATED_POSTS'],
+                                   config['RELATED_MAX_POSTINGS'],
+                                   batch_size)
+
+        print "%d related posts stored" % num_rows
+
+        if once:
+            break
+
+        time.sleep(interval)
+
+        db.session.remove()
+
+
+@manager.option("-m", "--mode", dest="mode", default="PASSIVE",
+                choices=CHECKPOINT_MODES, help="WAL checkpoint mode")
+@manager.option("-i", "--interval", dest="interval", type=int,
+                default=300, help="Seconds between runs")
+@manager.option("-o", "--once", dest="once", action="store_true",
+                default=False, help="Exit after one run")
+def checkpoint(mode="PASSIVE", interval=300, once=False):
+    "Checkpoints the SQLite WAL and updates query planner statistics"
+
+    if db.engine.dialect.name != "sqlite":
+        print "checkpoint needs SQLite"
+        sys.exit(1)
+
+    while True:
+        busy, num_frames, num_checkpointed = wal_checkpoint(mode)
+        optimize()
+
+        print "%d of %d WAL frames checkpointed%s" % (
+              num_checkpointed, num_frames, ", busy" if busy else "")
+
+        if once:
+            break
+
+        time.sleep(interval)
+
+        db.session.remove()
+
+
+@manager.option("-b", "--batch-size", dest="batch_size", type=int,
+                default=100, help="Users per batch")
+@manager.option("-i", "--interval", dest="interval", type=int,
+                default=60, help="Seconds between runs")
+@manager.option("-o", "--once", dest="once", action="store_true",
+                default=False, help="Exit after one run")
+def digests(batch_size=100, interval=60, once=False):
+    "Queues notification digests for the mail worker"
+
+    window = current_app.config['NOTIFICATION_DIGEST_WINDOW']
+
+    while True:
+        num_digests = send_digests(window, batch_size)
+
+        if num_digests:
+            print "%d digests queued" % num_digests
+
+        if once:
+            break
+
+        time.sleep(interval)
+
+        db.session.remove()
+
+
+@manager.option("-u", "--users", dest="num_users", type=int, default=1000)
+@manager.option("-p", "--posts", dest="num_posts", type=int, default=10000)
+@manager.option("-f", "--follows", dest="follows", type=int, default=10,
+                help="Average number of users each user follows")
+@manager.option("-t", "--tags", dest="num_tags", type=int, default=200)
+@manager.option("-c", "--max-comments", dest="max_comments", type=int,
+                default=500, help="Most comments on a post")
+@manager.option("-d", "--max-depth", dest="max_depth", type=int, default=8,
+                help="Deepest comment reply")
+@manager.option("--days", dest="days", type=int, default=365,
+                help="Posts are spread over this many days")
+@manager.option("-b", "--chunk-size", dest="chunk_size", type=int,
+                default=10000, help="Rows inserted per transaction")
+@manager.option("-s", "--seed", dest="random_seed", type=int, default=0)
+def seed(num_users, num_posts, follows=10, num_tags=200, max_comments=500,
+         max_depth=8, days=365, chunk_size=10000, random_seed=0):
+    """
+    Generates synthetic users, posts, comments, votes, follows and
+    tags. For testing only !
+    """
+
+    started = time.time()
+
+    counts = seed_database(num_users, num_posts, follows, num_tags,
+                           max_comments, max_depth, days, chunk_size,
+                           random_seed)
+
+    for table, count in sorted(counts.iteritems()):
+        print "%s: %d" % (table, count)
+
+    print "%d rows in %.1fs, user password is %s" % (
+          sum(counts.values()), time.time() - started, SEED_PASSWORD)
+
+@manager.option("-s", "--size", dest="sizes", type=int, action="append",
+                default=[], help="Number of posts, may be repeated")
+@manager.option("-d", "--db-dir", dest="db_dir", required=False,
+                help="Directory keeping seeded databases between runs")
+@manager.option("-n", "--requests", dest="num_requests", type=int,
+                default=20, help="Measured requests per view")
+@manager.option("-o", "--output", dest="output", required=False,
+                help="JSON results file")
+@manager.option("-c", "--compare", dest="compare", required=False,
+                help="JSON results file of an earlier run")
+@manager.option("--cache", dest="use_cache", action="store_true",
+                default=False, help="Measure with the cache enabled")
+def benchmark(sizes, db_dir=None, num_requests=20, output=None, compare=None,
+              use_cache=False):
+    "Benchmarks views against seeded databases"
+
+    sizes = sizes or [1000, 10000]
+
+    if db_dir is None:
+        db_dir = os.path.join(tempfile.gettempdir(), "newsmeme-benchmarks")
+
+    if output is None:
+        output = "benchmark-%s.json" % time.strftime("%Y%m%d%H%M%S")
+
+    results = benchmarks.run(sizes, db_dir, num_requests, 
+                             use_cache=use_cache)
+
+    benchmarks.save(results, output, sizes=sizes, num_requests=num_requests,
+                    use_cache=use_cache)
+
+    print "Results written to %s" % output
+
+    if compare:
+        for size, endpoint, logged_in, old_latency, latency, \
+            old_queries, queries in benchmarks.compare(
+                benchmarks.load(compare), results):
+
+            print "%d %s%s: %.1fms -> %.1fms (%+.0f%%), %d -> %d queries" % (
+                  size, endpoint, " (logged in)" if logged_in else "",
+                  old_latency * 1000, latency * 1000,
+                  (latency - old_latency) * 100 / (old_latency or 1), 
+                  old_queries, queries)
+
+@manager.option("-c", "--clients", dest="num_clients", type=int, default=4,
+                help="Client processes")
+@manager.option("-w", "--workers", dest="num_servers", type=int, default=4,
+                help="Server processes")
+@manager.option("-n", "--requests", dest="num_requests", type=int,
+                default=1000, help="Synthetic requests in total")
+@manager.option("-m", "--mix", dest="mix", required=False,
+                help="Synthetic mix e.g. index=40,post=25,upvote=10")
+@manager.option("-l", "--log", dest="log", required=False,
+                help="Access log to replay instead of a synthetic mix")
+@manager.option("-p", "--port", dest="port", type=int, default=5050)
+@manager.option("-s", "--seed", dest="random_seed", type=int, default=0)
+@manager.option("-o", "--output", dest="output", required=False,
+                help="JSON report file")
+def loadtest(num_clients=4, num_servers=4, num_requests=1000, mix=None,
+             log=None, port=5050, random_seed=0, output=None):
+    """
+    Sends requests from many processes to a local server using the
+    configured database, seeded with manage.py seed
+    """
+
+    targets = loadtests.get_targets()
+
+    if not targets['post_ids'] or not targets['usernames']:
+        print "No posts found: seed the database first"
+        sys.exit(1)
+
+    if log:
+        fp = open(log)
+        try:
+            requests = loadtests.read_log(fp, current_app.url_map)
+        finally:
+            fp.close()
+    else:
+        try:
+            mix = loadtests.parse_mix(mix) if mix else loadtests.DEFAULT_MIX
+        except ValueError, e:
+            print e
+            sys.exit(1)
+
+        requests = loadtests.synthetic_requests(random.Random(random_seed),
+                                                mix, targets, num_requests)
+
+    config = BenchmarkConfig()
+    config.SQLALCHEMY_DATABASE_URI = \
+        current_app.config['SQLALCHEMY_DATABASE_URI']
+    config.CACHE_TYPE = current_app.config['CACHE_TYPE']
+
+    rv = loadtests.run(config, requests, targets['usernames'], num_clients,
+                       num_servers, port)
+
+    print "%d requests in %.1fs, %.1f requests/s" % (
+          rv['requests'], rv['elapsed'], rv['throughput'])
+
+    print "%d errors, %d lock timeouts" % (rv['errors'], rv['lock_errors'])
+
+    for action, stats in sorted(rv['actions'].iteritems()):
+        latency = stats['latency']
+        print "%s: %d requests, %d errors, median %.1fms, " \
+              "p95 %.1fms, p99 %.1fms" % (action, stats['requests'],
+                                          stats['errors'],
+                                          latency['median'] * 1000,
+                                          latency['p95'] * 1000,
+                                          latency['p99'] * 1000)
+
+    if output:
+        fp = open(output, "w")
+        try:
+            json.dump(rv, fp, indent=2)
+        finally:
+            fp.close()
+
+@manager.option("-u", "--username", dest="username", required=False,
+                help="Current user for restricted queries")
+def indexcheck(username=None):
+    "Shows query plans of query class methods, flagging full scans"
+
+    if db.engine.dialect.name != "sqlite":
+        print "indexcheck needs SQLite"
+        sys.exit(1)
+
+    if username:
+        user = User.query.by_username(username).first()
+    else:
+        user = User.query.first()
+
+    if user is None:
+        print "No users found: seed the database first"
+        sys.exit(1)
+
+    for name in unchecked_methods():
+        print "%s is not checked" % name
+
+    num_scans = 0
+
+    for name, plan, scans in check_plans(user):
+        print name
+        for detail in plan:
+            print "    %s%s" % (detail, " <- FULL SCAN" \
+                                if detail in scans else "")
+        num_scans += len(scans)
+
+    print "%d full scans" % num_scans
+
+
+class ProfileReport(Command):
+    "Shows top functions across profiler samples"
+
+    option_list = (
+        Option("-d", "--dir", dest="profile_dir", required=False,
+               help="Samples directory"),
+        Option("-e", "--endpoint", dest="endpoint", required=False,
+               help="Only samples for this endpoint"),
+        Option("-s", "--sort", dest="sort", default="cumulative",
+               help="pstats sort key"),
+        Option("-n", "--limit", dest="limit", type=int, default=30,
+               help="Number of functions shown"),
+    )
+
+    def run(self, profile_dir=None, endpoint=None, sort="cumulative",
+            limit=30):
+
+        if profile_dir is None:
+            profile_dir = os.path.join(current_app.root_path,
+                                       current_app.config['PROFILER_DIR'])
+
+        files = list_samples(profile_dir, endpoint)
+        if not files:
+            print "No samples found in %s" % profile_dir
+            return
+
+        print "%d samples" % len(files)
+        aggregate(files, sort).print_stats(limit)
+
+
+manager.add_command("profile-report", ProfileReport())
 
 
 @manager.shell
@@ -9,9 +9,11 @@
     :license: BSD, see LICENSE for more details.
 """
 import os
+import Queue
+import atexit
 import logging
 
-from logging.handlers import SMTPHandler, RotatingFileHandler
+from logging.handlers import RotatingFileHandler
 
 from flask import Flask, Response, request, g, \
         jsonify, redirect, url_for, flash
@@ -22,8 +24,16 @@ from flaskext.principal import Principal, identity_loaded
 
 from newsmeme import helpers
 from newsmeme import views
+from newsmeme import instrumentation
+from newsmeme import metrics
+from newsmeme import sqlite
+from newsmeme import routing
 from newsmeme.config import DefaultConfig
-from newsmeme.models import User, Tag
+from newsmeme.profiler import SamplingProfiler
+from newsmeme.loghandlers import QueueHandler, QueueListener, \
+    DigestSMTPHandler
+from newsmeme.models import User
+from newsmeme.models.trending import get_trending
 from newsmeme.helpers import render_template
 from newsmeme.extensions import db, mail, oid, cache
 
@@ -40,6 +50,7 @@ DEFAULT_MODULES = (
     (views.feeds, "/feeds"),
     (views.openid, "/openid"),
     (views.api, "/api"),
+    (views.admin, "/admin"),
 )
 
 def create_app(config=None, app_name=None, modules=None):
@@ -57,11 +68,15 @@ def create_app(config=None, app_name=None, modules=None):
     configure_logging(app)
     configure_errorhandlers(app)
     configure_extensions(app)
+    configure_database(app)
+    configure_instrumentation(app)
+    configure_metrics(app)
     configure_before_handlers(app)
     configure_template_filters(app)
     configure_context_processors(app)
     # configure_after_handlers(app)
     configure_modules(app, modules)
+    configure_profiler(app)
 
     return app
 
@@ -82,6 +97,23 @@ def configure_modules(app, modules):
         app.register_module(module, url_prefix=url_prefix)
 
 
+def configure_profiler(app):
+
+    if not app.config['PROFILER_ENABLED']:
+        return
+
+    profile_dir = os.path.join(app.root_path, 
+                               app.config['PROFILER_DIR'])
+
+    app.wsgi_app = \
+        SamplingProfiler(app,
+                         profile_dir,
+                         sample_rate=app.config['PROFILER_SAMPLE_RATE'],
+                         endpoints=app.config['PROFILER_ENDPOINTS'],
+                         slow_threshold=app.config['PROFILER_SLOW_THRESHOLD'],
+                         max_files=app.config['PROFILER_MAX_FILES'])
+
+
 def configure_template_filters(app):
 
     @app.template_filter()
@@ -102,7 +134,7 @@ def configure_context_processors(app):
     def get_tags():
         tags = cache.get("tags")
         if tags is None:
-            tags = Tag.query.order_by(Tag.num_posts.desc()).limit(10).all()
+            tags = [tag for tag, score in get_trending(10)]
             cache.set("tags", tags)
 
         return dict(tags=tags)
@@ -127,6 +159,24 @@ def configure_extensions(app):
     configure_i18n(app)
     
 
+def configure_database(app):
+
+    routing.init_app(app)
+    sqlite.init_app(app)
+
+
+def configure_instrumentation(app):
+
+    if app.config['SQLALCHEMY_INSTRUMENT']:
+        instrumentation.init_app(app)
+
+
+def configure_metrics(app):
+
+    if app.config['METRICS_ENABLED']:
+        metrics.init_app(app)
+
+
 def configure_identity(app):
 
     Principal(app)
@@ -183,18 +233,22 @@ def configure_logging(app):
     if app.debug or app.testing:
         return
 
+    # handlers run in a background thread, so request threads never
+    # block on file rotation or SMTP
+
     mail_handler = \
-        SMTPHandler(app.config['MAIL_SERVER'],
-                    'error@newsmeme.com',
-                    app.config['ADMINS'], 
-                    'application error',
-                    (
-                        app.config['MAIL_USERNAME'],
-                        app.config['MAIL_PASSWORD'],
-                    ))
+        DigestSMTPHandler(app.config['MAIL_SERVER'],
+                          'error@newsmeme.com',
+                          app.config['ADMINS'], 
+                          'application error',
+                          (
+                              app.config['MAIL_USERNAME'],
+                              app.config['MAIL_PASSWORD'],
+                          ),
+                          interval=app.config['ERROR_MAIL_INTERVAL'],
+                          capacity=app.config['ERROR_MAIL_CAPACITY'])
 
     mail_handler.setLevel(logging.ERROR)
-    app.logger.addHandler(mail_handler)
 
     formatter = logging.Formatter(
         '%(asctime)s %(levelname)s: %(message)s '
@@ -210,7 +264,6 @@ def configure_logging(app):
 
     debug_file_handler.setLevel(logging.DEBUG)
     debug_file_handler.setFormatter(formatter)
-    app.logger.addHandler(debug_file_handler)
 
     error_log = os.path.join(app.root_path, 
                              app.config['ERROR_LOG'])
@@ -222,7 +275,13 @@ def configure_logging(app):
 
     error_file_handler.setLevel(logging.ERROR)
     error_file_handler.setFormatter(formatter)
-    app.logger.addHandler(error_file_handler)
 
+    queue = Queue.Queue(app.config['LOG_QUEUE_SIZE'])
 
+    listener = QueueListener(queue, [mail_handler,
+                                     debug_file_handler,
+                                     error_file_handler])
+    listener.start()
+    atexit.register(listener.stop)
 
+    app.logger.addHandler(QueueHandler(queue))
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmark.py
+    ~~~~~~~~~~~~
+
+    End-to-end view benchmarks (manage.py benchmark). Each view is
+    requested through the test client against seeded databases of
+    several sizes, anonymously and logged in, measuring latency,
+    queries issued and peak memory. Results are written as JSON so
+    runs can be compared.
+
+    Each view is measured in a forked child process so peak memory
+    is its own. Unix only.
+
+    :copyright: (c) 2010 by Dan Jacob.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import time
+import shutil
+import urllib
+import resource
+
+from datetime import datetime
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from newsmeme import create_app
+from newsmeme.config import BenchmarkConfig
+from newsmeme.extensions import db
+from newsmeme.instrumentation import record_queries
+from newsmeme.models import User, Post, Comment, Tag
+from newsmeme.seeder import seed, SEED_PASSWORD
+
+SEARCH_KEYWORDS = "python"
+
+def summarize(values):
+    """
+    Returns dict of min, median, 95th and 99th percentile, max and
+    mean of a non-empty list of values.
+    """
+    values = sorted(values)
+
+    def percentile(p):
+        return values[min(len(values) - 1, int(len(values) * p))]
+
+    return dict(min=values[0],
+                median=percentile(0.5),
+                p95=percentile(0.95),
+                p99=percentile(0.99),
+                max=values[-1],
+                mean=sum(values) / float(len(values)))
+
+
+def get_cases(user, num_requests):
+    """
+    Returns list of (name, method, urls, logged in only). Vote
+    cases get a different post or comment for each request.
+    """
+
+    post = Post.query.public().order_by(Post.num_comments.desc()).first()
+    tag = Tag.query.order_by(Tag.num_posts.desc()).first()
+
+    recent = ",".join(str(post_id) for post_id, in \
+                      db.session.query(Post.id).\
+                      order_by(Post.id.desc()).limit(Post.PER_PAGE))
+
+    get = [
+        ("frontend.index", "/"),
+        ("frontend.latest", "/latest/"),
+        ("frontend.deadpool", "/deadpool/"),
+        ("frontend.top", "/top/week/"),
+        ("frontend.tag", "/tags/%s/" % tag.slug),
+        ("frontend.search", "/search/?keywords=%s" % SEARCH_KEYWORDS),
+        ("post.view", "/post/%d/" % post.id),
+        ("feeds.index", "/feeds/"),
+        ("feeds.latest", "/feeds/latest/"),
+        ("feeds.deadpool", "/feeds/deadpool/"),
+        ("feeds.top", "/feeds/top/week/"),
+        ("feeds.tag", "/feeds/tag/%s/" % tag.slug),
+        ("feeds.user", "/feeds/user/%s/" % post.author.username),
+        ("api.post", "/api/post/%d/" % post.id),
+        ("api.posts", "/api/posts/?ids=%s" % recent),
+        ("api.link", "/api/link/?" + urllib.urlencode(dict(url=post.link))),
+        ("api.search", "/api/search/?keywords=%s" % SEARCH_KEYWORDS),
+        ("api.top", "/api/top/week/"),
+        ("api.user", "/api/user/%s/" % post.author.username),
+    ]
+
+    cases = [(name, "GET", [url] * num_requests, False) \
+             for name, url in get]
+
+    # posts and comments the user may vote for
+    post_ids = [post.id for post in \
+                Post.query.filter(Post.author_id != user.id).\
+                limit(num_requests * 10) if user.id not in post.votes]
+
+    comment_ids = [comment.id for comment in \
+                   Comment.query.filter(Comment.author_id != user.id).\
+                   order_by(Comment.id.desc()).\
+                   limit(num_requests * 10) if user.id not in comment.votes]
+
+    cases.append(("post.upvote", "POST",
+                  ["/post/%d/upvote/" % post_id for post_id in \
+                   post_ids[:num_requests]], True))
+
+    cases.append(("comment.upvote", "POST",
+                  ["/comment/%d/upvote/" % comment_id for comment_id in \
+                   comment_ids[:num_requests]], True))
+
+    return cases
+
+
+def measure(app, method, urls, username=None, warmup=2):
+    """
+    Requests each url, the first `warmup` ones unmeasured. Returns
+    dict of statuses, latency (seconds), queries per request and
+    growth of peak memory (KB).
+    """
+
+    client = app.test_client()
+
+    if username:
+        client.post("/acct/login/", data=dict(login=username,
+                                              password=SEED_PASSWORD))
+
+    for url in urls[:warmup]:
+        client.open(url, method=method)
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    latency = []
+    queries = []
+    statuses = set()
+
+    for url in urls[warmup:]:
+        with record_queries() as stats:
+            started = time.time()
+            response = client.open(url, method=method)
+            latency.append(time.time() - started)
+
+        queries.append(stats.count)
+        statuses.add(response.status_code)
+
+    return dict(requests=len(latency),
+                status=sorted(statuses),
+                latency=summarize(latency),
+                queries=summarize(queries),
+                peak_memory_kb=resource.getrusage(
+                    resource.RUSAGE_SELF).ru_maxrss - max_rss)
+
+
+def _run_forked(func, *args):
+    """
+    Runs func in a child process, returning its JSON result.
+    """
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+
+    if pid == 0:
+        os.close(read_fd)
+        status = 0
+        try:
+            try:
+                result = func(*args)
+            except Exception, e:
+                result = dict(error=repr(e))
+                status = 1
+            fp = os.fdopen(write_fd, "w")
+            json.dump(result, fp)
+            fp.close()
+        finally:
+            os._exit(status)
+
+    os.close(write_fd)
+    fp = os.fdopen(read_fd)
+    try:
+        data = fp.read()
+    finally:
+        fp.close()
+        os.waitpid(pid, 0)
+
+    return json.loads(data)
+
+
+def seeded_database(db_dir, num_posts, random_seed=0):
+    """
+    Returns path of a database seeded with num_posts posts and a
+    user for every 10 posts, seeding it if not done before.
+    """
+
+    path = os.path.join(db_dir, "benchmark-%d-%d.db" % (num_posts,
+                                                         random_seed))
+    if os.path.exists(path):
+        return path
+
+    if os.path.exists(path + ".tmp"):
+        os.remove(path + ".tmp")
+
+    config = BenchmarkConfig()
+    config.SQLALCHEMY_DATABASE_URI = "sqlite:///%s.tmp" % path
+
+    app = create_app(config)
+
+    with app.test_request_context():
+        db.create_all()
+        seed(max(num_posts // 10, 10), num_posts, random_seed=random_seed)
+        db.session.remove()
+        db.engine.dispose()
+
+    # only complete databases are reused
+    os.rename(path + ".tmp", path)
+
+    return path
+
+
+def run(sizes, db_dir, num_requests=20, warmup=2, random_seed=0,
+        use_cache=False, out=sys.stdout):
+    """
+    Benchmarks every case against a database of each size (number
+    of posts). Returns list of result dicts.
+    """
+
+    if not os.path.exists(db_dir):
+        os.makedirs(db_dir)
+
+    results = []
+
+    for num_posts in sizes:
+        path = seeded_database(db_dir, num_posts, random_seed)
+
+        # votes change the database: benchmark a copy
+        work_path = path + ".work"
+        shutil.copy(path, work_path)
+
+        config = BenchmarkConfig()
+        config.SQLALCHEMY_DATABASE_URI = "sqlite:///%s" % work_path
+        if use_cache:
+            config.CACHE_TYPE = "simple"
+
+        app = create_app(config)
+
+        try:
+            with app.test_request_context():
+
+                user = User.query.order_by(User.id).first()
+                username = user.username
+
+                cases = get_cases(user, num_requests + warmup)
+
+                db.session.remove()
+                db.engine.dispose()
+
+                for name, method, urls, login_required in cases:
+                    if len(urls) <= warmup:
+                        print >> out, "%d %s: skipped, too few rows" % (
+                            num_posts, name)
+                        continue
+
+                    for logged_in in (False, True):
+                        if login_required and not logged_in:
+                            continue
+
+                        result = _run_forked(measure, app, method, urls,
+                                             username if logged_in else None,
+                                             warmup)
+
+                        result.update(size=num_posts,
+                                      endpoint=name,
+                                      logged_in=logged_in)
+
+                        results.append(result)
+
+                        if 'error' in result:
+                            print >> out, "%d %s: %s" % (
+                                num_posts, name, result['error'])
+                        else:
+                            print >> out, "%d %s%s: %.1fms, %d queries" % (
+                                num_posts, name,
+                                " (logged in)" if logged_in else "",
+                                result['latency']['median'] * 1000,
+                                result['queries']['max'])
+        finally:
+            os.remove(work_path)
+
+    return results
+
+
+def save(results, path, **options):
+    fp = open(path, "w")
+    try:
+        json.dump(dict(date=datetime.utcnow().isoformat(),
+                       python=sys.version.split()[0],
+                       options=options,
+                       results=results), fp, indent=2)
+    finally:
+        fp.close()
+
+
+def load(path):
+    fp = open(path)
+    try:
+        return json.load(fp)['results']
+    finally:
+        fp.close()
+
+
+def compare(old_results, new_results):
+    """
+    Returns list of (size, endpoint, logged in, old median latency,
+    new median latency, old max queries, new max queries) for cases
+    found in both runs.
+    """
+
+    def key(result):
+        return result['size'], result['endpoint'], result['logged_in']
+
+    old = dict((key(result), result) for result in old_results \
+               if 'error' not in result)
+
+    rv = []
+
+    for result in new_results:
+        if 'error' in result or key(result) not in old:
+            continue
+
+        prev = old[key(result)]
+
+        rv.append(key(result) + (prev['latency']['median'],
+                                 result['latency']['median'],
+                                 prev['queries']['max'],
+                                 result['queries']['max']))
+
+    return rv
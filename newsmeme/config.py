@@ -31,19 +31,126 @@ class DefaultConfig(object):
 
     SQLALCHEMY_ECHO = False
 
+    # reads in GET and HEAD requests go to SQLALCHEMY_READ_URI if set,
+    # unless the request has written. With SQLite, set it to the same
+    # URI: a pool of read-only connections over the WAL file serves
+    # reads while the primary connection writes.
+
+    SQLALCHEMY_READ_URI = None
+    SQLALCHEMY_READ_POOL_SIZE = 5
+
+    # set on each new SQLite connection. WAL lets requests read
+    # while another writes, and busy_timeout (ms) makes writers wait
+    # for the lock rather than fail at once. NORMAL synchronous is
+    # safe with WAL: only the last commits can be lost on power loss.
+
+    SQLITE_PRAGMAS = (("journal_mode", "WAL"),
+                      ("synchronous", "NORMAL"),
+                      ("busy_timeout", 5000),
+                      ("cache_size", -16000),
+                      ("mmap_size", 268435456),
+                      ("temp_store", "MEMORY"))
+
+    # views writing to the database run again up to SQLITE_BUSY_RETRIES
+    # times if it stays locked past busy_timeout, after a random wait
+    # of up to SQLITE_BUSY_BACKOFF * 2 ** retry seconds
+
+    SQLITE_BUSY_RETRIES = 3
+    SQLITE_BUSY_BACKOFF = 0.05
+
+    # record per-request query count and SQL time, and log
+    # statements repeated this many times as possible N+1 queries
+
+    SQLALCHEMY_INSTRUMENT = False
+    SQLALCHEMY_REPEATED_QUERY_THRESHOLD = 5
+
     MAIL_DEBUG = DEBUG
 
+    # the mail worker needs SMTP errors raised so it can retry
+    MAIL_FAIL_SILENTLY = False
+
     ADMINS = ()
 
     DEFAULT_MAIL_SENDER = "support@thenewsmeme.com"
 
+    # users get at most one digest of comments, replies and new
+    # followers every NOTIFICATION_DIGEST_WINDOW seconds
+
+    NOTIFICATION_DIGEST_WINDOW = 3600
+
+    # manage.py archive moves posts older than ARCHIVE_AFTER_DAYS,
+    # with their comments, to read-only archive tables
+
+    ARCHIVE_AFTER_DAYS = 365
+
+    # top listings show the TOP_POSTS_SIZE best scoring public posts
+    # of each window, recomputed every TOP_POSTS_TIMEOUT seconds
+
+    TOP_POSTS_SIZE = 500
+    TOP_POSTS_TIMEOUT = 300
+
+    # new posts are copied to the timelines of their author's
+    # followers, unless there are more than TIMELINE_FANOUT_LIMIT;
+    # their posts are merged in when timelines are read instead.
+    # Timelines keep the newest TIMELINE_SIZE posts.
+
+    TIMELINE_FANOUT_LIMIT = 1000
+    TIMELINE_SIZE = 500
+
+    # tags trend when their activity in the last TRENDING_HOURS is
+    # high compared to the TRENDING_PERIODS periods before it. The
+    # TRENDING_SIZE top tags are recomputed every TRENDING_TIMEOUT
+    # seconds.
+
+    TRENDING_HOURS = 24
+    TRENDING_PERIODS = 7
+    TRENDING_SIZE = 50
+    TRENDING_TIMEOUT = 300
+
+    # post pages show the RELATED_POSTS posts sharing the most tags
+    # and voters, stored by manage.py related. Tags and voters of more
+    # than RELATED_MAX_POSTINGS posts are too common to be compared.
+
+    RELATED_POSTS = 5
+    RELATED_MAX_POSTINGS = 1000
+
     ACCEPT_LANGUAGES = ['en', 'fi']
 
     DEBUG_LOG = 'logs/debug.log'
     ERROR_LOG = 'logs/error.log'
 
+    # log records waiting for the logging thread; more are dropped
+    LOG_QUEUE_SIZE = 10000
+
+    # error emails are sent as one digest every ERROR_MAIL_INTERVAL 
+    # seconds, of at most ERROR_MAIL_CAPACITY errors
+
+    ERROR_MAIL_INTERVAL = 300
+    ERROR_MAIL_CAPACITY = 50
+
     THEME = 'newsmeme'
 
+    # cProfile 1 in PROFILER_SAMPLE_RATE requests, plus any request
+    # whose endpoint matches a pattern in PROFILER_ENDPOINTS. If
+    # PROFILER_SLOW_THRESHOLD (seconds) is set, every request is
+    # profiled and slower ones are kept too: this makes every
+    # request several times slower, so only set it briefly.
+
+    PROFILER_ENABLED = False
+    PROFILER_DIR = 'logs/profiles'
+    PROFILER_SAMPLE_RATE = 1000
+    PROFILER_ENDPOINTS = ()
+    PROFILER_SLOW_THRESHOLD = None
+    PROFILER_MAX_FILES = 500
+
+    # request latency, cache and DB time metrics, exposed to admins
+    # at /admin/metrics/. Each worker writes to its own file in 
+    # METRICS_DIR at most every METRICS_FLUSH_INTERVAL seconds.
+
+    METRICS_ENABLED = False
+    METRICS_DIR = 'logs/metrics'
+    METRICS_FLUSH_INTERVAL = 5
+
     CACHE_TYPE = "simple"
     CACHE_DEFAULT_TIMEOUT = 300
 
@@ -54,7 +161,16 @@ class TestConfig(object):
     CSRF_ENABLED = False
     SQLALCHEMY_DATABASE_URI = "sqlite://"
     SQLALCHEMY_ECHO = False
+    SQLALCHEMY_INSTRUMENT = True
 
 
+class BenchmarkConfig(object):
 
+    # the database URI is set for each benchmarked database. Views
+    # are measured uncached unless the benchmark is run with --cache
 
+    DEBUG = False
+    CSRF_ENABLED = False
+    SQLALCHEMY_ECHO = False
+    SQLALCHEMY_INSTRUMENT = True
+    CACHE_TYPE = "null"
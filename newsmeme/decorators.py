@@ -1,6 +1,13 @@
+import time
+import random
 import functools
 
-from flask import g
+from flask import g, current_app
+
+from sqlalchemy.exc import OperationalError
+
+from newsmeme.extensions import db
+from newsmeme.sqlite import is_busy
 
 def keep_login_url(func):
     """
@@ -13,3 +20,27 @@ def keep_login_url(func):
         return func(*args, **kwargs)
     return wrapper
 
+
+def retry_on_busy(func):
+    """
+    Runs a view writing to the database again, after rolling back,
+    if SQLite stays locked past its busy timeout. Waits are random,
+    so the writers that collided don't collide again. Views must
+    make all their changes in one commit, including queued email,
+    so a retry never repeats changes already committed, and only
+    flash messages and send signals after it.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        retries = current_app.config['SQLITE_BUSY_RETRIES']
+        backoff = current_app.config['SQLITE_BUSY_BACKOFF']
+
+        for attempt in xrange(retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError, e:
+                if attempt == retries or not is_busy(e):
+                    raise
+                db.session.rollback()
+                time.sleep(random.uniform(0, backoff * 2 ** attempt))
+    return wrapper
@@ -1,12 +1,13 @@
 from flaskext.mail import Mail
 from flaskext.openid import OpenID
-from flaskext.sqlalchemy import SQLAlchemy
 from flaskext.cache import Cache
 
+from newsmeme.routing import RoutingSQLAlchemy
+
 __all__ = ['oid', 'mail', 'db']
 
 oid = OpenID()
 mail = Mail()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 cache = Cache()
 
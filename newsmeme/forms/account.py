@@ -48,12 +48,12 @@ class SignupForm(Form):
     submit = SubmitField(_("Signup"))
 
     def validate_username(self, field):
-        user = User.query.filter(User.username.like(field.data)).first()
+        user = User.query.by_username(field.data).first()
         if user:
             raise ValidationError, gettext("This username is taken")
 
     def validate_email(self, field):
-        user = User.query.filter(User.email.like(field.data)).first()
+        user = User.query.by_email(field.data).first()
         if user:
             raise ValidationError, gettext("This email is taken")
 
@@ -81,17 +81,15 @@ class EditAccountForm(Form):
         super(EditAccountForm, self).__init__(*args, **kwargs)
         
     def validate_username(self, field):
-        user = User.query.filter(db.and_(
-                                 User.username.like(field.data),
-                                 db.not_(User.id==self.user.id))).first()
+        user = User.query.by_username(field.data).\
+                    filter(db.not_(User.id==self.user.id)).first()
 
         if user:
             raise ValidationError, gettext("This username is taken")
 
     def validate_email(self, field):
-        user = User.query.filter(db.and_(
-                                 User.email.like(field.data),
-                                 db.not_(User.id==self.user.id))).first()
+        user = User.query.by_email(field.data).\
+                    filter(db.not_(User.id==self.user.id)).first()
         if user:
             raise ValidationError, gettext("This email is taken")
 
@@ -1,7 +1,7 @@
 from flaskext.wtf import Form, HiddenField, TextField, RecaptchaField, \
         SubmitField, ValidationError, required, email, url
 
-from flaskext.babel import lazy_gettext as _
+from flaskext.babel import gettext, lazy_gettext as _
 
 from newsmeme.models import User
 
@@ -24,12 +24,12 @@ class OpenIdSignupForm(Form):
     submit = SubmitField(_("Signup"))
 
     def validate_username(self, field):
-        user = User.query.filter(User.username.like(field.data)).first()
+        user = User.query.by_username(field.data).first()
         if user:
             raise ValidationError, gettext("This username is taken")
 
     def validate_email(self, field):
-        user = User.query.filter(User.email.like(field.data)).first()
+        user = User.query.by_email(field.data).first()
         if user:
             raise ValidationError, gettext("This email is taken")
 
@@ -5,6 +5,7 @@ from flaskext.wtf import Form, TextField, TextAreaField, RadioField, \
 from flaskext.babel import gettext, lazy_gettext as _
 
 from newsmeme.models import Post
+from newsmeme.helpers import link_hash
 from newsmeme.extensions import db
 
 class PostForm(Form):
@@ -34,7 +35,9 @@ class PostForm(Form):
         super(PostForm, self).__init__(*args, **kwargs)
 
     def validate_link(self, field):
-        posts = Post.query.public().filter_by(link=field.data)
+        if not field.data:
+            return
+        posts = Post.query.public().filter_by(link_hash=link_hash(field.data))
         if self.post:
             posts = posts.filter(db.not_(Post.id==self.post.id))
         if posts.count():
@@ -9,7 +9,9 @@
     :license: BSD, see LICENSE for more details.
 """
 import markdown
+import hashlib
 import re
+import urllib
 import urlparse
 import functools
 
@@ -93,3 +95,56 @@ def domain(url):
         rv = rv[4:]
     return rv
 
+
+# query parameters used for tracking rather than content
+TRACKING_PARAMS = frozenset(("fbclid", "gclid", "ref", "mc_cid", "mc_eid"))
+
+def canonical_url(url):
+    """
+    Returns URL normalized for duplicate detection e.g.
+    https://www.x.com/a/?utm_source=y > http://x.com/a
+    Scheme and host are lower cased, https is treated as http, 
+    "www.", default ports, trailing slashes, fragments and tracking
+    parameters are removed, and other parameters are sorted.
+    """
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url.strip())
+
+    scheme = scheme.lower()
+    if scheme == "https":
+        scheme = "http"
+
+    netloc = netloc.lower()
+    if netloc.startswith("www."):
+        netloc = netloc[4:]
+    if netloc.endswith(":80") or netloc.endswith(":443"):
+        netloc = netloc.rsplit(":", 1)[0]
+
+    params = [(key, value) for key, value in \
+              urlparse.parse_qsl(query, keep_blank_values=True) \
+              if not key.lower().startswith("utm_") and \
+              key.lower() not in TRACKING_PARAMS]
+    params.sort()
+
+    return urlparse.urlunsplit((scheme, 
+                                netloc, 
+                                path.rstrip("/"), 
+                                urllib.urlencode(params), 
+                                ""))
+
+
+def link_hash(url):
+    """
+    Returns hash of the canonical form of a URL
+    """
+    if isinstance(url, unicode):
+        url = url.encode("utf-8")
+    return hashlib.md5(canonical_url(url)).hexdigest()
+
+
+def gravatar(email):
+    """
+    Returns the gravatar hash of an email address
+    """
+    md5 = hashlib.md5()
+    md5.update(email.strip().lower())
+    return md5.hexdigest()
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+    importer.py
+    ~~~~~~~~~~~
+
+    Imports posts from RSS and Atom feeds (manage.py importfeed).
+    Feeds are fetched concurrently, conditionally on their last
+    ETag and Last-Modified values, and new entries are inserted 
+    in chunks.
+
+    :copyright: (c) 2010 by Dan Jacob.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import calendar
+import feedparser
+
+from datetime import datetime
+from email.utils import formatdate
+from multiprocessing.pool import ThreadPool
+
+from newsmeme.extensions import db
+from newsmeme.helpers import slugify, domain, link_hash
+from newsmeme.models import Post, Feed
+from newsmeme.models.timelines import fan_out_posts, uncache_celebrities
+
+def fetch(source, etag=None, modified=None):
+    """
+    Parses a feed URL or local file. Returns (entries, etag, 
+    modified), or None if the feed has not been modified since
+    the given etag and modified values. Local files are compared
+    by modification time.
+    """
+
+    if os.path.exists(source):
+        mtime = formatdate(os.path.getmtime(source), usegmt=True)
+        if mtime == modified:
+            return None
+        return feedparser.parse(source).entries, None, mtime
+
+    d = feedparser.parse(source, etag=etag, modified=modified)
+
+    if 'status' not in d and d.get('bozo'):
+        # the feed could not be fetched
+        raise d.bozo_exception
+
+    if d.status == 304:
+        return None
+
+    if d.status >= 400:
+        raise IOError("%s returned HTTP %d" % (source, d.status))
+
+    modified = d.get('modified')
+    if modified is not None and not isinstance(modified, basestring):
+        # older feedparser versions return a UTC time tuple
+        modified = formatdate(calendar.timegm(modified), usegmt=True)
+
+    return d.entries, d.get('etag'), modified
+
+
+def _fetch_feed(args):
+    url, etag, modified = args
+    try:
+        return url, fetch(url, etag, modified), None
+    except Exception, e:
+        return url, None, e
+
+
+def import_entries(entries, author, seen=None, batch_size=100):
+    """
+    Inserts posts for entries whose link has not been posted, 
+    checking links and inserting rows batch_size entries at a 
+    time. Links are compared by canonical link hash. Hashes in 
+    `seen` are skipped and new hashes added to it. New posts are
+    copied to the timelines of the author's followers. Returns
+    number of posts added.
+    """
+
+    if seen is None:
+        seen = set()
+
+    num_posts = 0
+    now = datetime.utcnow()
+
+    for start in xrange(0, len(entries), batch_size):
+        batch = entries[start:start + batch_size]
+
+        hashes = dict((entry.link, link_hash(entry.link)) for entry in \
+                      batch if entry.get('link'))
+
+        if not hashes:
+            continue
+
+        posted = set(row[0] for row in \
+                     db.session.query(Post.link_hash).\
+                     filter(Post.link_hash.in_(set(hashes.values()))))
+
+        rows = []
+
+        for entry in batch:
+            link = entry.get('link')
+
+            if not link or len(link) > 250 or \
+                hashes[link] in posted or hashes[link] in seen:
+                continue
+
+            seen.add(hashes[link])
+
+            title = (entry.get('title') or link)[:200]
+
+            rows.append(dict(author_id=author.id,
+                             title=title,
+                             slug=slugify(title)[:80],
+                             link=link,
+                             domain=domain(link),
+                             link_hash=hashes[link],
+                             date_created=now,
+                             score=1,
+                             num_comments=0,
+                             votes=set(),
+                             access=Post.PUBLIC))
+
+        if rows:
+            db.session.execute(Post.__table__.insert(), rows)
+
+            post_ids = [post_id for post_id, in \
+                        db.session.query(Post.id).\
+                        filter(Post.author_id==author.id).\
+                        filter(Post.link_hash.in_([row['link_hash'] \
+                                                   for row in rows]))]
+
+            num_timelines, celebrity = fan_out_posts(author,
+                                                     Post.PUBLIC,
+                                                     post_ids)
+
+            db.session.commit()
+
+            if celebrity:
+                uncache_celebrities()
+
+            num_posts += len(rows)
+
+    return num_posts
+
+
+def import_feeds(sources, author, workers=4, batch_size=100):
+    """
+    Fetches feed URLs or local files using a pool of `workers` 
+    threads and imports their new entries as posts by `author`.
+    Returns (posts added, feeds not modified, feeds failed).
+    """
+
+    feeds = dict((feed.url, feed) for feed in \
+                 Feed.query.filter(Feed.url.in_(sources)))
+
+    for source in sources:
+        if source not in feeds:
+            feeds[source] = Feed(url=source)
+            db.session.add(feeds[source])
+
+    db.session.commit()
+
+    num_posts = num_unmodified = num_failed = 0
+    seen = set()
+
+    pool = ThreadPool(workers)
+
+    try:
+        # only fetching runs in the pool: the session is used 
+        # by this thread alone
+        for url, result, error in pool.imap_unordered(
+            _fetch_feed, [(feed.url, feed.etag, feed.modified) \
+                          for feed in feeds.itervalues()]):
+
+            feed = feeds[url]
+            feed.last_fetched = datetime.utcnow()
+
+            if error is not None:
+                num_failed += 1
+            elif result is None:
+                num_unmodified += 1
+            else:
+                entries, feed.etag, feed.modified = result
+                num_posts += import_entries(entries, author, seen, batch_size)
+                feed.last_imported = feed.last_fetched
+
+            db.session.commit()
+
+    finally:
+        pool.close()
+        pool.join()
+
+    return num_posts, num_unmodified, num_failed
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+    instrumentation.py
+    ~~~~~~~~~~~~~~~~~~
+
+    Per-request SQL instrumentation: query counts, total SQL time
+    and repeated statement shapes (possible N+1 queries).
+
+    :copyright: (c) 2010 by Dan Jacob.
+    :license: BSD, see LICENSE for more details.
+"""
+import re
+import time
+import threading
+
+from flask import request, _request_ctx_stack
+
+from sqlalchemy import event
+
+from newsmeme.extensions import db
+
+_number_re = re.compile(r"\b\d+\b")
+_string_re = re.compile(r"'(?:[^']|'')*'")
+_in_re = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_space_re = re.compile(r"\s+")
+
+# collectors active outside of the request in this thread, 
+# see record_queries()
+_local = threading.local()
+
+def statement_shape(statement):
+    """
+    Normalizes a SQL statement so that statements differing only
+    in literal values or IN list length have the same shape.
+    """
+    statement = _string_re.sub("?", statement)
+    statement = _number_re.sub("?", statement)
+    statement = _in_re.sub("(?)", statement)
+    return _space_re.sub(" ", statement).strip()
+
+
+class QueryStats(object):
+    """
+    Collects number of queries, total time and statement shapes.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = {}
+
+    def add(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+
+        shape = statement_shape(statement)
+        self.shapes[shape] = self.shapes.get(shape, 0) + 1
+
+    def repeated(self, threshold):
+        """
+        Returns list of (shape, count) for statements run at least
+        threshold times, most frequent first.
+        """
+        rv = [(shape, count) for shape, count in self.shapes.iteritems() \
+              if count >= threshold]
+        rv.sort(key=lambda item: item[1], reverse=True)
+        return rv
+
+
+class record_queries(object):
+    """
+    Context manager collecting stats for all queries run inside the
+    block, whether or not in a request e.g.
+
+        with record_queries() as stats:
+            client.get("/")
+        assert stats.count < 10
+
+    Only queries run in the current thread are collected.
+    Instrumentation must be enabled with SQLALCHEMY_INSTRUMENT.
+    """
+
+    def __enter__(self):
+        self.stats = QueryStats()
+        _get_collectors().append(self.stats)
+        return self.stats
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _get_collectors().remove(self.stats)
+
+
+def _get_collectors():
+    collectors = getattr(_local, "collectors", None)
+    if collectors is None:
+        collectors = _local.collectors = []
+    return collectors
+
+
+def get_query_stats():
+    """
+    Returns QueryStats for the current request, or None
+    """
+    ctx = _request_ctx_stack.top
+    if ctx is None:
+        return None
+    return getattr(ctx, "query_stats", None)
+
+
+def _before_cursor_execute(conn, cursor, statement,
+                           parameters, context, executemany):
+
+    conn.info.setdefault("query_start", []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement,
+                          parameters, context, executemany):
+
+    duration = time.time() - conn.info["query_start"].pop()
+
+    ctx = _request_ctx_stack.top
+    if ctx is not None:
+        if not hasattr(ctx, "query_stats"):
+            ctx.query_stats = QueryStats()
+        ctx.query_stats.add(statement, duration)
+
+    for stats in _get_collectors():
+        stats.add(statement, duration)
+
+
+def _dbapi_error(conn, cursor, statement, parameters, context, exception):
+
+    # after_cursor_execute is not called for failed statements
+    conn.info["query_start"].pop()
+
+
+def init_app(app):
+    """
+    Installs engine listeners and reports stats for each request
+    in a Server-Timing header and the application log.
+    """
+
+    engines = [db.get_engine(app)]
+
+    if getattr(app, "read_engine", None) is not None:
+        engines.append(app.read_engine)
+
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(engine, "dbapi_error", _dbapi_error)
+
+    threshold = app.config['SQLALCHEMY_REPEATED_QUERY_THRESHOLD']
+
+    @app.after_request
+    def report_queries(response):
+
+        stats = get_query_stats()
+        if stats is None:
+            return response
+
+        response.headers.add("Server-Timing",
+                             'db;dur=%.2f;desc="%d queries"' % (
+                             stats.duration * 1000, stats.count))
+
+        app.logger.info("%s %s: %d queries in %.2fms",
+                        request.method,
+                        request.path,
+                        stats.count,
+                        stats.duration * 1000)
+
+        for shape, count in stats.repeated(threshold):
+            app.logger.warning("%s %s: possible N+1, %d x %s",
+                               request.method,
+                               request.path,
+                               count,
+                               shape)
+
+        return response
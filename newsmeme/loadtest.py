@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""
+    loadtest.py
+    ~~~~~~~~~~~
+
+    Load generator (manage.py loadtest). Starts the application in a
+    local forking WSGI server and sends requests from several client
+    processes: either a synthetic mix of reads and writes, or the
+    requests in an access log. Reports throughput, latency
+    percentiles and requests failed by SQLite lock timeouts.
+
+    :copyright: (c) 2010 by Dan Jacob.
+    :license: BSD, see LICENSE for more details.
+"""
+import re
+import time
+import socket
+import urllib
+import urllib2
+import cookielib
+import multiprocessing
+
+from flask import got_request_exception
+
+from sqlalchemy.exc import OperationalError
+
+from werkzeug.serving import run_simple, WSGIRequestHandler
+from werkzeug.exceptions import HTTPException
+
+from newsmeme import create_app
+from newsmeme.extensions import db
+from newsmeme.models import User, Post, Tag
+from newsmeme.benchmark import summarize
+from newsmeme.seeder import WORDS, SEED_PASSWORD
+
+# action name and relative weight
+DEFAULT_MIX = (("index", 40),
+               ("latest", 10),
+               ("post", 25),
+               ("tag", 5),
+               ("search", 5),
+               ("upvote", 10),
+               ("comment", 3),
+               ("submit", 2))
+
+# POST requests that can be replayed without a request body
+REPLAYED_POSTS = ("post.upvote", "post.downvote",
+                  "comment.upvote", "comment.downvote")
+
+_log_re = re.compile(r'"?(GET|HEAD|POST) (\S+)')
+
+def parse_mix(spec):
+    """
+    Parses a mix like "index=40,post=20,upvote=5". Raises
+    ValueError for unknown actions or bad weights.
+    """
+
+    actions = dict(DEFAULT_MIX)
+    mix = []
+
+    for item in spec.split(","):
+        name, weight = item.split("=")
+        name = name.strip()
+        if name not in actions:
+            raise ValueError("Unknown action %s" % name)
+        mix.append((name, int(weight)))
+
+    return tuple(mix)
+
+
+def get_targets(num_posts=10000):
+    """
+    Returns dict of recent public post ids, tag slugs and usernames
+    for synthetic requests.
+    """
+
+    return dict(post_ids=[post_id for post_id, in \
+                          db.session.query(Post.id).\
+                          filter(Post.access==Post.PUBLIC).\
+                          order_by(Post.id.desc()).limit(num_posts)],
+                tags=[slug for slug, in db.session.query(Tag.slug)],
+                usernames=[username for username, in \
+                           db.session.query(User._username).\
+                           order_by(User.id).limit(1000)])
+
+
+def synthetic_requests(rng, mix, targets, num_requests):
+    """
+    Returns list of (action, method, path, form data) drawn from
+    the mix.
+    """
+
+    actions = []
+    for name, weight in mix:
+        actions.extend([name] * weight)
+
+    rv = []
+
+    for i in xrange(num_requests):
+        action = rng.choice(actions)
+        post_id = rng.choice(targets['post_ids'])
+
+        if action == "index":
+            request = ("GET", "/%d/" % rng.randint(1, 3), None)
+
+        elif action == "latest":
+            request = ("GET", "/latest/", None)
+
+        elif action == "post":
+            request = ("GET", "/post/%d/" % post_id, None)
+
+        elif action == "tag":
+            request = ("GET", "/tags/%s/" % rng.choice(targets['tags']),
+                       None)
+
+        elif action == "search":
+            request = ("GET", "/search/?keywords=%s" % rng.choice(WORDS),
+                       None)
+
+        elif action == "upvote":
+            request = ("POST", "/post/%d/upvote/" % post_id, None)
+
+        elif action == "comment":
+            request = ("POST", "/post/%d/addcomment/" % post_id,
+                       dict(comment=" ".join(rng.sample(WORDS, 10))))
+
+        else:
+            request = ("POST", "/submit/",
+                       dict(title=" ".join(rng.sample(WORDS, 5)),
+                            link="http://loadtest.example.com/%d/%d" % (
+                                 rng.randint(0, 1 << 30), i),
+                            access=Post.PUBLIC))
+
+        rv.append((action,) + request)
+
+    return rv
+
+
+def read_log(fp, url_map):
+    """
+    Returns list of (endpoint, method, path, None) for requests in
+    an access log, e.g. in Apache combined format. POST requests
+    are only replayed for votes, as logs have no request bodies.
+    Lines for unknown URLs are skipped.
+    """
+
+    adapter = url_map.bind("localhost")
+    rv = []
+
+    for line in fp:
+        match = _log_re.search(line)
+        if match is None:
+            continue
+
+        method, path = match.groups()
+
+        try:
+            endpoint, args = adapter.match(path.split("?")[0], method)
+        except HTTPException:
+            continue
+
+        if method == "POST" and endpoint not in REPLAYED_POSTS:
+            continue
+
+        rv.append((endpoint, method, path, None))
+
+    return rv
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+
+    def log_request(self, *args):
+        pass
+
+
+class _NoRedirectHandler(urllib2.HTTPRedirectHandler):
+
+    # redirects are measured as responses
+    def redirect_request(self, *args):
+        return None
+
+
+def _serve(config, port, num_servers, lock_errors):
+
+    app = create_app(config)
+
+    def count_lock_errors(sender, exception):
+        if isinstance(exception, OperationalError) and \
+            "locked" in str(exception):
+            lock_errors.get_lock().acquire()
+            try:
+                lock_errors.value += 1
+            finally:
+                lock_errors.get_lock().release()
+
+    got_request_exception.connect(count_lock_errors, app)
+
+    run_simple("localhost", port, app,
+               processes=num_servers,
+               request_handler=_QuietRequestHandler)
+
+
+def _wait_for_server(port, timeout=10):
+    started = time.time()
+    while True:
+        try:
+            socket.create_connection(("localhost", port), 1).close()
+            return
+        except socket.error:
+            if time.time() - started > timeout:
+                raise
+            time.sleep(0.1)
+
+
+def _client(args):
+    """
+    Logs in and sends requests one at a time. Returns list of
+    (action, status, latency). Status is 0 if the connection
+    failed.
+    """
+
+    base_url, username, requests = args
+
+    opener = urllib2.build_opener(
+        urllib2.HTTPCookieProcessor(cookielib.CookieJar()),
+        _NoRedirectHandler())
+
+    def send(method, path, data):
+        if method == "POST":
+            data = urllib.urlencode(data or {})
+        started = time.time()
+        try:
+            response = opener.open(base_url + path, data)
+            status = response.code
+            response.read()
+            response.close()
+        except urllib2.HTTPError, e:
+            status = e.code
+            e.close()
+        except (urllib2.URLError, socket.error):
+            status = 0
+        return status, time.time() - started
+
+    send("POST", "/acct/login/", dict(login=username,
+                                      password=SEED_PASSWORD))
+
+    return [(action,) + send(method, path, data) for \
+            action, method, path, data in requests]
+
+
+def report(results, elapsed, lock_errors):
+    """
+    Returns dict of throughput, latency percentiles and errors, in
+    total and per action.
+    """
+
+    def stats(results):
+        statuses = {}
+        for action, status, latency in results:
+            statuses[status] = statuses.get(status, 0) + 1
+
+        return dict(requests=len(results),
+                    status=statuses,
+                    errors=sum(count for status, count in \
+                               statuses.iteritems() \
+                               if status == 0 or status >= 500),
+                    latency=summarize([latency for action, status, \
+                                       latency in results]))
+
+    actions = {}
+    for result in results:
+        actions.setdefault(result[0], []).append(result)
+
+    rv = stats(results)
+
+    rv.update(elapsed=elapsed,
+              throughput=len(results) / elapsed,
+              lock_errors=lock_errors,
+              actions=dict((action, stats(results)) for \
+                           action, results in actions.iteritems()))
+
+    return rv
+
+
+def run(config, requests, usernames, num_clients=4, num_servers=4,
+        port=5050):
+    """
+    Serves the application with `num_servers` processes and sends
+    the requests, split between `num_clients` client processes each
+    logged in as one of `usernames`. Returns report() dict.
+    """
+
+    lock_errors = multiprocessing.Value("i", 0)
+
+    # the server makes its own connections
+    db.session.remove()
+    db.engine.dispose()
+
+    server = multiprocessing.Process(target=_serve,
+                                     args=(config, port, num_servers,
+                                           lock_errors))
+    server.daemon = True
+    server.start()
+
+    try:
+        _wait_for_server(port)
+
+        base_url = "http://localhost:%d" % port
+
+        pool = multiprocessing.Pool(num_clients)
+        try:
+            started = time.time()
+            results = pool.map(_client,
+                               [(base_url,
+                                 usernames[i % len(usernames)],
+                                 requests[i::num_clients]) \
+                                for i in xrange(num_clients)])
+            elapsed = time.time() - started
+        finally:
+            pool.close()
+            pool.join()
+
+    finally:
+        server.terminate()
+        server.join()
+
+    return report([result for client_results in results \
+                   for result in client_results],
+                  elapsed,
+                  lock_errors.value)
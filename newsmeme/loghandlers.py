@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+    loghandlers.py
+    ~~~~~~~~~~~~~~
+
+    Non-blocking logging: records are put on a queue and handled
+    by a background thread, and error emails are sent as digests.
+
+    :copyright: (c) 2010 by Dan Jacob.
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+import Queue
+import smtplib
+import logging
+import threading
+
+from email.utils import formatdate
+from logging.handlers import SMTPHandler
+
+class QueueHandler(logging.Handler):
+    """
+    Puts records on a queue without blocking. Records are dropped
+    if the queue is full.
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def prepare(self, record):
+        """
+        Merges message arguments and traceback into the message, so
+        the record holds no references to request objects.
+        """
+        record.msg = self.format(record)
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            pass
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """
+    Background thread passing records from a queue to handlers.
+    Handlers with a poll() method are polled at least every
+    poll_interval seconds, so buffered records get sent.
+    """
+
+    _stop = object()
+
+    def __init__(self, queue, handlers, poll_interval=1):
+        self.queue = queue
+        self.handlers = handlers
+        self.poll_interval = poll_interval
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.queue.put(self._stop)
+        self.thread.join()
+        self.thread = None
+
+        for handler in self.handlers:
+            handler.close()
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def poll(self):
+        for handler in self.handlers:
+            if hasattr(handler, "poll"):
+                handler.poll()
+
+    def run(self):
+        while True:
+            try:
+                record = self.queue.get(True, self.poll_interval)
+            except Queue.Empty:
+                record = None
+
+            if record is self._stop:
+                break
+
+            if record is not None:
+                self.handle(record)
+
+            self.poll()
+
+
+class DigestSMTPHandler(SMTPHandler):
+    """
+    Buffers records and emails them as one digest at most every
+    `interval` seconds. At most `capacity` records are kept per
+    digest; the number of records left out is noted in the email.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.interval = kwargs.pop("interval", 300)
+        self.capacity = kwargs.pop("capacity", 50)
+
+        SMTPHandler.__init__(self, *args, **kwargs)
+
+        self.buffer = []
+        self.dropped = 0
+        self.last_sent = 0
+
+    def emit(self, record):
+        self.acquire()
+        try:
+            if len(self.buffer) < self.capacity:
+                self.buffer.append(record)
+            else:
+                self.dropped += 1
+        finally:
+            self.release()
+
+        self.poll()
+
+    def poll(self):
+        if time.time() - self.last_sent >= self.interval:
+            self.flush()
+
+    def flush(self):
+        self.acquire()
+        try:
+            records, dropped = self.buffer, self.dropped
+            self.buffer, self.dropped = [], 0
+        finally:
+            self.release()
+
+        if not records:
+            return
+
+        self.last_sent = time.time()
+
+        try:
+            self.send(records, dropped)
+        except Exception:
+            self.handleError(records[-1])
+
+    def close(self):
+        self.flush()
+        SMTPHandler.close(self)
+
+    def send(self, records, dropped):
+
+        subject = "%s (%d)" % (self.subject, len(records) + dropped)
+
+        body = "\n\n".join(self.format(record) for record in records)
+        if dropped:
+            body += "\n\n%d more not shown" % dropped
+
+        msg = "From: %s\r\nTo: %s\r\nSubject: %s\r\nDate: %s\r\n\r\n%s" % (
+              self.fromaddr,
+              ",".join(self.toaddrs),
+              subject,
+              formatdate(),
+              body)
+
+        smtp = smtplib.SMTP(self.mailhost, self.mailport or smtplib.SMTP_PORT)
+        try:
+            if self.username:
+                smtp.login(self.username, self.password)
+            smtp.sendmail(self.fromaddr, self.toaddrs, msg)
+        finally:
+            smtp.quit()
@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+"""
+    mailer.py
+    ~~~~~~~~~
+
+    Email is queued in the outbox table by views and sent by the
+    mail worker (manage.py mailworker), so requests never wait
+    on the mail server. Notifications are queued as digests by
+    manage.py digests. Mailings to all users (manage.py mailall)
+    are sent directly over a pool of connections.
+
+    :copyright: (c) 2010 by Dan Jacob.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import time
+import Queue
+import socket
+import smtplib
+import threading
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from flask import current_app
+
+from flaskext.mail import Message
+from flaskext.babel import gettext as _
+
+from newsmeme.extensions import db, mail
+from newsmeme.helpers import render_template
+from newsmeme.models import OutboxMessage, User, Notification
+
+def send(message):
+    """
+    Queues a flaskext.mail Message for sending. The message is
+    committed with the caller's changes.
+    """
+    db.session.add(OutboxMessage.from_message(message))
+
+
+def send_message(*args, **kwargs):
+    send(Message(*args, **kwargs))
+
+
+def process_outbox(batch_size=100):
+    """
+    Sends pending messages in batches over one SMTP connection, 
+    until none are left. Failed messages are retried later with 
+    backoff. Returns number of (sent, failed) messages.
+    """
+
+    num_sent = num_failed = 0
+
+    batch = OutboxMessage.query.pending().limit(batch_size).all()
+
+    if not batch:
+        return num_sent, num_failed
+
+    try:
+        with mail.connect() as conn:
+
+            while batch:
+
+                for outbox in batch:
+                    try:
+                        conn.send(outbox.to_message())
+                    except smtplib.SMTPServerDisconnected:
+                        raise
+                    except smtplib.SMTPException, e:
+                        outbox.failed(e)
+                        num_failed += 1
+                    else:
+                        outbox.sent()
+                        num_sent += 1
+
+                db.session.commit()
+
+                batch = OutboxMessage.query.pending().\
+                            limit(batch_size).all()
+
+    except (socket.error, smtplib.SMTPException), e:
+
+        # connection lost: unsent messages in this batch are retried
+        for outbox in batch:
+            if outbox.date_sent is None:
+                outbox.failed(e)
+                num_failed += 1
+
+        db.session.commit()
+
+    return num_sent, num_failed
+
+
+def send_digests(window, batch_size=100, now=None):
+    """
+    Queues one digest email for each user whose notifications are
+    due, in batches of users, and deletes the notifications sent. 
+    Returns number of digests.
+    """
+
+    num_digests = 0
+
+    while True:
+
+        user_ids = [user_id for user_id, in \
+                    Notification.query.due(window, now).limit(batch_size)]
+
+        if not user_ids:
+            break
+
+        users = dict((user.id, user) for user in \
+                     User.query.filter(User.id.in_(user_ids)))
+
+        pending = {}
+        notification_ids = []
+
+        for notification in Notification.query.for_users(user_ids):
+            pending.setdefault(notification.user_id, []).append(notification)
+            notification_ids.append(notification.id)
+
+        for user_id in user_ids:
+            user = users.get(user_id)
+            if user is None:
+                continue
+
+            notifications = pending.get(user_id, [])
+
+            # comments may have been deleted since
+            commented = [n for n in notifications if \
+                         n.kind == Notification.COMMENTED and n.comment]
+
+            replied = [n for n in notifications if \
+                       n.kind == Notification.REPLIED and n.comment]
+
+            followed = [n for n in notifications if \
+                        n.kind == Notification.FOLLOWED]
+
+            if not (commented or replied or followed):
+                continue
+
+            body = render_template("emails/digest.html",
+                                   user=user,
+                                   commented=commented,
+                                   replied=replied,
+                                   followed=followed)
+
+            message = Message(subject=_("Your newsmeme notifications"),
+                              body=body,
+                              recipients=[user.email])
+
+            db.session.add(OutboxMessage.from_message(message))
+            num_digests += 1
+
+        if notification_ids:
+            Notification.query.filter(
+                Notification.id.in_(notification_ids)).\
+                delete(synchronize_session=False)
+
+        db.session.commit()
+
+    return num_digests
+
+
+class Throttle(object):
+    """
+    Limits calls of wait() to `rate` per second across threads.
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_call = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+
+        self.lock.acquire()
+        try:
+            now = time.time()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        finally:
+            self.lock.release()
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Checkpoint(object):
+    """
+    Stores a mailing and the id of the last user such that every
+    user up to it has been handled, so an interrupted mailing
+    resumes after it. Users are handled out of order by the
+    connection pool, so the id only advances over users handled
+    without gaps. The id is stored by save(), once per batch.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mailing = None
+        self.dispatched = []
+        self.handled = set()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        fp = open(self.path)
+        try:
+            self.mailing = json.load(fp)
+        finally:
+            fp.close()
+        return self.mailing
+
+    def start(self, subject, body, sender):
+        self.mailing = dict(subject=subject,
+                            body=body,
+                            sender=sender,
+                            last_id=0)
+        self.save()
+
+    def save(self):
+        # write and rename so an interrupted write keeps the old file
+        tmp = self.path + ".tmp"
+        fp = open(tmp, "w")
+        try:
+            json.dump(self.mailing, fp)
+        finally:
+            fp.close()
+        os.rename(tmp, self.path)
+
+    def remove(self):
+        os.remove(self.path)
+
+    def dispatch(self, user_id):
+        self.dispatched.append(user_id)
+
+    def handle(self, user_id):
+        self.handled.add(user_id)
+
+        last_id = None
+        while self.dispatched and self.dispatched[0] in self.handled:
+            last_id = self.dispatched.pop(0)
+            self.handled.remove(last_id)
+
+        if last_id is not None:
+            self.mailing['last_id'] = last_id
+
+
+def _send_bulk_worker(app, tasks, results, throttle, mailing):
+    """
+    Sends messages for (user_id, email) tasks until None is taken,
+    putting (user_id, email, error) on results for every task, as
+    send_bulk waits for all of them. A new connection is opened if
+    the connection fails.
+    """
+
+    message = Message(subject=mailing['subject'],
+                      body=mailing['body'],
+                      sender=mailing['sender'])
+
+    with app.test_request_context():
+
+        task = tasks.get()
+
+        while task is not None:
+            try:
+                with mail.connect() as conn:
+                    while task is not None:
+                        try:
+                            message.recipients = [task[1]]
+                            throttle.wait()
+                            conn.send(message)
+                        except (socket.error,
+                                smtplib.SMTPServerDisconnected):
+                            raise
+                        except Exception, e:
+                            # e.g. a bad address, failing this task only
+                            results.put(task + (e,))
+                        else:
+                            results.put(task + (None,))
+
+                        task = tasks.get()
+
+            except Exception, e:
+                if task is None:
+                    break
+                results.put(task + (e,))
+                task = tasks.get()
+
+
+def send_bulk(checkpoint, connections=4, rate=None, batch_size=1000):
+    """
+    Sends the checkpoint's mailing to every user after its last 
+    handled user, over a pool of `connections` SMTP connections 
+    sending at most `rate` messages per second in total. Messages
+    that fail are queued in the outbox to be retried by the mail
+    worker. Returns number of (sent, failed) messages.
+    """
+
+    mailing = checkpoint.mailing
+
+    tasks = Queue.Queue(connections * 10)
+    results = Queue.Queue()
+    throttle = Throttle(rate)
+
+    threads = []
+    for i in xrange(connections):
+        thread = threading.Thread(target=_send_bulk_worker,
+                                  args=(current_app._get_current_object(),
+                                        tasks,
+                                        results,
+                                        throttle,
+                                        mailing))
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+
+    counts = [0, 0]
+
+    def handle(user_id, email, error):
+        if error is None:
+            counts[0] += 1
+        else:
+            send_message(subject=mailing['subject'],
+                         body=mailing['body'],
+                         sender=mailing['sender'],
+                         recipients=[email])
+            counts[1] += 1
+
+        checkpoint.handle(user_id)
+
+    last_id = mailing['last_id']
+
+    def save():
+        # failed messages are committed before the users they were
+        # for are passed over
+        db.session.commit()
+        checkpoint.save()
+
+    while True:
+        # select in batches by id rather than with an open cursor, 
+        # as failed messages are committed to the outbox meanwhile
+        users = db.session.query(User.id, User._email).\
+                    filter(User.id > last_id).\
+                    order_by(User.id.asc()).\
+                    limit(batch_size).all()
+
+        if not users:
+            break
+
+        for user_id, email in users:
+            checkpoint.dispatch(user_id)
+            tasks.put((user_id, email))
+
+            while True:
+                try:
+                    handle(*results.get_nowait())
+                except Queue.Empty:
+                    break
+
+        last_id = users[-1][0]
+
+        save()
+
+    for thread in threads:
+        tasks.put(None)
+
+    while checkpoint.dispatched:
+        handle(*results.get())
+
+    save()
+
+    for thread in threads:
+        thread.join()
+
+    return tuple(counts)
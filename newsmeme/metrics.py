@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+"""
+    metrics.py
+    ~~~~~~~~~~
+
+    In-process metrics registry for request latency, cache hits and
+    misses and DB time per endpoint. Each worker process flushes its
+    metrics to its own file in a shared directory, and the files are
+    merged on exposition so totals are correct across prefork workers.
+    Files left by dead workers are merged into an archive file when
+    a worker first flushes.
+
+    :copyright: (c) 2010 by Dan Jacob.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import glob
+import time
+import errno
+import fcntl
+import atexit
+import weakref
+import threading
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from flask import g, request
+
+from newsmeme.extensions import cache
+from newsmeme.instrumentation import get_query_stats
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+ARCHIVE_FILENAME = "metrics-archive.json"
+
+# registries of apps with metrics, flushed at exit
+_registries = weakref.WeakSet()
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _load(path):
+    try:
+        fp = open(path)
+        try:
+            return json.load(fp)
+        finally:
+            fp.close()
+    except (IOError, ValueError):
+        return None
+
+
+def _dump(path, data):
+    # write and rename so readers never see a partial file
+    tmp = path + ".tmp"
+    fp = open(tmp, "w")
+    try:
+        json.dump(data, fp)
+    finally:
+        fp.close()
+    os.rename(tmp, path)
+
+
+class Registry(object):
+    """
+    Stores counters and histograms, keyed by metric name and a
+    tuple of (label, value) pairs.
+
+    Worker files are named by pid and start time, so a reused pid
+    never overwrites the totals of the dead worker. The file is
+    named on the first flush, and again in a process forked since,
+    so workers forked by a preloading server each get their own.
+    """
+
+    def __init__(self, metrics_dir, flush_interval=5,
+                 buckets=DEFAULT_BUCKETS, pid=None):
+
+        self.metrics_dir = metrics_dir
+        self.flush_interval = flush_interval
+        self.buckets = tuple(buckets)
+        self.fixed_pid = pid
+        self.owner = os.getpid()
+        self.pid = None
+        self.started = None
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.last_flush = 0
+
+        if not os.path.exists(metrics_dir):
+            os.makedirs(metrics_dir)
+
+    def _check_fork(self):
+        # metrics recorded before a fork are the parent's
+        if os.getpid() != self.owner:
+            self.owner = os.getpid()
+            self.pid = None
+            self.counters = {}
+            self.histograms = {}
+
+    def _start(self):
+        """
+        Names this process's file on its first flush, merging files
+        of dead workers into the archive.
+        """
+
+        self._check_fork()
+
+        if self.pid is None:
+            self.pid = self.fixed_pid or self.owner
+            self.started = int(time.time() * 1000000)
+            self.last_flush = 0
+            self.archive()
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, tuple(labels))
+        self.lock.acquire()
+        try:
+            self._check_fork()
+            self.counters[key] = self.counters.get(key, 0) + value
+        finally:
+            self.lock.release()
+
+    def observe(self, name, value, labels=()):
+        """
+        Adds value to a histogram. Buckets are stored cumulatively,
+        followed by the sum and count of values.
+        """
+        key = (name, tuple(labels))
+        self.lock.acquire()
+        try:
+            self._check_fork()
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * (len(self.buckets) + 2)
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist[i] += 1
+
+            hist[-2] += value
+            hist[-1] += 1
+        finally:
+            self.lock.release()
+
+    @property
+    def filename(self):
+        self._start()
+        return os.path.join(self.metrics_dir, 
+                            "metrics-%d-%d.json" % (self.pid, self.started))
+
+    def flush(self, force=False):
+        """
+        Writes this process's metrics to its file, at most once
+        every flush_interval seconds unless forced.
+        """
+
+        now = time.time()
+        if not force and now - self.last_flush < self.flush_interval:
+            return
+
+        self.lock.acquire()
+        try:
+            self._start()
+
+            data = dict(counters=[[name, labels, value] for \
+                                  (name, labels), value in \
+                                  self.counters.iteritems()],
+                        histograms=[[name, labels, hist] for \
+                                    (name, labels), hist in \
+                                    self.histograms.iteritems()])
+
+            _dump(self.filename, data)
+
+            self.last_flush = now
+        finally:
+            self.lock.release()
+
+    def archive(self):
+        """
+        Merges files of dead workers into the archive file. Files
+        with this process's pid are from a dead worker whose pid
+        was reused.
+        """
+
+        lockfile = open(os.path.join(self.metrics_dir, "metrics.lock"), "a")
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            dead = []
+            for path in glob.glob(os.path.join(self.metrics_dir,
+                                               "metrics-*-*.json")):
+                pid = int(os.path.basename(path).split("-")[1])
+                if pid == self.pid or not _is_running(pid):
+                    dead.append(path)
+
+            if not dead:
+                return
+
+            archive_path = os.path.join(self.metrics_dir, ARCHIVE_FILENAME)
+            counters, histograms = self.collect([archive_path] + dead)
+
+            _dump(archive_path, 
+                  dict(counters=[[name, labels, value] for \
+                                 (name, labels), value in \
+                                 counters.iteritems()],
+                       histograms=[[name, labels, hist] for \
+                                   (name, labels), hist in \
+                                   histograms.iteritems()]))
+
+            for path in dead:
+                os.remove(path)
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+            lockfile.close()
+
+    def collect(self, paths=None):
+        """
+        Returns (counters, histograms) merged from all process files
+        and the archive, or from the given paths.
+        """
+
+        if paths is None:
+            paths = glob.glob(os.path.join(self.metrics_dir, 
+                                           "metrics-*.json"))
+
+        counters = {}
+        histograms = {}
+
+        for path in paths:
+            data = _load(path)
+            if data is None:
+                continue
+
+            for name, labels, value in data['counters']:
+                key = (name, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+
+            for name, labels, hist in data['histograms']:
+                key = (name, tuple(tuple(label) for label in labels))
+                if key in histograms:
+                    histograms[key] = [a + b for a, b in \
+                                       zip(histograms[key], hist)]
+                else:
+                    histograms[key] = list(hist)
+
+        return counters, histograms
+
+    def render(self):
+        """
+        Returns all metrics in Prometheus text format.
+        """
+
+        self.flush(force=True)
+
+        counters, histograms = self.collect()
+        lines = []
+
+        def format_labels(labels):
+            if not labels:
+                return ""
+            return "{%s}" % ",".join('%s="%s"' % (label, value) \
+                                     for label, value in labels)
+
+        for name in sorted(set(name for name, labels in counters)):
+            lines.append("# TYPE %s counter" % name)
+            for (key, labels), value in sorted(counters.iteritems()):
+                if key == name:
+                    lines.append("%s%s %s" % (name,
+                                              format_labels(labels),
+                                              value))
+
+        for name in sorted(set(name for name, labels in histograms)):
+            lines.append("# TYPE %s histogram" % name)
+            for (key, labels), hist in sorted(histograms.iteritems()):
+                if key != name:
+                    continue
+                for bound, count in zip(self.buckets, hist):
+                    lines.append("%s_bucket%s %d" % (
+                                 name,
+                                 format_labels(labels + (("le", bound),)),
+                                 count))
+                lines.append("%s_bucket%s %d" % (
+                             name,
+                             format_labels(labels + (("le", "+Inf"),)),
+                             hist[-1]))
+                lines.append("%s_sum%s %s" % (name,
+                                              format_labels(labels),
+                                              hist[-2]))
+                lines.append("%s_count%s %d" % (name,
+                                                format_labels(labels),
+                                                hist[-1]))
+
+        return "\n".join(lines) + "\n"
+
+
+class InstrumentedCache(object):
+    """
+    Wraps the cache backend, counting hits and misses.
+    """
+
+    def __init__(self, backend, registry):
+        self.backend = backend
+        self.registry = registry
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def _count(self, value):
+        self.registry.inc("newsmeme_cache_requests_total",
+                          (("result", "miss" if value is None else "hit"),))
+
+    def get(self, key):
+        rv = self.backend.get(key)
+        self._count(rv)
+        return rv
+
+    def get_many(self, *keys):
+        rv = self.backend.get_many(*keys)
+        for value in rv:
+            self._count(value)
+        return rv
+
+
+def init_app(app):
+    """
+    Records request latency and DB time per endpoint. DB time
+    requires SQLALCHEMY_INSTRUMENT.
+    """
+
+    registry = Registry(os.path.join(app.root_path,
+                                     app.config['METRICS_DIR']),
+                        flush_interval=app.config['METRICS_FLUSH_INTERVAL'])
+
+    app.metrics = registry
+
+    _registries.add(registry)
+
+    # cache.cache is already wrapped if the cache was not
+    # reinitialized since the last app was created
+    if isinstance(cache.cache, InstrumentedCache):
+        cache.cache.registry = registry
+    else:
+        cache.cache = InstrumentedCache(cache.cache, registry)
+
+    @app.before_request
+    def start_timer():
+        g.request_started = time.time()
+
+    @app.after_request
+    def record_request(response):
+
+        started = getattr(g, "request_started", None)
+        if started is None:
+            return response
+
+        labels = (("endpoint", request.endpoint or "none"),)
+
+        registry.observe("newsmeme_request_duration_seconds",
+                         time.time() - started,
+                         labels)
+
+        stats = get_query_stats()
+        if stats is not None:
+            registry.inc("newsmeme_db_duration_seconds_total",
+                         labels,
+                         stats.duration)
+            registry.inc("newsmeme_db_queries_total",
+                         labels,
+                         stats.count)
+
+        registry.flush()
+
+        return response
+
+
+def _flush_at_exit():
+    for registry in list(_registries):
+        try:
+            registry.flush(force=True)
+        except (IOError, OSError):
+            # metrics dir removed
+            pass
+
+
+atexit.register(_flush_at_exit)
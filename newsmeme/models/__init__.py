@@ -12,5 +12,12 @@
 from newsmeme.models.users import User
 from newsmeme.models.posts import Post, Tag, post_tags
 from newsmeme.models.comments import Comment
-
-
+from newsmeme.models.outbox import OutboxMessage
+from newsmeme.models.notifications import Notification
+from newsmeme.models.feeds import Feed
+from newsmeme.models.rankings import PostScore
+from newsmeme.models.timelines import TimelineEntry, TimelineCelebrity
+from newsmeme.models.trending import TagActivity
+from newsmeme.models.related import RelatedPost
+from newsmeme.models.archive import posts_archive, comments_archive, \
+    post_tags_archive
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""
+    archive.py
+    ~~~~~~~~~~
+
+    Archive tables for old posts (manage.py archive). Posts older
+    than ARCHIVE_AFTER_DAYS are moved with their comments, votes and
+    tag links out of the tables used by the listings. Archived posts
+    keep their ids and are still found by permalink, the API and
+    search, as read-only Post and Comment instances built from the
+    archive rows.
+
+    :copyright: (c) 2010 by Dan Jacob.
+    :license: BSD, see LICENSE for more details.
+"""
+from flask import abort
+
+from sqlalchemy.orm import ColumnProperty
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql import visitors
+
+from flaskext.sqlalchemy import Pagination
+
+from newsmeme.extensions import db
+from newsmeme.models.users import User
+from newsmeme.models.posts import Post, post_tags, comment_tree, \
+    JSON_FIELDS
+from newsmeme.models.comments import Comment
+from newsmeme.models.notifications import Notification
+from newsmeme.models.rankings import PostScore
+from newsmeme.models.timelines import TimelineEntry
+from newsmeme.models.related import RelatedPost
+
+ARCHIVE_TABLES = {"posts" : "posts_archive",
+                  "comments" : "comments_archive",
+                  "post_tags" : "post_tags_archive"}
+
+# users loaded per query, within the SQLite limit on parameters
+USERS_PER_QUERY = 500
+
+def _archive_table(table):
+    """
+    Returns archive table with the columns of `table`. Foreign keys
+    to archived tables point at their archive tables.
+    """
+
+    columns = []
+
+    for column in table.columns:
+
+        foreign_keys = []
+        for fk in column.foreign_keys:
+            name, target = fk.target_fullname.split(".")
+            foreign_keys.append(db.ForeignKey(
+                "%s.%s" % (ARCHIVE_TABLES.get(name, name), target),
+                ondelete=fk.ondelete))
+
+        # ids are copied from the live tables
+        columns.append(db.Column(column.name, column.type, *foreign_keys,
+                                 primary_key=column.primary_key,
+                                 nullable=column.nullable,
+                                 autoincrement=False))
+
+    return db.Table(ARCHIVE_TABLES[table.name], db.Model.metadata,
+                    *columns)
+
+
+posts_archive = _archive_table(Post.__table__)
+comments_archive = _archive_table(Comment.__table__)
+post_tags_archive = _archive_table(post_tags)
+
+# posts by author, comment threads
+db.Index("ix_posts_archive_author_id",
+         posts_archive.c.author_id, posts_archive.c.id)
+
+db.Index("ix_comments_archive_post_id",
+         comments_archive.c.post_id, comments_archive.c.id)
+
+
+def archive_posts(before, batch_size=500):
+    """
+    Moves posts created before `before` with their comments and tag
+    links to the archive tables, committing every `batch_size` posts.
+    Returns number of posts archived.
+    """
+
+    posts = Post.__table__
+    comments = Comment.__table__
+    notifications = Notification.__table__
+    scores = PostScore.__table__
+    entries = TimelineEntry.__table__
+    related = RelatedPost.__table__
+
+    # ids stay unique across live and archive tables, as the live
+    # tables never reuse ids (sqlite_autoincrement)
+
+    num_posts = 0
+
+    while True:
+        post_ids = [post_id for post_id, in db.session.execute(
+            db.select([posts.c.id]).\
+            where(posts.c.date_created < before).\
+            order_by(posts.c.id.asc()).\
+            limit(batch_size))]
+
+        if not post_ids:
+            break
+
+        comment_ids = db.select([comments.c.id]).\
+            where(comments.c.post_id.in_(post_ids))
+
+        # replies are inserted after their parents
+        for table, column, order in ((posts, posts.c.id, posts.c.id),
+                                     (post_tags, post_tags.c.post_id,
+                                      post_tags.c.post_id),
+                                     (comments, comments.c.post_id,
+                                      comments.c.id)):
+
+            rows = db.session.execute(
+                table.select().where(column.in_(post_ids)).\
+                order_by(order)).fetchall()
+
+            if rows:
+                db.session.execute(
+                    db.Model.metadata.tables[ARCHIVE_TABLES[table.name]].\
+                    insert(), [dict(row) for row in rows])
+
+        # pending digests would point at missing comments
+        db.session.execute(notifications.delete().\
+                           where(notifications.c.comment_id.in_(comment_ids)))
+
+        # archived posts are not ranked, in timelines or related
+        db.session.execute(scores.delete().\
+                           where(scores.c.post_id.in_(post_ids)))
+
+        db.session.execute(entries.delete().\
+                           where(entries.c.post_id.in_(post_ids)))
+
+        db.session.execute(related.delete().\
+                           where(db.or_(related.c.post_id.in_(post_ids),
+                                        related.c.related_id.in_(post_ids))))
+
+        db.session.execute(comments.delete().\
+                           where(comments.c.post_id.in_(post_ids)))
+
+        db.session.execute(post_tags.delete().\
+                           where(post_tags.c.post_id.in_(post_ids)))
+
+        db.session.execute(posts.delete().where(posts.c.id.in_(post_ids)))
+
+        db.session.commit()
+
+        num_posts += len(post_ids)
+
+    return num_posts
+
+
+def _instance(model, row):
+    """
+    Returns model instance with columns set from an archive row.
+    The instance is not added to the session.
+    """
+
+    obj = model.__mapper__.class_manager.new_instance()
+
+    for prop in model.__mapper__.iterate_properties:
+        if isinstance(prop, ColumnProperty):
+            column = prop.columns[0]
+            if getattr(column, "table", None) is model.__table__:
+                set_committed_value(obj, prop.key, row[column.name])
+
+    obj.archived = True
+    return obj
+
+
+def _get_users(user_ids):
+    user_ids = list(set(user_ids))
+    users = {}
+
+    for i in xrange(0, len(user_ids), USERS_PER_QUERY):
+        for user in User.query.filter(
+            User.id.in_(user_ids[i:i + USERS_PER_QUERY])):
+            users[user.id] = user
+
+    return users
+
+
+def get_posts(post_ids):
+    """
+    Returns dict of post_id: archived post, with authors loaded.
+    Posts whose author has been deleted are left out.
+    """
+
+    if not post_ids:
+        return {}
+
+    rows = db.session.execute(posts_archive.select().\
+                              where(posts_archive.c.id.in_(post_ids))).\
+                              fetchall()
+
+    authors = _get_users([row['author_id'] for row in rows])
+
+    posts = {}
+
+    for row in rows:
+        if row['author_id'] in authors:
+            post = _instance(Post, row)
+            set_committed_value(post, "author", authors[row['author_id']])
+            posts[post.id] = post
+
+    return posts
+
+
+def get_post(post_id):
+    """
+    Returns archived post with its comment tree, or None.
+    """
+
+    post = get_posts([post_id]).get(post_id)
+    if post is None:
+        return None
+
+    rows = db.session.execute(comments_archive.select().\
+                              where(comments_archive.c.post_id==post_id).\
+                              order_by(comments_archive.c.id.asc())).\
+                              fetchall()
+
+    authors = _get_users([row['author_id'] for row in rows])
+
+    comments = []
+
+    for row in rows:
+        if row['author_id'] in authors:
+            comment = _instance(Comment, row)
+            set_committed_value(comment, "author",
+                                authors[row['author_id']])
+            set_committed_value(comment, "post", post)
+            comments.append(comment)
+
+    by_id = dict((comment.id, comment) for comment in comments)
+
+    for comment in comments:
+        set_committed_value(comment, "parent", by_id.get(comment.parent_id))
+
+    post.comments = comment_tree(comments)
+
+    return post
+
+
+def as_json(post_ids):
+    """
+    Returns dicts of the same attributes as Post.json for archived
+    public posts.
+    """
+
+    users = User.__table__
+
+    author = db.select([users.c.username]).\
+        where(users.c.id==posts_archive.c.author_id).as_scalar()
+
+    q = db.select([posts_archive.c.id,
+                   posts_archive.c.score,
+                   posts_archive.c.title,
+                   posts_archive.c.link,
+                   posts_archive.c.description,
+                   posts_archive.c.num_comments,
+                   author]).\
+        where(db.and_(posts_archive.c.id.in_(post_ids),
+                      posts_archive.c.access==Post.PUBLIC))
+
+    for row in db.session.execute(q):
+        if row[-1] is not None:
+            yield dict(zip(JSON_FIELDS, row))
+
+
+def _search_ids(query):
+    """
+    Returns union of ids of posts matching the criteria of `query`,
+    a PostQuery, and of archived posts matching the same criteria.
+    """
+
+    posts = Post.__table__
+    users = User.__table__
+
+    criteria = query.whereclause
+
+    def replace(column):
+        if isinstance(column, db.Column) and column.table is posts:
+            return posts_archive.c[column.name]
+
+    archived_criteria = visitors.replacement_traverse(criteria, {},
+                                                      replace)
+
+    live = db.select([posts.c.id], criteria,
+                     from_obj=[posts.join(users,
+                                          posts.c.author_id==users.c.id)])
+
+    archived = db.select([posts_archive.c.id], archived_criteria,
+                         from_obj=[posts_archive.join(
+                             users, posts_archive.c.author_id==users.c.id)])
+
+    return db.union_all(live, archived).alias()
+
+
+def _newest(ids, limit, offset=0):
+    return [post_id for post_id, in db.session.execute(
+            db.select([ids.c.id]).order_by(ids.c.id.desc()).\
+            limit(limit).offset(offset))]
+
+
+def search(query, limit):
+    """
+    Returns ids of posts and archived posts matching the criteria
+    of `query`, newest first.
+    """
+
+    return _newest(_search_ids(query), limit)
+
+
+def paginate(query, page, per_page):
+    """
+    Returns Pagination of posts and archived posts matching the
+    criteria of `query`, newest first. Aborts with 404 if the page
+    is out of range.
+    """
+
+    if page < 1:
+        abort(404)
+
+    ids = _search_ids(query)
+
+    total = db.session.execute(
+        db.select([db.func.count()]).select_from(ids)).scalar()
+
+    post_ids = _newest(ids, per_page, (page - 1) * per_page)
+
+    if not post_ids and page != 1:
+        abort(404)
+
+    posts = dict((post.id, post) for post in \
+                 Post.query.filter(Post.id.in_(post_ids)).as_list())
+
+    missing = [post_id for post_id in post_ids if post_id not in posts]
+    posts.update(get_posts(missing))
+
+    items = [posts[post_id] for post_id in post_ids if post_id in posts]
+
+    return Pagination(None, page, per_page, total, items)
+
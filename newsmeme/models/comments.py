@@ -6,9 +6,8 @@ from flask import Markup
 from flaskext.sqlalchemy import BaseQuery
 from flaskext.principal import Permission, UserNeed, Denial
 
-from newsmeme import signals
 from newsmeme.extensions import db
-from newsmeme.permissions import auth, moderator
+from newsmeme.permissions import auth, moderator, null
 from newsmeme.helpers import markdown
 from newsmeme.models.posts import Post
 from newsmeme.models.users import User
@@ -16,6 +15,29 @@ from newsmeme.models.types import DenormalizedText
 
 class CommentQuery(BaseQuery):
 
+    def as_list(self):
+        """
+        Return restricted list of columns for comment threads and lists
+        """
+
+        deferred_cols = ("post.description",
+                         "post.tags",
+                         "post.votes",
+                         "author._email",
+                         "author.email_lower",
+                         "author.username_lower",
+                         "author._password",
+                         "author.activation_key",
+                         "author._openid",
+                         "author.date_joined",
+                         "author.receive_email",
+                         "author.email_alerts",
+                         "author.followers",
+                         "author.following")
+
+        options = [db.defer(col) for col in deferred_cols]
+        return self.options(*options)
+
     def restricted(self, user):
 
         if user and user.is_moderator:
@@ -26,7 +48,7 @@ class CommentQuery(BaseQuery):
 
         if user:
             criteria.append(Post.author_id==user.id)
-            if user.friends:
+            if user.num_friends:
                 criteria.append(db.and_(Post.access==Post.FRIENDS,
                                         Post.author_id.in_(user.friends)))
         
@@ -37,10 +59,16 @@ class Comment(db.Model):
 
     __tablename__ = "comments"
 
+    # ids of deleted and archived comments are never reused
+    __table_args__ = {"sqlite_autoincrement" : True}
+
     PER_PAGE = 20
 
     query_class = CommentQuery
 
+    # set on read-only comments built by newsmeme.models.archive
+    archived = False
+
     id = db.Column(db.Integer, primary_key=True)
     
     author_id = db.Column(db.Integer, 
@@ -78,15 +106,22 @@ class Comment(db.Model):
 
         @cached_property
         def edit(self):
+            if self.obj.archived:
+                return null
             return self.default
 
         @cached_property
         def delete(self):
+            if self.obj.archived:
+                return null
             return self.default
 
         @cached_property
         def vote(self):
 
+            if self.obj.archived:
+                return null
+
             needs = [UserNeed(user_id) for user_id in self.obj.votes]
             needs.append(UserNeed(self.obj.author_id))
 
@@ -119,15 +154,17 @@ class Comment(db.Model):
     def markdown(self):
         return Markup(markdown(self.comment or ''))
 
-# ------------- SIGNALS ----------------#
-
-def update_num_comments(sender):
-    sender.num_comments = \
-        Comment.query.filter(Comment.post_id==sender.id).count()
-    
-    db.session.commit()
-
+def update_num_comments(post):
+    """
+    Counts the comments of a post, including those added or deleted
+    in the session. Committed by the caller with the comment, so a
+    view retried on a busy database commits once.
+    """
+    post.num_comments = \
+        Comment.query.filter(Comment.post_id==post.id).count()
 
-signals.comment_added.connect(update_num_comments)
-signals.comment_deleted.connect(update_num_comments)
 
+# comment threads, comments by author and replies
+db.Index("ix_comments_post_id", Comment.post_id, Comment.id)
+db.Index("ix_comments_author_id", Comment.author_id, Comment.id)
+db.Index("ix_comments_parent_id", Comment.parent_id)
@@ -0,0 +1,22 @@
+from datetime import datetime
+
+from newsmeme.extensions import db
+
+class Feed(db.Model):
+    """
+    Feed source imported by manage.py importfeed. The ETag and 
+    Last-Modified values of the last fetch are kept for conditional
+    requests.
+    """
+
+    __tablename__ = "feeds"
+
+    id = db.Column(db.Integer, primary_key=True)
+    url = db.Column(db.String(250), unique=True, nullable=False)
+    etag = db.Column(db.String(250))
+    modified = db.Column(db.String(50))
+    last_fetched = db.Column(db.DateTime)
+    last_imported = db.Column(db.DateTime)
+
+    def __str__(self):
+        return self.url
@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta
+
+from flaskext.sqlalchemy import BaseQuery
+
+from newsmeme.extensions import db
+from newsmeme.models.users import User
+from newsmeme.models.comments import Comment
+
+class NotificationQuery(BaseQuery):
+
+    def due(self, window, now=None):
+        """
+        Returns ids of users whose oldest pending notification is
+        at least `window` seconds old, so each user gets at most
+        one digest per window.
+        """
+
+        if now is None:
+            now = datetime.utcnow()
+
+        return db.session.query(Notification.user_id).\
+                    group_by(Notification.user_id).\
+                    having(db.func.min(Notification.date_created) <= \
+                           now - timedelta(seconds=window)).\
+                    order_by(Notification.user_id.asc())
+
+    def for_users(self, user_ids):
+        return self.filter(Notification.user_id.in_(user_ids)).\
+                    options(db.joinedload("actor"),
+                            db.joinedload("comment")).\
+                    order_by(Notification.id.asc())
+
+
+class Notification(db.Model):
+    """
+    Event waiting to be sent to a user in an email digest.
+    """
+
+    __tablename__ = "notifications"
+
+    query_class = NotificationQuery
+
+    COMMENTED = 100
+    REPLIED = 200
+    FOLLOWED = 300
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    user_id = db.Column(db.Integer,
+                        db.ForeignKey(User.id, ondelete='CASCADE'),
+                        nullable=False)
+
+    actor_id = db.Column(db.Integer,
+                         db.ForeignKey(User.id, ondelete='CASCADE'),
+                         nullable=False)
+
+    comment_id = db.Column(db.Integer,
+                           db.ForeignKey(Comment.id, ondelete='CASCADE'))
+
+    kind = db.Column(db.Integer, nullable=False)
+    date_created = db.Column(db.DateTime, default=datetime.utcnow)
+
+    user = db.relation(User, primaryjoin=user_id==User.id)
+
+    actor = db.relation(User, primaryjoin=actor_id==User.id)
+
+    comment = db.relation(Comment)
+
+
+db.Index("ix_notifications_user_date",
+         Notification.user_id,
+         Notification.date_created)
@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta
+
+from flaskext.sqlalchemy import BaseQuery
+from flaskext.mail import Message
+
+from newsmeme.extensions import db
+from newsmeme.models.types import DenormalizedText
+
+class OutboxQuery(BaseQuery):
+
+    def pending(self, now=None):
+        """
+        Returns unsent messages due for a (re)try, oldest first
+        """
+
+        if now is None:
+            now = datetime.utcnow()
+
+        return self.filter(db.and_(OutboxMessage.date_sent==None,
+                                   OutboxMessage.next_attempt <= now,
+                                   OutboxMessage.attempts < \
+                                        OutboxMessage.MAX_ATTEMPTS)).\
+                    order_by(OutboxMessage.id.asc())
+
+
+class OutboxMessage(db.Model):
+    """
+    Email waiting to be sent by the mail worker.
+    """
+
+    __tablename__ = "outbox"
+
+    query_class = OutboxQuery
+
+    MAX_ATTEMPTS = 8
+
+    # seconds before first retry, doubled with each attempt
+    RETRY_DELAY = 60
+
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.Unicode(250))
+    body = db.Column(db.UnicodeText)
+    sender = db.Column(db.Unicode(250))
+    recipients = db.Column(DenormalizedText(coerce=unicode))
+    date_created = db.Column(db.DateTime, default=datetime.utcnow)
+    next_attempt = db.Column(db.DateTime, default=datetime.utcnow)
+    date_sent = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer, default=0)
+    last_error = db.Column(db.UnicodeText)
+
+    @classmethod
+    def from_message(cls, message):
+        return cls(subject=message.subject,
+                   body=message.body,
+                   sender=message.sender,
+                   recipients=set(message.recipients))
+
+    def to_message(self):
+        return Message(subject=self.subject,
+                       body=self.body,
+                       sender=self.sender,
+                       recipients=list(self.recipients))
+
+    def sent(self):
+        self.date_sent = datetime.utcnow()
+        self.last_error = None
+
+    def failed(self, error):
+        """
+        Records failed attempt and schedules retry with 
+        exponential backoff.
+        """
+        self.attempts = (self.attempts or 0) + 1
+        self.last_error = unicode(error)
+        self.next_attempt = datetime.utcnow() + \
+            timedelta(seconds=self.RETRY_DELAY * 2 ** (self.attempts - 1))
+
+
+db.Index("ix_outbox_pending", 
+         OutboxMessage.date_sent, 
+         OutboxMessage.next_attempt)
@@ -4,21 +4,45 @@ from datetime import datetime
 
 from werkzeug import cached_property
 
+from sqlalchemy import event, DDL
+
 from flask import url_for, Markup
 from flaskext.sqlalchemy import BaseQuery
 from flaskext.principal import Permission, UserNeed, Denial
 
 from newsmeme.extensions import db
-from newsmeme.helpers import slugify, domain, markdown
-from newsmeme.permissions import auth, moderator
+from newsmeme.helpers import slugify, domain, link_hash, markdown
+from newsmeme.permissions import auth, moderator, null
 from newsmeme.models.types import DenormalizedText
 from newsmeme.models.users import User
 
 class PostQuery(BaseQuery):
 
     def jsonify(self):
-        for post in self.all():
-            yield post.json
+        return self.as_json()
+
+    def as_json(self):
+        """
+        Returns dicts of the same attributes as Post.json, built 
+        straight from column tuples rather than Post instances.
+        """
+
+        # aliased so it is still correlated if the query joins users
+        users = User.__table__.alias()
+
+        author = db.select([users.c.username]).\
+            where(users.c.id==Post.author_id).as_scalar()
+
+        q = self.with_entities(Post.id,
+                               Post.score,
+                               Post.title,
+                               Post.link,
+                               Post.description,
+                               Post.num_comments,
+                               author)
+
+        for row in q:
+            yield dict(zip(JSON_FIELDS, row))
 
     def as_list(self):
         """
@@ -27,10 +51,12 @@ class PostQuery(BaseQuery):
 
         deferred_cols = ("description", 
                          "tags",
-                         "author.email",
-                         "author.password",
+                         "author._email",
+                         "author.email_lower",
+                         "author.username_lower",
+                         "author._password",
                          "author.activation_key",
-                         "author.openid",
+                         "author._openid",
                          "author.date_joined",
                          "author.receive_email",
                          "author.email_alerts",
@@ -41,11 +67,14 @@ class PostQuery(BaseQuery):
         options = [db.defer(col) for col in deferred_cols]
         return self.options(*options)
         
+    # score is compared to a literal rather than a bound parameter,
+    # so SQLite can use the partial indexes on popular posts
+
     def deadpooled(self):
-        return self.filter(Post.score <= 0)
+        return self.filter(Post.score <= db.literal_column("0"))
 
     def popular(self):
-        return self.filter(Post.score > 0)
+        return self.filter(Post.score > db.literal_column("0"))
     
     def hottest(self):
         return self.order_by(Post.num_comments.desc(),
@@ -68,7 +97,8 @@ class PostQuery(BaseQuery):
 
         if user:
             criteria.append(Post.author_id==user.id)
-            if user.friends:
+            # num_friends is cached for the current user
+            if user.num_friends:
                 criteria.append(db.and_(Post.access==Post.FRIENDS,
                                         Post.author_id.in_(user.friends)))
         
@@ -97,6 +127,9 @@ class PostQuery(BaseQuery):
 class Post(db.Model):
 
     __tablename__ = "posts"
+
+    # ids of deleted and archived posts are never reused
+    __table_args__ = {"sqlite_autoincrement" : True}
     
     PUBLIC = 100
     FRIENDS = 200
@@ -106,21 +139,30 @@ class Post(db.Model):
 
     query_class = PostQuery
 
+    # set on read-only posts built by newsmeme.models.archive
+    archived = False
+
     id = db.Column(db.Integer, primary_key=True)
 
     author_id = db.Column(db.Integer, 
                           db.ForeignKey(User.id, ondelete='CASCADE'), 
                           nullable=False)
     
-    title = db.Column(db.Unicode(200))
     description = db.Column(db.UnicodeText)
-    link = db.Column(db.String(250))
     date_created = db.Column(db.DateTime, default=datetime.utcnow)
     score = db.Column(db.Integer, default=1)
     num_comments = db.Column(db.Integer, default=0)
     votes = db.Column(DenormalizedText)
     access = db.Column(db.Integer, default=PUBLIC)
 
+    # slug, domain and link hash are derived from title and link 
+    # on write
+    slug = db.Column(db.Unicode(80))
+    domain = db.Column(db.String(250))
+    link_hash = db.Column(db.String(32))
+
+    _title = db.Column("title", db.Unicode(200))
+    _link = db.Column("link", db.String(250))
     _tags = db.Column("tags", db.UnicodeText)
 
     author = db.relation(User, innerjoin=True, lazy="joined")
@@ -151,15 +193,22 @@ class Post(db.Model):
 
         @cached_property
         def edit(self):
+            if self.obj.archived:
+                return null
             return self.default
 
         @cached_property
         def delete(self):
+            if self.obj.archived:
+                return null
             return self.default
 
         @cached_property
         def vote(self):
 
+            if self.obj.archived:
+                return null
+
             needs = [UserNeed(user_id) for user_id in self.obj.votes]
             needs.append(UserNeed(self.obj.author_id))
 
@@ -167,6 +216,8 @@ class Post(db.Model):
 
         @cached_property
         def comment(self):
+            if self.obj.archived:
+                return null
             return auth
 
     def __init__(self, *args, **kwargs):
@@ -187,6 +238,25 @@ class Post(db.Model):
     def vote(self, user):
         self.votes.add(user.id)
 
+    def _get_title(self):
+        return self._title
+
+    def _set_title(self, title):
+        self._title = title
+        self.slug = slugify(title or '')[:80]
+
+    title = db.synonym("_title", descriptor=property(_get_title, _set_title))
+
+    def _get_link(self):
+        return self._link
+
+    def _set_link(self, link):
+        self._link = link
+        self.domain = domain(link) if link else ''
+        self.link_hash = link_hash(link) if link else None
+
+    link = db.synonym("_link", descriptor=property(_get_link, _set_link))
+
     def _get_tags(self):
         return self._tags 
 
@@ -231,12 +301,6 @@ class Post(db.Model):
                               slug=slugify(tag))) \
                 for tag in self.taglist]
 
-    @cached_property
-    def domain(self):
-        if not self.link:
-            return ''
-        return domain(self.link)
-
     @cached_property
     def json(self):
         """
@@ -280,25 +344,8 @@ class Post(db.Model):
         """
         from newsmeme.models.comments import Comment
 
-        comments = Comment.query.filter(Comment.post_id==self.id).all()
-
-        def _get_comments(parent, depth):
-            
-            parent.comments = []
-            parent.depth = depth
-
-            for comment in comments:
-                if comment.parent_id == parent.id:
-                    parent.comments.append(comment)
-                    _get_comments(comment, depth + 1)
-
-
-        parents = [c for c in comments if c.parent_id is None]
-
-        for parent in parents:
-            _get_comments(parent, 0)
-
-        return parents
+        return comment_tree(Comment.query.filter(Comment.post_id==self.id).\
+                            as_list().all())
         
     def _url(self, _external=False):
         return url_for('post.view', 
@@ -318,9 +365,70 @@ class Post(db.Model):
     def markdown(self):
         return Markup(markdown(self.description or ''))
 
-    @cached_property
-    def slug(self):
-        return slugify(self.title or '')[:80]
+
+def comment_tree(comments):
+    """
+    Returns top level comments. Each comment has a "comments" 
+    attribute appended and a "depth" attribute.
+    """
+
+    def _get_comments(parent, depth):
+        
+        parent.comments = []
+        parent.depth = depth
+
+        for comment in comments:
+            if comment.parent_id == parent.id:
+                parent.comments.append(comment)
+                _get_comments(comment, depth + 1)
+
+
+    parents = [c for c in comments if c.parent_id is None]
+
+    for parent in parents:
+        _get_comments(parent, 0)
+
+    return parents
+
+
+# duplicate link lookups
+db.Index("ix_posts_link_hash", Post.link_hash)
+
+# posts by author, newest first
+db.Index("ix_posts_author_id", Post.author_id, Post.id)
+
+# top posts of all time
+db.Index("ix_posts_top", Post.access, Post.score, Post.id)
+
+# partial indexes for PostQuery.popular() and deadpooled() with 
+# public() or restricted(), newest first or hottest(). Created with
+# the table, and by manage.py backfill on existing databases.
+
+Post.__table__.info['partial_indexes'] = [
+    ("ix_posts_popular", 
+     "CREATE INDEX ix_posts_popular ON posts (access, id) "
+     "WHERE score > 0"),
+    ("ix_posts_hottest",
+     "CREATE INDEX ix_posts_hottest ON posts "
+     "(access, num_comments, score, id) WHERE score > 0"),
+    ("ix_posts_deadpooled",
+     "CREATE INDEX ix_posts_deadpooled ON posts (access, id) "
+     "WHERE score <= 0"),
+]
+
+for name, statement in Post.__table__.info['partial_indexes']:
+    event.listen(Post.__table__, "after_create", 
+                 DDL(statement).execute_if(dialect=("sqlite", 
+                                                    "postgresql")))
+
+
+JSON_FIELDS = ("post_id",
+               "score",
+               "title",
+               "link",
+               "description",
+               "num_comments",
+               "author")
 
 
 post_tags = db.Table("post_tags", db.Model.metadata,
@@ -332,6 +440,9 @@ post_tags = db.Table("post_tags", db.Model.metadata,
               db.ForeignKey('tags.id', ondelete='CASCADE'),
               primary_key=True))
 
+# tag pages and tag post counts
+db.Index("ix_post_tags_tag_id", post_tags.c.tag_id, post_tags.c.post_id)
+
 
 class TagQuery(BaseQuery):
 
@@ -392,5 +503,3 @@ class Tag(db.Model):
             where(db.and_(post_tags.c.tag_id==id,
                           Post.id==post_tags.c.post_id,
                           Post.access==Post.PUBLIC)).as_scalar())
-
-
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+    rankings.py
+    ~~~~~~~~~~~
+
+    Top posts per time window. Each post vote is added to the post's
+    score for the hour, so the score of a post in a window is the sum
+    of its hourly scores. Rankings are cached as sorted lists of post
+    ids, recomputed every TOP_POSTS_TIMEOUT seconds (or by
+    manage.py rankings), and pages are read from the cached lists.
+
+    :copyright: (c) 2010 by Dan Jacob.
+    :license: BSD, see LICENSE for more details.
+"""
+import calendar
+
+from datetime import datetime
+
+from flask import abort, current_app
+
+from flaskext.sqlalchemy import Pagination
+
+from newsmeme.extensions import db, cache
+from newsmeme.models.posts import Post
+
+# window name and length in hours; "all" ranks posts by their score
+WINDOWS = (("day", 24),
+           ("week", 24 * 7),
+           ("month", 24 * 30),
+           ("all", None))
+
+def to_hour(dt):
+    """
+    Returns hours since the epoch of a UTC datetime.
+    """
+    return calendar.timegm(dt.utctimetuple()) // 3600
+
+
+def rankings_key(window):
+    return "top-posts-%s" % window
+
+
+class PostScore(db.Model):
+    """
+    Sum of votes on a post within an hour.
+    """
+
+    __tablename__ = "post_scores"
+
+    post_id = db.Column(db.Integer,
+                        db.ForeignKey(Post.id, ondelete='CASCADE'),
+                        primary_key=True)
+
+    hour = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    score = db.Column(db.Integer, nullable=False, default=0)
+
+
+# scores within a window
+db.Index("ix_post_scores_hour", PostScore.hour, PostScore.post_id)
+
+
+def record_vote(post_id, score, now=None):
+    """
+    Adds a vote to the post's score for the current hour. Committed
+    with the vote.
+    """
+
+    table = PostScore.__table__
+    hour = to_hour(now or datetime.utcnow())
+
+    result = db.session.execute(
+        table.update().\
+        where(db.and_(table.c.post_id==post_id, table.c.hour==hour)).\
+        values(score=table.c.score + score))
+
+    if not result.rowcount:
+        db.session.execute(table.insert().values(post_id=post_id,
+                                                 hour=hour,
+                                                 score=score))
+
+
+def compute_rankings(window, limit, now=None):
+    """
+    Returns ids of the `limit` public posts with the highest score in
+    the window, best first. Posts must have a positive score.
+    """
+
+    posts = Post.__table__
+    hours = dict(WINDOWS)[window]
+
+    if hours is None:
+        q = db.select([posts.c.id]).\
+            where(db.and_(posts.c.access==Post.PUBLIC,
+                          posts.c.score > db.literal_column("0"))).\
+            order_by(posts.c.score.desc(), posts.c.id.desc())
+
+    else:
+        scores = PostScore.__table__
+        since = to_hour(now or datetime.utcnow()) - hours + 1
+
+        total = db.func.sum(scores.c.score)
+
+        q = db.select([scores.c.post_id],
+                      from_obj=[scores.join(posts,
+                                            posts.c.id==scores.c.post_id)]).\
+            where(db.and_(scores.c.hour >= since,
+                          posts.c.access==Post.PUBLIC)).\
+            group_by(scores.c.post_id).\
+            having(total > 0).\
+            order_by(total.desc(), scores.c.post_id.desc())
+
+    return [post_id for post_id, in db.session.execute(q.limit(limit))]
+
+
+def refresh_rankings(window):
+    """
+    Recomputes and caches the rankings of a window. Returns list of
+    post ids.
+    """
+
+    config = current_app.config
+
+    post_ids = compute_rankings(window, config['TOP_POSTS_SIZE'])
+    cache.set(rankings_key(window), post_ids,
+              timeout=config['TOP_POSTS_TIMEOUT'])
+
+    return post_ids
+
+
+def get_rankings(window):
+    """
+    Returns cached rankings of a window, computing them if not
+    cached. Aborts with 404 if the window is unknown.
+    """
+
+    if window not in dict(WINDOWS):
+        abort(404)
+
+    post_ids = cache.get(rankings_key(window))
+    if post_ids is None:
+        post_ids = refresh_rankings(window)
+
+    return post_ids
+
+
+def paginate_rankings(window, page, per_page):
+    """
+    Returns Pagination of the top posts of a window. Aborts with 404
+    if the window is unknown or the page out of range.
+    """
+
+    post_ids = get_rankings(window)
+
+    if page < 1:
+        abort(404)
+
+    page_ids = post_ids[(page - 1) * per_page:page * per_page]
+
+    if not page_ids and page != 1:
+        abort(404)
+
+    # posts deleted since the rankings were computed are left out
+    posts = dict((post.id, post) for post in \
+                 Post.query.filter(Post.id.in_(page_ids)).as_list())
+
+    items = [posts[post_id] for post_id in page_ids if post_id in posts]
+
+    return Pagination(None, page, per_page, len(post_ids), items)
+
+
+def prune_scores(now=None):
+    """
+    Deletes hourly scores older than the longest window. Returns
+    number of rows deleted.
+    """
+
+    table = PostScore.__table__
+
+    hours = max(hours for window, hours in WINDOWS if hours)
+    since = to_hour(now or datetime.utcnow()) - hours + 1
+
+    result = db.session.execute(table.delete().where(table.c.hour < since))
+    db.session.commit()
+
+    return result.rowcount
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+    related.py
+    ~~~~~~~~~~
+
+    Related posts, from shared tags and shared voters. Each post's
+    tags and voters are sparse vectors weighted by inverse document
+    frequency; the similarity of two posts is a weighted sum of the
+    cosines of their tag and voter vectors. manage.py related stores
+    the RELATED_POSTS most similar posts of each post, so a post page
+    reads its related posts in one indexed query.
+
+    :copyright: (c) 2010 by Dan Jacob.
+    :license: BSD, see LICENSE for more details.
+"""
+import math
+import heapq
+
+from newsmeme.extensions import db
+from newsmeme.models.posts import Post, post_tags
+
+# weight of tag and voter similarity in the score
+TAG_WEIGHT = 0.6
+VOTER_WEIGHT = 0.4
+
+class RelatedPost(db.Model):
+    """
+    Post similar to another post, with similarity score.
+    """
+
+    __tablename__ = "related_posts"
+
+    post_id = db.Column(db.Integer,
+                        db.ForeignKey(Post.id, ondelete='CASCADE'),
+                        primary_key=True)
+
+    related_id = db.Column(db.Integer,
+                           db.ForeignKey(Post.id, ondelete='CASCADE'),
+                           primary_key=True)
+
+    score = db.Column(db.Float, nullable=False)
+
+
+# rows pointing at archived and deleted posts
+db.Index("ix_related_posts_related_id", RelatedPost.related_id)
+
+
+class _Space(object):
+    """
+    Sparse binary vectors of features (tags or voters) per post,
+    weighted by inverse document frequency. Features of more than
+    `max_postings` posts are ignored by similar(): they say little
+    about a pair of posts, and cost the square of their posts.
+    """
+
+    def __init__(self, vectors, max_postings):
+        self.vectors = vectors
+        self.max_postings = max_postings
+
+        self.postings = {}
+        for post_id, features in vectors.iteritems():
+            for feature in features:
+                self.postings.setdefault(feature, []).append(post_id)
+
+        num_posts = float(len(vectors))
+
+        self.weights = dict((feature, math.log(num_posts / len(posts))) \
+                            for feature, posts in self.postings.iteritems())
+
+        self.norms = dict((post_id, math.sqrt(sum(self.weights[f] ** 2 \
+                                                  for f in features))) \
+                          for post_id, features in vectors.iteritems())
+
+    def similar(self, post_id):
+        """
+        Returns dict of post_id: cosine for posts sharing a feature.
+        """
+
+        dots = {}
+
+        for feature in self.vectors.get(post_id, ()):
+            posts = self.postings[feature]
+            weight = self.weights[feature] ** 2
+
+            if not weight or len(posts) > self.max_postings:
+                continue
+
+            for other in posts:
+                if other != post_id:
+                    dots[other] = dots.get(other, 0) + weight
+
+        norm = self.norms.get(post_id)
+
+        return dict((other, dot / (norm * self.norms[other])) \
+                    for other, dot in dots.iteritems())
+
+
+def compute_related(tags, voters, num_related=10, max_postings=1000):
+    """
+    Yields (post_id, list of (related post_id, score)) of the
+    `num_related` most similar posts of each post. `tags` and
+    `voters` are dicts of post_id: set of tag or user ids.
+    """
+
+    tags = _Space(tags, max_postings)
+    voters = _Space(voters, max_postings)
+
+    for post_id in set(tags.vectors) | set(voters.vectors):
+
+        scores = dict((other, score * TAG_WEIGHT) for other, score in \
+                      tags.similar(post_id).iteritems())
+
+        for other, score in voters.similar(post_id).iteritems():
+            scores[other] = scores.get(other, 0) + score * VOTER_WEIGHT
+
+        # ties go to the newest posts
+        yield post_id, heapq.nlargest(num_related, scores.iteritems(),
+                                      key=lambda item: (item[1], item[0]))
+
+
+def rebuild_related(num_related=10, max_postings=1000, batch_size=1000):
+    """
+    Recomputes related posts of all posts, replacing the rows of
+    `batch_size` posts per transaction. Returns number of rows
+    written.
+    """
+
+    posts = Post.__table__
+    table = RelatedPost.__table__
+
+    tags = {}
+    for post_id, tag_id in db.session.execute(
+        db.select([post_tags.c.post_id, post_tags.c.tag_id])):
+        tags.setdefault(post_id, set()).add(tag_id)
+
+    voters = {}
+    for post_id, votes in db.session.execute(
+        db.select([posts.c.id, posts.c.votes])):
+        if votes:
+            voters[post_id] = votes
+
+    db.session.execute(table.delete().where(
+        ~table.c.post_id.in_(db.select([posts.c.id]))))
+
+    num_rows = 0
+
+    def write(post_ids, rows):
+        db.session.execute(table.delete().where(
+            table.c.post_id.in_(post_ids)))
+        if rows:
+            db.session.execute(table.insert(), rows)
+        db.session.commit()
+
+    post_ids = []
+    rows = []
+
+    for post_id, related in compute_related(tags, voters,
+                                            num_related, max_postings):
+
+        post_ids.append(post_id)
+        rows.extend(dict(post_id=post_id,
+                         related_id=related_id,
+                         score=score) for related_id, score in related)
+
+        if len(post_ids) >= batch_size:
+            write(post_ids, rows)
+            num_rows += len(rows)
+            post_ids, rows = [], []
+
+    if post_ids:
+        write(post_ids, rows)
+        num_rows += len(rows)
+    else:
+        db.session.commit()
+
+    return num_rows
+
+
+def get_related(post_id, user=None, limit=5):
+    """
+    Returns the related posts of a post that the user can see, most
+    similar first.
+    """
+
+    return Post.query.join((RelatedPost, RelatedPost.related_id==Post.id)).\
+        filter(RelatedPost.post_id==post_id).\
+        restricted(user).\
+        as_list().\
+        order_by(RelatedPost.score.desc()).\
+        limit(limit).all()
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+    timelines.py
+    ~~~~~~~~~~~~
+
+    Timelines of posts by the users each user follows. A new post is
+    copied to the timelines of its author's followers when submitted
+    (fan-out on write), unless the author has more than
+    TIMELINE_FANOUT_LIMIT followers. Posts of these celebrity authors
+    are merged in when a timeline is read (fan-out on read).
+    Timelines keep the newest TIMELINE_SIZE posts.
+
+    :copyright: (c) 2010 by Dan Jacob.
+    :license: BSD, see LICENSE for more details.
+"""
+from flask import abort, current_app
+
+from flaskext.sqlalchemy import Pagination
+
+from newsmeme.extensions import db, cache
+from newsmeme.models.users import User
+from newsmeme.models.posts import Post
+
+CELEBRITIES_KEY = "timeline-celebrities"
+
+class TimelineEntry(db.Model):
+    """
+    Post copied to the timeline of a follower of its author.
+    """
+
+    __tablename__ = "timeline_entries"
+
+    user_id = db.Column(db.Integer,
+                        db.ForeignKey(User.id, ondelete='CASCADE'),
+                        primary_key=True)
+
+    post_id = db.Column(db.Integer,
+                        db.ForeignKey(Post.id, ondelete='CASCADE'),
+                        primary_key=True)
+
+
+# entries for archived and deleted posts
+db.Index("ix_timeline_entries_post_id", TimelineEntry.post_id)
+
+
+class TimelineCelebrity(db.Model):
+    """
+    Author whose posts are merged into timelines on read. Authors
+    stay celebrities, so their posts are never missing from
+    timelines.
+    """
+
+    __tablename__ = "timeline_celebrities"
+
+    user_id = db.Column(db.Integer,
+                        db.ForeignKey(User.id, ondelete='CASCADE'),
+                        primary_key=True)
+
+
+def celebrity_ids():
+    """
+    Returns set of ids of celebrity authors.
+    """
+
+    user_ids = cache.get(CELEBRITIES_KEY)
+
+    if user_ids is None:
+        user_ids = [user_id for user_id, in \
+                    db.session.query(TimelineCelebrity.user_id)]
+        cache.set(CELEBRITIES_KEY, user_ids)
+
+    return set(user_ids)
+
+
+def uncache_celebrities():
+    cache.delete(CELEBRITIES_KEY)
+
+
+def fan_out(post):
+    """
+    Copies a new post to the timelines of the followers who can see
+    it, trimming their timelines to TIMELINE_SIZE, or marks its
+    author as a celebrity if they have too many followers. The post
+    must be flushed, and is committed with the entries. Returns
+    (number of timelines the post was copied to, True if the author
+    became a celebrity); if so, call uncache_celebrities() after
+    committing.
+    """
+
+    return fan_out_posts(post.author, post.access, [post.id])
+
+
+def fan_out_posts(author, access, post_ids):
+    """
+    Copies new posts of an author, all with the same access, as
+    fan_out() does.
+    """
+
+    config = current_app.config
+
+    if access == Post.PUBLIC:
+        user_ids = author.followers or set()
+    elif access == Post.FRIENDS:
+        user_ids = author.friends
+    else:
+        return 0, False
+
+    if len(author.followers or ()) > config['TIMELINE_FANOUT_LIMIT']:
+
+        if TimelineCelebrity.query.get(author.id) is None:
+            db.session.add(TimelineCelebrity(user_id=author.id))
+            return 0, True
+
+        return 0, False
+
+    if not user_ids or not post_ids:
+        return 0, False
+
+    table = TimelineEntry.__table__
+
+    db.session.execute(table.insert(),
+                       [dict(user_id=user_id, post_id=post_id) \
+                        for user_id in user_ids \
+                        for post_id in post_ids])
+
+    # drops entries older than the TIMELINE_SIZE newest, one
+    # follower at a time so each is an index range
+    entries = table.alias()
+
+    oldest = db.select([entries.c.post_id]).\
+        where(entries.c.user_id==db.bindparam("_user_id")).\
+        order_by(entries.c.post_id.desc()).\
+        limit(1).offset(config['TIMELINE_SIZE'] - 1).as_scalar()
+
+    db.session.execute(table.delete().\
+                       where(db.and_(
+                           table.c.user_id==db.bindparam("_user_id"),
+                           table.c.post_id < oldest)),
+                       [dict(_user_id=user_id) for user_id in user_ids])
+
+    return len(user_ids), False
+
+
+def get_timeline(user, size):
+    """
+    Returns ids of the newest `size` posts in the user's timeline,
+    merging copied posts with posts of followed celebrities.
+    """
+
+    post_ids = set(post_id for post_id, in \
+                   db.session.query(TimelineEntry.post_id).\
+                   filter(TimelineEntry.user_id==user.id).\
+                   order_by(TimelineEntry.post_id.desc()).\
+                   limit(size))
+
+    celebrities = celebrity_ids().intersection(user.following or ())
+
+    if celebrities:
+        post_ids.update(post_id for post_id, in \
+                        Post.query.filter(Post.author_id.in_(celebrities)).\
+                        restricted(user).\
+                        with_entities(Post.id).\
+                        order_by(Post.id.desc()).\
+                        limit(size))
+
+    return sorted(post_ids, reverse=True)[:size]
+
+
+def paginate_timeline(user, page, per_page):
+    """
+    Returns Pagination of posts in the user's timeline, newest first.
+    Aborts with 404 if the page is out of range.
+    """
+
+    if page < 1:
+        abort(404)
+
+    post_ids = get_timeline(user, current_app.config['TIMELINE_SIZE'])
+    page_ids = post_ids[(page - 1) * per_page:page * per_page]
+
+    if not page_ids and page != 1:
+        abort(404)
+
+    # posts are left out if deleted, no longer visible to the user
+    # or by an author the user no longer follows
+    following = user.following or set()
+
+    posts = dict((post.id, post) for post in \
+                 Post.query.filter(Post.id.in_(page_ids)).\
+                 restricted(user).as_list() \
+                 if post.author_id in following)
+
+    items = [posts[post_id] for post_id in page_ids if post_id in posts]
+
+    return Pagination(None, page, per_page, len(post_ids), items)
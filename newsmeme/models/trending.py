@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+    trending.py
+    ~~~~~~~~~~~
+
+    Trending tags. New posts, votes and comments are counted per tag
+    and hour as they are flushed. A tag trends when its activity in
+    the last TRENDING_HOURS is high compared to the TRENDING_PERIODS
+    periods of the same length before, scored as a z-score. The top
+    tags are cached every TRENDING_TIMEOUT seconds (or by manage.py
+    rankings).
+
+    :copyright: (c) 2010 by Dan Jacob.
+    :license: BSD, see LICENSE for more details.
+"""
+import math
+
+from datetime import datetime
+
+from flask import current_app
+
+from sqlalchemy import event
+from sqlalchemy.orm.attributes import get_history
+
+from newsmeme.extensions import db, cache
+from newsmeme.helpers import slugify
+from newsmeme.models.posts import Post, Tag
+from newsmeme.models.comments import Comment
+from newsmeme.models.rankings import to_hour
+
+TRENDING_KEY = "trending-tags"
+
+# weight of each post, vote and comment in a tag's activity
+POST_WEIGHT = 3
+VOTE_WEIGHT = 1
+COMMENT_WEIGHT = 2
+
+class TagActivity(db.Model):
+    """
+    Posts, votes and comments on posts with a tag within an hour.
+    Tags are identified by slug, so new tags are counted before
+    they are inserted.
+    """
+
+    __tablename__ = "tag_activity"
+
+    slug = db.Column(db.Unicode(80), primary_key=True)
+    hour = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+    num_posts = db.Column(db.Integer, nullable=False, default=0)
+    num_votes = db.Column(db.Integer, nullable=False, default=0)
+    num_comments = db.Column(db.Integer, nullable=False, default=0)
+
+
+# activity within a period
+db.Index("ix_tag_activity_hour", TagActivity.hour, TagActivity.slug)
+
+
+def add_activity(connection, taglist, now=None, **counts):
+    """
+    Adds counts e.g. num_votes=1 to the current hour of each tag.
+    """
+
+    table = TagActivity.__table__
+    hour = to_hour(now or datetime.utcnow())
+
+    values = dict((name, table.c[name] + count) for name, count in \
+                  counts.iteritems())
+
+    for slug in set(slugify(tag) for tag in taglist):
+
+        if not slug:
+            continue
+
+        result = connection.execute(
+            table.update().\
+            where(db.and_(table.c.slug==slug, table.c.hour==hour)).\
+            values(**values))
+
+        if not result.rowcount:
+            connection.execute(table.insert().values(slug=slug,
+                                                     hour=hour,
+                                                     **counts))
+
+
+def compute_trending(hours, periods, limit, now=None):
+    """
+    Returns list of (slug, score) of the `limit` tags with the highest
+    z-score of activity in the last `hours` against the `periods`
+    periods before, best first. Only tags with a positive score are
+    returned.
+    """
+
+    table = TagActivity.__table__
+
+    current = to_hour(now or datetime.utcnow()) - hours + 1
+    since = current - hours * periods
+
+    activity = db.func.sum(table.c.num_posts * POST_WEIGHT +
+                           table.c.num_votes * VOTE_WEIGHT +
+                           table.c.num_comments * COMMENT_WEIGHT)
+
+    # period 0 is the current one
+    period = (current + hours - 1 - table.c.hour) / hours
+
+    q = db.select([table.c.slug, period, activity]).\
+        where(table.c.hour >= since).\
+        group_by(table.c.slug, period)
+
+    tags = {}
+
+    for slug, n, count in db.session.execute(q):
+        tags.setdefault(slug, [0] * (periods + 1))[int(n)] = count
+
+    scores = []
+
+    for slug, counts in tags.iteritems():
+        if not counts[0]:
+            continue
+
+        history = counts[1:]
+
+        mean = sum(history) / float(periods)
+        variance = sum((count - mean) ** 2 for count in history) / periods
+
+        # a tag with steady or no history is scored by its growth
+        score = (counts[0] - mean) / max(math.sqrt(variance), 1.0)
+
+        if score > 0:
+            scores.append((slug, score))
+
+    scores.sort(key=lambda item: (-item[1], item[0]))
+
+    return scores[:limit]
+
+
+def refresh_trending():
+    """
+    Recomputes and caches trending tags. Returns list of (slug,
+    score).
+    """
+
+    config = current_app.config
+
+    trending = compute_trending(config['TRENDING_HOURS'],
+                                config['TRENDING_PERIODS'],
+                                config['TRENDING_SIZE'])
+
+    cache.set(TRENDING_KEY, trending, timeout=config['TRENDING_TIMEOUT'])
+
+    return trending
+
+
+def get_trending(limit=None):
+    """
+    Returns list of (tag, score) of cached trending tags, computing
+    them if not cached.
+    """
+
+    trending = cache.get(TRENDING_KEY)
+    if trending is None:
+        trending = refresh_trending()
+
+    trending = trending[:limit]
+
+    if not trending:
+        return []
+
+    tags = dict((tag.slug, tag) for tag in \
+                Tag.query.filter(Tag.slug.in_([slug for slug, score in \
+                                               trending])))
+
+    return [(tags[slug], score) for slug, score in trending if slug in tags]
+
+
+def prune_activity(now=None):
+    """
+    Deletes activity older than the periods compared. Returns number
+    of rows deleted.
+    """
+
+    config = current_app.config
+    table = TagActivity.__table__
+
+    hours = config['TRENDING_HOURS']
+
+    since = to_hour(now or datetime.utcnow()) - \
+        hours * (config['TRENDING_PERIODS'] + 1) + 1
+
+    result = db.session.execute(table.delete().where(table.c.hour < since))
+    db.session.commit()
+
+    return result.rowcount
+
+# ------------- EVENTS ----------------#
+
+def post_inserted(mapper, connection, post):
+    add_activity(connection, post.taglist, num_posts=1)
+
+
+def post_updated(mapper, connection, post):
+    added, unchanged, deleted = get_history(post, "score")
+    if added and deleted and added[0] > deleted[0]:
+        add_activity(connection, post.taglist,
+                     num_votes=added[0] - deleted[0])
+
+
+def comment_inserted(mapper, connection, comment):
+    if comment.post is not None:
+        add_activity(connection, comment.post.taglist, num_comments=1)
+
+
+event.listen(Post, "after_insert", post_inserted)
+event.listen(Post, "after_update", post_updated)
+event.listen(Comment, "after_insert", comment_inserted)
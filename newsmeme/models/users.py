@@ -1,17 +1,27 @@
-import hashlib
-
 from datetime import datetime
 
 from werkzeug import generate_password_hash, check_password_hash, \
     cached_property
 
+from sqlalchemy.orm import ColumnProperty
+from sqlalchemy.orm.attributes import instance_state, set_committed_value
+
 from flaskext.sqlalchemy import BaseQuery
 from flaskext.principal import RoleNeed, UserNeed, Permission
 
-from newsmeme.extensions import db
+from newsmeme import signals
+from newsmeme.extensions import db, cache
+from newsmeme.helpers import gravatar
 from newsmeme.permissions import null
 from newsmeme.models.types import DenormalizedText
 
+# bump when snapshot fields change, so older cached snapshots are ignored
+SNAPSHOT_VERSION = 2
+
+def snapshot_key(user_id):
+    return "user-snapshot:%d" % user_id
+
+
 class UserQuery(BaseQuery):
 
     def from_identity(self, identity):
@@ -25,7 +35,7 @@ class UserQuery(BaseQuery):
         """
 
         try:
-            user = self.get(int(identity.name))
+            user = self.from_snapshot(int(identity.name))
         except ValueError:
             user = None
 
@@ -36,10 +46,75 @@ class UserQuery(BaseQuery):
 
         return user
  
+    def from_snapshot(self, user_id):
+        """
+        Returns user built from the cached snapshot of id, username,
+        role, karma and number of friends, without a query. Other columns
+        are loaded together on first access. If no snapshot is 
+        cached the user is loaded and the snapshot cached.
+
+        If no user found then None is returned.
+        """
+
+        mapper = User.__mapper__
+        key = mapper.identity_key_from_primary_key([user_id])
+
+        if key in db.session.identity_map:
+            return db.session.identity_map[key]
+
+        snapshot = cache.get(snapshot_key(user_id))
+
+        if snapshot is None or snapshot['version'] != SNAPSHOT_VERSION:
+            user = self.get(user_id)
+            if user is not None:
+                cache.set(snapshot_key(user_id), user.snapshot)
+            return user
+
+        # built as if unpickled from a cache, with its identity key,
+        # and merged without being loaded
+        user = mapper.class_manager.new_instance()
+        instance_state(user).key = key
+
+        fields = (("id", "id"),
+                  ("_username", "username"),
+                  ("role", "role"),
+                  ("karma", "karma"))
+
+        for attr, field in fields:
+            set_committed_value(user, attr, snapshot[field])
+
+        user = db.session.merge(user, load=False)
+
+        loaded = [attr for attr, field in fields]
+
+        db.session.expire(user, [prop.key for prop in \
+                                 mapper.iterate_properties \
+                                 if isinstance(prop, ColumnProperty) and \
+                                 prop.key not in loaded])
+
+        user.__dict__['num_friends'] = snapshot['num_friends']
+
+        return user
+
+    def by_username(self, username):
+        """
+        Filters by username, ignoring case
+        """
+        return self.filter(User.username_lower==username.lower())
+
+    def by_email(self, email):
+        """
+        Filters by email address, ignoring case
+        """
+        return self.filter(User.email_lower==email.lower())
+
     def authenticate(self, login, password):
         
-        user = self.filter(db.or_(User.username==login,
-                                  User.email==login)).first()
+        # usernames cannot contain "@"
+        if "@" in login:
+            user = self.by_email(login).first()
+        else:
+            user = self.by_username(login).first()
 
         if user:
             authenticated = user.check_password(password)
@@ -50,7 +125,7 @@ class UserQuery(BaseQuery):
 
     def authenticate_openid(self, email, openid):
 
-        user = self.filter(User.email==email).first()
+        user = self.by_email(email).first()
 
         if user:
             authenticated = user.check_openid(openid)
@@ -72,8 +147,6 @@ class User(db.Model):
     ADMIN = 300
 
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.Unicode(60), unique=True, nullable=False)
-    email = db.Column(db.String(150), unique=True, nullable=False)
     karma = db.Column(db.Integer, default=0)
     date_joined = db.Column(db.DateTime, default=datetime.utcnow)
     activation_key = db.Column(db.String(80), unique=True)
@@ -83,6 +156,17 @@ class User(db.Model):
     followers = db.Column(DenormalizedText)
     following = db.Column(DenormalizedText)
 
+    # lower case username and email are set on write, for case
+    # insensitive lookups
+    username_lower = db.Column(db.Unicode(60))
+    email_lower = db.Column(db.String(150))
+
+    _username = db.Column("username", db.Unicode(60), 
+                          unique=True, 
+                          nullable=False)
+
+    _email = db.Column("email", db.String(150), unique=True, nullable=False)
+    _gravatar = db.Column("gravatar", db.String(32))
     _password = db.Column("password", db.String(80))
     _openid = db.Column("openid", db.String(80), unique=True)
 
@@ -117,6 +201,52 @@ class User(db.Model):
     def permissions(self):
         return self.Permissions(self)
 
+    @cached_property
+    def num_friends(self):
+        return len(self.friends)
+
+    @property
+    def snapshot(self):
+        """
+        Compact dict of attributes needed on most requests, cached
+        by UserQuery.from_snapshot()
+        """
+        return dict(id=self.id,
+                    username=self.username,
+                    role=self.role,
+                    karma=self.karma,
+                    num_friends=self.num_friends,
+                    version=SNAPSHOT_VERSION)
+
+    def uncache_snapshot(self):
+        cache.delete(snapshot_key(self.id))
+
+        # counts cached on this instance
+        for name in ("num_friends", "num_followers", "num_following"):
+            self.__dict__.pop(name, None)
+
+    def _get_username(self):
+        return self._username
+
+    def _set_username(self, username):
+        self._username = username
+        self.username_lower = username.lower() if username else None
+
+    username = db.synonym("_username", 
+                          descriptor=property(_get_username, 
+                                              _set_username))
+
+    def _get_email(self):
+        return self._email
+
+    def _set_email(self, email):
+        self._email = email
+        self.email_lower = email.lower() if email else None
+        self._gravatar = gravatar(email) if email else None
+
+    email = db.synonym("_email", 
+                       descriptor=property(_get_email, _set_email))
+
     def _get_password(self):
         return self._password
 
@@ -188,6 +318,9 @@ class User(db.Model):
         user.followers.add(self.id)
         self.following.add(user.id)
 
+        self.uncache_snapshot()
+        user.uncache_snapshot()
+
     def unfollow(self, user):
         if self.id in user.followers:
             user.followers.remove(self.id)
@@ -195,6 +328,9 @@ class User(db.Model):
         if user.id in self.following:
             self.following.remove(user.id)
 
+        self.uncache_snapshot()
+        user.uncache_snapshot()
+
     def get_following(self):
         """
         Return following users as query
@@ -215,13 +351,13 @@ class User(db.Model):
     def is_admin(self):
         return self.role >= self.ADMIN
 
-    @cached_property
+    @property
     def gravatar(self):
-        if not self.email:
-            return ''
-        md5 = hashlib.md5()
-        md5.update(self.email.strip().lower())
-        return md5.hexdigest()
+        """
+        MD5 hash of the email, stored on write so the deferred
+        email column need not be loaded.
+        """
+        return self._gravatar or ''
 
     def gravatar_url(self, size=80):
         if not self.gravatar:
@@ -231,3 +367,14 @@ class User(db.Model):
             self.gravatar, size)
 
  
+
+
+db.Index("ix_users_username_lower", User.username_lower, unique=True)
+db.Index("ix_users_email_lower", User.email_lower, unique=True)
+
+
+def uncache_snapshot(sender):
+    sender.uncache_snapshot()
+
+
+signals.user_updated.connect(uncache_snapshot)
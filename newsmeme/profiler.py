@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+    profiler.py
+    ~~~~~~~~~~~
+
+    Sampling cProfile middleware for production requests.
+
+    :copyright: (c) 2010 by Dan Jacob.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import re
+import glob
+import time
+import random
+import pstats
+import cProfile
+
+from werkzeug.exceptions import HTTPException
+
+_unsafe_re = re.compile(r'[^\w.]+')
+
+def sample_filename(endpoint, duration):
+    """
+    Returns file name for a sample, tagged with endpoint and
+    duration in milliseconds.
+    """
+    return "%d-%s-%dms-%d.pstats" % (time.time() * 1000000,
+                                     _unsafe_re.sub("_", endpoint),
+                                     duration * 1000,
+                                     os.getpid())
+
+
+def list_samples(profile_dir, endpoint=None):
+    """
+    Returns sample files in profile_dir, oldest first, optionally
+    only those for an endpoint.
+    """
+    pattern = "*-%s-*.pstats" % _unsafe_re.sub("_", endpoint) \
+        if endpoint else "*.pstats"
+
+    files = glob.glob(os.path.join(profile_dir, pattern))
+    files.sort(key=lambda path: int(os.path.basename(path).split("-")[0]))
+    return files
+
+
+def aggregate(files, sort="cumulative"):
+    """
+    Returns pstats.Stats combining all sample files.
+    """
+    stats = pstats.Stats(files[0])
+    for path in files[1:]:
+        stats.add(path)
+    return stats.sort_stats(sort)
+
+
+class SamplingProfiler(object):
+    """
+    WSGI middleware profiling a sample of requests with cProfile.
+
+    A request is profiled if it is one of 1 in `sample_rate`
+    requests, or its endpoint matches one of `endpoints` (regular
+    expressions). If `slow_threshold` (seconds) is given, every
+    request is profiled and those slower than the threshold are
+    kept as well as the sampled ones. Note that cProfile makes
+    pure Python code several times slower, so a threshold makes
+    every request pay that overhead.
+
+    Samples are written to `profile_dir`, keeping the newest
+    `max_files`.
+    """
+
+    def __init__(self, app, profile_dir, sample_rate=0, endpoints=None,
+                 slow_threshold=None, max_files=500):
+
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+        self.profile_dir = profile_dir
+        self.sample_rate = sample_rate
+        self.endpoints = [re.compile(pattern) for pattern in endpoints or ()]
+        self.slow_threshold = slow_threshold
+        self.max_files = max_files
+
+        if not os.path.exists(profile_dir):
+            os.makedirs(profile_dir)
+
+    def get_endpoint(self, environ):
+        try:
+            endpoint, args = self.app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return "none"
+        return endpoint
+
+    def is_sampled(self, environ):
+        """
+        Returns True if the request should be kept regardless of
+        duration. The URL is only matched if endpoint patterns
+        are configured.
+        """
+        if self.sample_rate and random.randint(1, self.sample_rate) == 1:
+            return True
+
+        if self.endpoints:
+            endpoint = self.get_endpoint(environ)
+            for pattern in self.endpoints:
+                if pattern.search(endpoint):
+                    return True
+
+        return False
+
+    def __call__(self, environ, start_response):
+
+        sampled = self.is_sampled(environ)
+
+        if not sampled and self.slow_threshold is None:
+            return self.wsgi_app(environ, start_response)
+
+        def run():
+            app_iter = self.wsgi_app(environ, start_response)
+            try:
+                return list(app_iter)
+            finally:
+                if hasattr(app_iter, "close"):
+                    app_iter.close()
+
+        profile = cProfile.Profile()
+        started = time.time()
+
+        try:
+            return profile.runcall(run)
+        finally:
+            duration = time.time() - started
+            if sampled or duration >= self.slow_threshold:
+                self.save(profile, self.get_endpoint(environ), duration)
+
+    def save(self, profile, endpoint, duration):
+
+        profile.dump_stats(os.path.join(self.profile_dir,
+                                        sample_filename(endpoint, duration)))
+
+        for path in list_samples(self.profile_dir)[:-self.max_files]:
+            try:
+                os.remove(path)
+            except OSError:
+                # removed by another worker
+                pass
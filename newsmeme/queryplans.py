@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+    queryplans.py
+    ~~~~~~~~~~~~~
+
+    SQLite query plans for the PostQuery, CommentQuery and TagQuery
+    methods, flagging full table scans (manage.py indexcheck).
+
+    :copyright: (c) 2010 by Dan Jacob.
+    :license: BSD, see LICENSE for more details.
+"""
+from newsmeme.extensions import db
+from newsmeme.models import Post, Comment, Tag, User
+from newsmeme.models.posts import PostQuery, TagQuery
+from newsmeme.models.comments import CommentQuery
+
+def explain(query):
+    """
+    Returns the EXPLAIN QUERY PLAN detail lines of a query. SQLite
+    only.
+    """
+
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    params = [compiled.params[name] for name in compiled.positiontup]
+
+    return [row[-1] for row in db.session.connection().execute(
+                "EXPLAIN QUERY PLAN %s" % compiled, *params)]
+
+
+def is_full_scan(detail):
+    """
+    Returns True if a plan line scans a whole table rather than
+    searching an index. Scans of an index in order are allowed.
+    """
+    return detail.startswith("SCAN") and "INDEX" not in detail and \
+        "SUBQUERY" not in detail and "CONSTANT ROW" not in detail
+
+
+def plan_queries(user):
+    """
+    Returns list of (name, query) with the queries the views build
+    with each query class method, for `user` as the current user.
+    """
+
+    page = Post.PER_PAGE
+
+    return [
+        ("PostQuery.as_list",
+         Post.query.as_list().limit(page)),
+        ("PostQuery.as_json",
+         Post.query.public().limit(page)),
+        ("PostQuery.popular",
+         Post.query.popular().restricted(None).limit(page)),
+        ("PostQuery.hottest",
+         Post.query.popular().hottest().restricted(None).limit(page)),
+        ("PostQuery.deadpooled",
+         Post.query.deadpooled().restricted(None).limit(page)),
+        ("PostQuery.public",
+         Post.query.filter_by(author_id=user.id).public().limit(15)),
+        ("PostQuery.restricted",
+         Post.query.filter_by(author_id=user.id).restricted(user)),
+        ("PostQuery.search",
+         Post.query.search("test").restricted(user).limit(page)),
+        ("CommentQuery.as_list",
+         Comment.query.filter(Comment.post_id==1).as_list()),
+        ("CommentQuery.restricted",
+         Comment.query.filter_by(author_id=user.id).\
+            order_by(Comment.id.desc()).restricted(user).limit(page)),
+        ("TagQuery.cloud",
+         Tag.query.filter(Tag.num_posts > 0)),
+    ]
+
+
+def check_plans(user):
+    """
+    Returns list of (name, plan, full scans) for each query in
+    plan_queries().
+    """
+
+    rv = []
+
+    for name, query in plan_queries(user):
+        plan = explain(query)
+        rv.append((name, plan, [detail for detail in plan \
+                                if is_full_scan(detail)]))
+
+    return rv
+
+
+def unchecked_methods():
+    """
+    Returns names of query class methods missing from plan_queries()
+    """
+
+    checked = set(name for name, query in plan_queries(User(id=0)))
+
+    return sorted("%s.%s" % (cls.__name__, name) \
+                  for cls in (PostQuery, CommentQuery, TagQuery) \
+                  for name, value in cls.__dict__.iteritems() \
+                  if callable(value) and not name.startswith("_") \
+                  and name != "jsonify" \
+                  and "%s.%s" % (cls.__name__, name) not in checked)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+    routing.py
+    ~~~~~~~~~~
+
+    Read/write session routing. Reads in GET and HEAD requests go to
+    a read-only engine (SQLALCHEMY_READ_URI), unless the session has
+    written during the request. Writes, reads in other requests and
+    reads outside requests go to the primary engine.
+
+    :copyright: (c) 2010 by Dan Jacob.
+    :license: BSD, see LICENSE for more details.
+"""
+from functools import partial
+
+from flask import _request_ctx_stack
+
+from sqlalchemy import orm, create_engine
+from sqlalchemy.pool import QueuePool
+
+from flaskext.sqlalchemy import SQLAlchemy, _SignallingSession
+
+READ_METHODS = ("GET", "HEAD")
+
+class RoutingSession(_SignallingSession):
+
+    has_written = False
+
+    def get_bind(self, mapper=None, clause=None):
+
+        ctx = _request_ctx_stack.top
+
+        if ctx is not None and not self.has_written and \
+            ctx.request.method in READ_METHODS:
+
+            engine = getattr(ctx.app, "read_engine", None)
+            if engine is not None:
+                return engine
+
+        return _SignallingSession.get_bind(self, mapper, clause)
+
+    def flush(self, objects=None):
+        # set before flushing, so the flush itself goes to the
+        # primary, and later reads see what was written
+        if self.new or self.dirty or self.deleted:
+            self.has_written = True
+        _SignallingSession.flush(self, objects)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_scoped_session(self, options=None):
+        if options is None:
+            options = {}
+        scopefunc = options.pop('scopefunc', None)
+        return orm.scoped_session(partial(RoutingSession, self, **options),
+                                  scopefunc=scopefunc)
+
+
+def create_read_engine(uri, pool_size=5):
+    """
+    Returns engine for reads. SQLite connections are pooled and
+    shared between threads; newsmeme.sqlite sets them read-only.
+    """
+
+    if not uri.startswith("sqlite"):
+        return create_engine(uri, pool_size=pool_size)
+
+    return create_engine(uri,
+                         poolclass=QueuePool,
+                         pool_size=pool_size,
+                         connect_args=dict(check_same_thread=False))
+
+
+def init_app(app):
+    """
+    Creates app.read_engine if SQLALCHEMY_READ_URI is set.
+    """
+
+    uri = app.config['SQLALCHEMY_READ_URI']
+
+    if uri:
+        app.read_engine = create_read_engine(
+            uri, app.config['SQLALCHEMY_READ_POOL_SIZE'])
@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+"""
+    seeder.py
+    ~~~~~~~~~
+
+    Generates a large synthetic dataset for load and scale testing
+    (manage.py seed): users with follows, posts with tags, comment
+    trees and votes. Authors, votes, follows and tags follow Zipf
+    distributions, and rows are inserted in chunked transactions.
+    The same random seed always generates the same users, posts,
+    comments and votes. Hourly tag activity is added for the periods
+    compared by trending tags.
+
+    :copyright: (c) 2010 by Dan Jacob.
+    :license: BSD, see LICENSE for more details.
+"""
+import random
+import bisect
+
+from datetime import datetime, timedelta
+
+from werkzeug import generate_password_hash
+
+from flask import current_app
+
+from newsmeme.extensions import db
+from newsmeme.helpers import slugify, domain, link_hash, gravatar
+from newsmeme.models import User, Post, Comment, Tag, PostScore, \
+    post_tags
+from newsmeme.models.rankings import to_hour
+from newsmeme.models.trending import add_activity
+
+# all seeded users have this password
+SEED_PASSWORD = "password"
+
+WORDS = ("news", "python", "flask", "web", "open", "source", "release",
+         "data", "cloud", "linux", "security", "startup", "design",
+         "mobile", "game", "music", "science", "space", "energy", "health",
+         "market", "money", "law", "privacy", "photo", "video", "review",
+         "guide", "history", "future", "city", "world", "new", "best",
+         "why", "how", "what", "fast", "slow", "big", "small", "first",
+         "last", "year", "week", "today", "people", "things", "idea", "way")
+
+class Zipf(object):
+    """
+    Draws integers 1..n with probability proportional to 1 / k ** s.
+    """
+
+    def __init__(self, rng, n, s=1.0):
+        self.rng = rng
+        self.cumulative = []
+
+        total = 0
+        for k in xrange(1, n + 1):
+            total += 1.0 / k ** s
+            self.cumulative.append(total)
+
+    def __call__(self):
+        return bisect.bisect(self.cumulative,
+                             self.rng.random() * self.cumulative[-1]) + 1
+
+
+class _Writer(object):
+    """
+    Buffers rows and inserts them in one transaction every
+    `chunk_size` rows. Tables are inserted in the given order, so
+    rows must be added after the rows they reference.
+    """
+
+    def __init__(self, tables, chunk_size):
+        self.tables = tables
+        self.chunk_size = chunk_size
+        self.rows = dict((table, []) for table in tables)
+        self.num_buffered = 0
+        self.counts = dict((table.name, 0) for table in tables)
+
+    def add(self, table, row):
+        self.rows[table].append(row)
+        self.num_buffered += 1
+        if self.num_buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        for table in self.tables:
+            rows = self.rows[table]
+            if rows:
+                db.session.execute(table.insert(), rows)
+                self.counts[table.name] += len(rows)
+                self.rows[table] = []
+
+        db.session.commit()
+        self.num_buffered = 0
+
+
+def _next_id(model):
+    return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+
+def _text(rng, min_words, max_words):
+    return " ".join(rng.choice(WORDS) for i in \
+                    xrange(rng.randint(min_words, max_words)))
+
+
+def _votes(rng, count, user_ids, exclude):
+    """
+    Returns (voter ids, score change) for `count` votes, one in
+    ten of them down votes.
+    """
+    voters = set(rng.sample(user_ids, min(count, len(user_ids))))
+    voters.discard(exclude)
+
+    score = 0
+    for voter in voters:
+        score += -1 if rng.random() < 0.1 else 1
+
+    return voters, score
+
+
+def _reset_sequences(models):
+    # rows are inserted with explicit ids
+    if db.engine.dialect.name == "postgresql":
+        for model in models:
+            table = model.__tablename__
+            db.session.execute("SELECT setval('%s_id_seq', "
+                               "(SELECT max(id) FROM %s))" % (table, table))
+        db.session.commit()
+
+
+def seed_users(rng, writer, num_users, follows):
+    """
+    Inserts users following on average about `follows` users each,
+    popular users having most followers. Returns list of new ids.
+    """
+
+    first_id = _next_id(User)
+    user_ids = xrange(first_id, first_id + num_users)
+
+    following = dict((user_id, set()) for user_id in user_ids)
+    followers = dict((user_id, set()) for user_id in user_ids)
+
+    popular = Zipf(rng, num_users)
+
+    for user_id in user_ids:
+        num_follows = int(rng.expovariate(1.0 / follows)) if follows else 0
+        for i in xrange(min(num_follows, num_users - 1)):
+            followed = user_ids[popular() - 1]
+            if followed != user_id:
+                following[user_id].add(followed)
+                followers[followed].add(user_id)
+
+    password = generate_password_hash(SEED_PASSWORD)
+    date_joined = datetime.utcnow()
+
+    for user_id in user_ids:
+        username = u"user%d" % user_id
+        email = "user%d@example.com" % user_id
+
+        writer.add(User.__table__,
+                   dict(id=user_id,
+                        username=username,
+                        username_lower=username,
+                        email=email,
+                        email_lower=email,
+                        gravatar=gravatar(email),
+                        password=password,
+                        karma=0,
+                        role=User.MEMBER,
+                        receive_email=False,
+                        email_alerts=False,
+                        date_joined=date_joined,
+                        following=following.pop(user_id),
+                        followers=followers.pop(user_id)))
+
+    writer.flush()
+
+    return user_ids
+
+
+def seed_tags(num_tags):
+    """
+    Returns list of (id, name) for tags "tag1".."tagN", inserting
+    missing tags.
+    """
+
+    names = [u"tag%d" % i for i in xrange(1, num_tags + 1)]
+    tags = dict(db.session.query(Tag._name, Tag.id))
+
+    missing = [name for name in names if name not in tags]
+    if missing:
+        db.session.execute(Tag.__table__.insert(),
+                           [dict(name=name, slug=slugify(name)) \
+                            for name in missing])
+        db.session.commit()
+        tags = dict(db.session.query(Tag._name, Tag.id))
+
+    return [(tags[name], name) for name in names]
+
+
+def seed_posts(rng, writer, user_ids, tags, num_posts, max_comments=500,
+               max_depth=8, days=365):
+    """
+    Inserts posts spread over the last `days` days, with tags, votes
+    and comment trees up to `max_depth` deep. Comment counts are Zipf
+    distributed up to `max_comments` per post.
+    """
+
+    num_users = len(user_ids)
+
+    author = Zipf(rng, num_users)
+    num_votes = Zipf(rng, num_users, 2.0)
+    num_comment_votes = Zipf(rng, num_users, 2.5)
+    num_comments = Zipf(rng, max_comments + 1, 1.5)
+    tag = Zipf(rng, len(tags)) if tags else None
+    site = Zipf(rng, 1000)
+
+    now = datetime.utcnow()
+    span = days * 24 * 3600
+
+    post_id = _next_id(Post)
+    comment_id = _next_id(Comment)
+
+    # hourly tag activity within the periods compared by trending
+    config = current_app.config
+    since = to_hour(now) - \
+        config['TRENDING_HOURS'] * (config['TRENDING_PERIODS'] + 1) + 1
+
+    activity = {}
+
+    def count(taglist, dt, index, n=1):
+        hour = to_hour(dt)
+        if n and hour >= since:
+            for tag_id, name in taglist:
+                activity.setdefault((name, hour), [0, 0, 0])[index] += n
+
+    for i in xrange(num_posts):
+
+        author_id = user_ids[author() - 1]
+        date_created = now - timedelta(seconds=span * (num_posts - i) / \
+                                               num_posts)
+
+        title = _text(rng, 3, 10).capitalize()
+        link = "http://site%d.example.com/%d" % (site(), post_id)
+
+        taglist = []
+        if tag is not None:
+            taglist = sorted(set(tags[tag() - 1] for j in \
+                                 xrange(rng.randint(0, 3))))
+
+        votes, score = _votes(rng, num_votes() - 1, user_ids, author_id)
+
+        # comments reply to a random earlier comment in the thread,
+        # or to the post
+        comments = []
+
+        for j in xrange(num_comments() - 1):
+            parent = None
+            if comments and rng.random() < 0.6:
+                parent = rng.choice(comments)
+                if parent['depth'] >= max_depth:
+                    parent = None
+
+            commenter_id = user_ids[author() - 1]
+
+            comment_votes, comment_score = _votes(rng,
+                                                  num_comment_votes() - 1,
+                                                  user_ids,
+                                                  commenter_id)
+
+            comment_date = (parent or {}).get('date_created', date_created) + \
+                timedelta(seconds=rng.expovariate(1.0 / 3600))
+
+            comments.append(dict(id=comment_id,
+                                 author_id=commenter_id,
+                                 post_id=post_id,
+                                 parent_id=parent['id'] if parent else None,
+                                 comment=_text(rng, 5, 60),
+                                 date_created=min(comment_date, now),
+                                 score=1 + comment_score,
+                                 votes=comment_votes,
+                                 depth=parent['depth'] + 1 if parent else 0))
+
+            comment_id += 1
+
+        access = Post.PUBLIC
+        r = rng.random()
+        if r > 0.95:
+            access = Post.PRIVATE
+        elif r > 0.9:
+            access = Post.FRIENDS
+
+        writer.add(Post.__table__,
+                   dict(id=post_id,
+                        author_id=author_id,
+                        title=title,
+                        slug=slugify(title)[:80],
+                        link=link,
+                        domain=domain(link),
+                        link_hash=link_hash(link),
+                        description=_text(rng, 10, 40) \
+                            if rng.random() < 0.5 else None,
+                        tags=u", ".join(name for tag_id, name in taglist),
+                        date_created=date_created,
+                        score=1 + score,
+                        num_comments=len(comments),
+                        votes=votes,
+                        access=access))
+
+        # votes are counted in the hour the post was created
+        if score:
+            writer.add(PostScore.__table__,
+                       dict(post_id=post_id,
+                            hour=to_hour(date_created),
+                            score=score))
+
+        for tag_id, name in taglist:
+            writer.add(post_tags, dict(post_id=post_id, tag_id=tag_id))
+
+        for comment in comments:
+            del comment['depth']
+            writer.add(Comment.__table__, comment)
+
+        # as counted on flush, up votes only
+        count(taglist, date_created, 0)
+        count(taglist, date_created, 1, (len(votes) + score) // 2)
+
+        for comment in comments:
+            count(taglist, comment['date_created'], 2)
+
+        post_id += 1
+
+    writer.flush()
+
+    # added to any existing counts
+    connection = db.session.connection()
+
+    for (name, hour), counts in sorted(activity.iteritems()):
+        add_activity(connection, [name],
+                     datetime.utcfromtimestamp(hour * 3600),
+                     num_posts=counts[0],
+                     num_votes=counts[1],
+                     num_comments=counts[2])
+
+    db.session.commit()
+
+
+def update_karma(user_ids):
+    """
+    Sets karma of the seeded users, a range of ids, to the votes on
+    their posts and comments. Users already in the database keep
+    their karma.
+    """
+
+    if not user_ids:
+        return
+
+    users = User.__table__
+    posts = Post.__table__
+    comments = Comment.__table__
+
+    def votes(table):
+        return db.select([db.func.coalesce(db.func.sum(table.c.score - 1),
+                                           0)]).\
+            where(table.c.author_id==users.c.id).as_scalar()
+
+    karma = votes(posts) + votes(comments)
+
+    db.session.execute(users.update().\
+                       where(users.c.id.between(user_ids[0],
+                                                user_ids[-1])).\
+                       values(karma=db.case([(karma < 0, 0)],
+                                            else_=karma)))
+
+    db.session.commit()
+
+
+def seed(num_users, num_posts, follows=10, num_tags=200, max_comments=500,
+         max_depth=8, days=365, chunk_size=10000, random_seed=0):
+    """
+    Generates users, tags, posts, comments, votes and follows.
+    Returns dict of number of rows inserted per table.
+    """
+
+    rng = random.Random(random_seed)
+
+    writer = _Writer([User.__table__,
+                      Post.__table__,
+                      PostScore.__table__,
+                      post_tags,
+                      Comment.__table__], chunk_size)
+
+    user_ids = seed_users(rng, writer, num_users, follows)
+    tags = seed_tags(num_tags)
+
+    if user_ids:
+        seed_posts(rng, writer, user_ids, tags, num_posts,
+                   max_comments, max_depth, days)
+
+    _reset_sequences([User, Post, Comment])
+
+    update_karma(user_ids)
+
+    writer.counts['tags'] = len(tags)
+
+    return writer.counts
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+    serializers.py
+    ~~~~~~~~~~~~~~
+
+    Fast JSON serialization of posts for the API. Payloads are built 
+    from column tuples and each post is cached as a pre-encoded
+    JSON fragment.
+
+    :copyright: (c) 2010 by Dan Jacob.
+    :license: BSD, see LICENSE for more details.
+"""
+
+try:
+    import ujson as json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        import json
+
+from flask import current_app
+
+from newsmeme import signals
+from newsmeme.models import Post, archive
+from newsmeme.extensions import cache
+
+def dumps(obj):
+    """
+    Encodes obj with the fastest JSON library available.
+    """
+    return json.dumps(obj)
+
+
+def json_response(body):
+    return current_app.response_class(body, mimetype="application/json")
+
+
+def render_list(name, fragments):
+    """
+    Returns JSON response of encoded fragments as a list 
+    e.g. {"posts": [...]}
+    """
+    return json_response('{%s: [%s]}' % (dumps(name), ", ".join(fragments)))
+
+
+def cache_key(post_id):
+    return "post-json-%d" % post_id
+
+
+def encode_posts(query, check_cache=True):
+    """
+    Encodes each post in a PostQuery, caching fragments not already
+    cached. Returns list of (post_id, fragment) in query order.
+
+    Pass check_cache=False if the posts are known not to be cached.
+    """
+
+    rv = [(d['post_id'], dumps(d)) for d in query.as_json()]
+
+    if not rv:
+        return rv
+
+    fragments = dict((cache_key(post_id), fragment) \
+                     for post_id, fragment in rv)
+
+    if check_cache:
+        keys = fragments.keys()
+        for key, value in zip(keys, cache.cache.get_many(*keys)):
+            if value is not None:
+                del fragments[key]
+
+    if fragments:
+        cache.cache.set_many(fragments)
+
+    return rv
+
+
+def get_fragments(post_ids):
+    """
+    Returns dict of post_id: encoded JSON for public posts, using
+    cached fragments where available and fetching the rest
+    in one query. Ids not found are looked up in the archive.
+    """
+
+    keys = [cache_key(post_id) for post_id in post_ids]
+
+    fragments = dict((post_id, fragment) for post_id, fragment in \
+                     zip(post_ids, cache.cache.get_many(*keys)) \
+                     if fragment is not None)
+
+    missing = [post_id for post_id in post_ids if post_id not in fragments]
+
+    if missing:
+        fragments.update(encode_posts(Post.query.public().\
+                                      filter(Post.id.in_(missing)),
+                                      check_cache=False))
+
+        missing = [post_id for post_id in missing \
+                   if post_id not in fragments]
+
+    if missing:
+        archived = dict((d['post_id'], dumps(d)) for d in \
+                        archive.as_json(missing))
+
+        if archived:
+            cache.cache.set_many(dict((cache_key(post_id), fragment) for \
+                                      post_id, fragment in archived.items()))
+            fragments.update(archived)
+
+    return fragments
+
+# ------------- SIGNALS ----------------#
+
+def uncache_post(sender):
+    cache.delete(cache_key(sender.id))
+
+
+def uncache_author(sender):
+    """
+    Fragments include the author's username, so drop all their posts
+    """
+    keys = [cache_key(post_id) for post_id, in \
+            Post.query.filter_by(author_id=sender.id).with_entities(Post.id)]
+
+    if keys:
+        cache.cache.delete_many(*keys)
+
+
+signals.post_updated.connect(uncache_post)
+signals.post_deleted.connect(uncache_post)
+signals.comment_added.connect(uncache_post)
+signals.comment_deleted.connect(uncache_post)
+signals.user_updated.connect(uncache_author)
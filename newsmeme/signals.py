@@ -1,3 +1,4 @@
+
 from blinker import Namespace
 
 signals = Namespace()
@@ -5,3 +6,7 @@ signals = Namespace()
 comment_added = signals.signal("comment-added")
 comment_deleted = signals.signal("comment-deleted")
 
+post_updated = signals.signal("post-updated")
+post_deleted = signals.signal("post-deleted")
+
+user_updated = signals.signal("user-updated")
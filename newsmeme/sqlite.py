@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+    sqlite.py
+    ~~~~~~~~~
+
+    SQLite production settings: pragmas set on each new connection,
+    detection of lock timeouts, and WAL checkpoints (manage.py
+    checkpoint). Connections of the read engine are set read-only,
+    so a pool of them over the same WAL file stands in for a read
+    replica.
+
+    :copyright: (c) 2010 by Dan Jacob.
+    :license: BSD, see LICENSE for more details.
+"""
+from sqlalchemy import event
+
+from newsmeme.extensions import db
+
+CHECKPOINT_MODES = ("PASSIVE", "FULL", "RESTART", "TRUNCATE")
+
+def is_busy(exception):
+    """
+    Returns True if a database error is SQLite giving up waiting
+    for a lock.
+    """
+    return "is locked" in str(getattr(exception, "orig", exception))
+
+
+def checkpoint(mode="PASSIVE"):
+    """
+    Copies WAL frames into the database file. Returns (busy, frames
+    in WAL, frames checkpointed). PASSIVE never waits for readers or
+    writers; TRUNCATE waits for them and empties the WAL file.
+    """
+
+    if mode not in CHECKPOINT_MODES:
+        raise ValueError("Unknown checkpoint mode %s" % mode)
+
+    rv = tuple(db.session.execute("PRAGMA wal_checkpoint(%s)" %
+                                  mode).fetchone())
+    db.session.commit()
+    return rv
+
+
+def optimize():
+    """
+    Updates query planner statistics where SQLite thinks they are
+    out of date.
+    """
+    db.session.execute("PRAGMA optimize")
+    db.session.commit()
+
+
+def listen_pragmas(engine, pragmas):
+    """
+    Sets pragmas, list of (name, value), on each new connection.
+    """
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas:
+                cursor.execute("PRAGMA %s = %s" % (name, value))
+        finally:
+            cursor.close()
+
+    event.listen(engine, "connect", set_pragmas)
+
+
+def init_app(app):
+    """
+    Sets SQLITE_PRAGMAS on each new connection to a SQLite database,
+    and sets connections of a SQLite read engine read-only.
+    """
+
+    pragmas = tuple(app.config['SQLITE_PRAGMAS'])
+
+    engine = db.get_engine(app)
+    if engine.dialect.name == "sqlite" and pragmas:
+        listen_pragmas(engine, pragmas)
+
+    read_engine = getattr(app, "read_engine", None)
+    if read_engine is not None and read_engine.dialect.name == "sqlite":
+        listen_pragmas(read_engine, pragmas + (("query_only", "ON"),))
@@ -7,3 +7,4 @@ from .account import account
 from .user import user
 from .openid import openid
 from .api import api
+from .admin import admin
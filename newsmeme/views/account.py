@@ -10,14 +10,17 @@ from flaskext.principal import identity_changed, Identity, AnonymousIdentity
 from newsmeme.forms import ChangePasswordForm, EditAccountForm, \
     DeleteAccountForm, LoginForm, SignupForm, RecoverPasswordForm
 
-from newsmeme.models import User
+from newsmeme.models import User, Notification
 from newsmeme.helpers import render_template
-from newsmeme.extensions import db, mail
+from newsmeme import mailer, signals
+from newsmeme.extensions import db
 from newsmeme.permissions import auth
+from newsmeme.decorators import retry_on_busy
 
 account = Module(__name__)
 
 @account.route("/login/", methods=("GET", "POST"))
+@retry_on_busy
 def login():
 
     form = LoginForm(login=request.args.get("login", None),
@@ -37,10 +40,12 @@ def login():
                                   identity=Identity(user.id))
 
             # check if openid has been passed in
-            openid = session.pop('openid', None)
+            openid = session.get('openid')
             if openid:
                 user.openid = openid
                 db.session.commit()
+
+                session.pop('openid')
                 
                 flash(_("Your OpenID has been attached to your account. "
                       "You can now sign in with your OpenID."), "success")
@@ -63,6 +68,7 @@ def login():
     return render_template("account/login.html", form=form)
 
 @account.route("/signup/", methods=("GET", "POST"))
+@retry_on_busy
 def signup():
 
     form = SignupForm(next=request.args.get("next"))
@@ -101,20 +107,17 @@ def logout():
 
 
 @account.route("/forgotpass/", methods=("GET", "POST"))
+@retry_on_busy
 def forgot_password():
 
     form = RecoverPasswordForm()
 
     if form.validate_on_submit():
 
-        user = User.query.filter_by(email=form.email.data).first()
+        user = User.query.by_email(form.email.data).first()
         
         if user:
-            flash(_("Please see your email for instructions on "
-                  "how to access your account"), "success")
-            
             user.activation_key = str(uuid.uuid4())
-            db.session.commit()
 
             body = render_template("emails/recover_password.html",
                                    user=user)
@@ -123,7 +126,11 @@ def forgot_password():
                               body=body,
                               recipients=[user.email])
 
-            mail.send(message)
+            mailer.send(message)
+            db.session.commit()
+
+            flash(_("Please see your email for instructions on "
+                  "how to access your account"), "success")
             
             return redirect(url_for("frontend.index"))
 
@@ -135,6 +142,7 @@ def forgot_password():
 
 
 @account.route("/changepass/", methods=("GET", "POST"))
+@retry_on_busy
 def change_password():
 
     user = None
@@ -168,6 +176,7 @@ def change_password():
 
 @account.route("/edit/", methods=("GET", "POST"))
 @auth.require(401)
+@retry_on_busy
 def edit():
     
     form = EditAccountForm(g.user)
@@ -177,6 +186,8 @@ def edit():
         form.populate_obj(g.user)
         db.session.commit()
 
+        signals.user_updated.send(g.user)
+
         flash(_("Your account has been updated"), "success")
 
         return redirect(url_for("frontend.index"))
@@ -186,6 +197,7 @@ def edit():
 
 @account.route("/delete/", methods=("GET", "POST"))
 @auth.require(401)
+@retry_on_busy
 def delete():
 
     # confirm password & recaptcha
@@ -195,6 +207,8 @@ def delete():
 
         db.session.delete(g.user)
         db.session.commit()
+
+        g.user.uncache_snapshot()
     
         identity_changed.send(current_app._get_current_object(),
                               identity=AnonymousIdentity())
@@ -208,18 +222,16 @@ def delete():
 
 @account.route("/follow/<int:user_id>/", methods=("POST",))
 @auth.require(401)
+@retry_on_busy
 def follow(user_id):
     
     user = User.query.get_or_404(user_id)
     g.user.follow(user)
-    db.session.commit()
-
-    body = render_template("emails/followed.html",
-                           user=user)
 
-    mail.send_message(subject=_("%s is now following you" % g.user.username),
-                      body=body,
-                      recipients=[user.email])
+    db.session.add(Notification(user=user,
+                                actor=g.user,
+                                kind=Notification.FOLLOWED))
+    db.session.commit()
 
     return jsonify(success=True,
                    reload=True)
@@ -227,6 +239,7 @@ def follow(user_id):
 
 @account.route("/unfollow/<int:user_id>/", methods=("POST",))
 @auth.require(401)
+@retry_on_busy
 def unfollow(user_id):
     
     user = User.query.get_or_404(user_id)
@@ -0,0 +1,17 @@
+from flask import Module, Response, abort, current_app
+
+from newsmeme.permissions import admin as admin_permission
+
+admin = Module(__name__)
+
+@admin.route("/metrics/")
+@admin_permission.require(403)
+def metrics():
+
+    registry = getattr(current_app, "metrics", None)
+    if registry is None:
+        abort(404)
+
+    return Response(registry.render(), 
+                    mimetype="text/plain; version=0.0.4")
+
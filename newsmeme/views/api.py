@@ -1,17 +1,76 @@
-from flask import Module, jsonify, request
+from flask import Module, jsonify, request, abort
 
-from newsmeme.models import Post, User
-from newsmeme.helpers import cached
+from newsmeme.models import Post, User, archive
+from newsmeme.models.rankings import get_rankings
+from newsmeme.models.trending import get_trending
+from newsmeme.helpers import cached, link_hash
+from newsmeme.serializers import json_response, render_list, \
+    encode_posts, get_fragments
 
 api = Module(__name__)
 
+# maximum number of post ids accepted by a single batch request
+MAX_BATCH_SIZE = 250
+
 @api.route("/post/<int:post_id>/")
-@cached()
 def post(post_id):
 
-    post = Post.query.public().filter_by(id=post_id).first_or_404()
+    fragments = get_fragments([post_id])
+
+    if post_id not in fragments:
+        abort(404)
+
+    return json_response(fragments[post_id])
+
+
+@api.route("/posts/")
+def posts():
+    """
+    Returns JSON for many posts in one request e.g. 
+    /api/posts/?ids=1,2,3. Posts are returned in the order
+    requested; ids not found are left out.
+    """
+
+    post_ids = []
+
+    for post_id in request.args.get("ids", "").split(","):
+        if not post_id.strip():
+            continue
+        try:
+            post_id = int(post_id)
+        except ValueError:
+            abort(400)
+        if post_id not in post_ids:
+            post_ids.append(post_id)
+
+    if len(post_ids) > MAX_BATCH_SIZE:
+        abort(400)
+
+    fragments = get_fragments(post_ids) if post_ids else {}
+
+    return render_list("posts", [fragments[post_id] for post_id in post_ids \
+                                 if post_id in fragments])
+
+
+@api.route("/link/")
+def link():
+    """
+    Returns public posts of a link, oldest first e.g.
+    /api/link/?url=http://example.com. Links are compared in
+    canonical form, so the posts may have a different URL.
+    """
+
+    url = request.args.get("url", "").strip()
+
+    if not url:
+        abort(400)
 
-    return jsonify(**post.json)
+    posts = Post.query.public().\
+                filter(Post.link_hash==link_hash(url)).\
+                order_by(Post.id.asc())
+
+    return render_list("posts", [fragment for post_id, fragment in \
+                                 encode_posts(posts)])
 
 
 @api.route("/search/")
@@ -27,9 +86,38 @@ def search():
     if num_results > 100:
         num_results = 100
 
-    posts = Post.query.search(keywords).public().limit(num_results)
+    # archived posts are searched too
+    post_ids = archive.search(Post.query.search(keywords).public(),
+                              num_results)
+
+    fragments = get_fragments(post_ids)
     
-    return jsonify(results=list(posts.jsonify()))
+    return render_list("results", [fragments[post_id] for post_id in \
+                                   post_ids if post_id in fragments])
+
+
+@api.route("/top/<window>/")
+def top(window):
+
+    num_results = int(request.args.get("num_results", 20))
+
+    if num_results > 100:
+        num_results = 100
+
+    post_ids = get_rankings(window)[:num_results]
+
+    fragments = get_fragments(post_ids)
+
+    return render_list("posts", [fragments[post_id] for post_id in \
+                                 post_ids if post_id in fragments])
+
+
+@api.route("/tags/trending/")
+def trending():
+
+    return jsonify(tags=[dict(name=tag.name,
+                              slug=tag.slug,
+                              score=score) for tag, score in get_trending()])
 
 
 @api.route("/user/<username>/")
@@ -40,6 +128,7 @@ def user(username):
     
     posts = Post.query.filter_by(author_id=user.id).public()
 
-    return jsonify(posts=list(posts.jsonify()))
+    return render_list("posts", [fragment for post_id, fragment in \
+                                 encode_posts(posts)])
 
 
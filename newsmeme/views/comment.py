@@ -3,17 +3,20 @@ from flask import Module, redirect, flash, g, jsonify, current_app
 from flaskext.mail import Message
 from flaskext.babel import gettext as _
 
-from newsmeme import signals
+from newsmeme import mailer, signals
 from newsmeme.helpers import render_template
 from newsmeme.permissions import auth
 from newsmeme.models import Comment
+from newsmeme.models.comments import update_num_comments
 from newsmeme.forms import CommentForm, CommentAbuseForm
-from newsmeme.extensions import db, mail
+from newsmeme.extensions import db
+from newsmeme.decorators import retry_on_busy
 
 comment = Module(__name__)
 
 @comment.route("/<int:comment_id>/edit/", methods=("GET", "POST"))
 @auth.require(401)
+@retry_on_busy
 def edit(comment_id):
 
     comment = Comment.query.get_or_404(comment_id)
@@ -37,15 +40,21 @@ def edit(comment_id):
 
 @comment.route("/<int:comment_id>/delete/", methods=("POST",))
 @auth.require(401)
+@retry_on_busy
 def delete(comment_id):
 
     comment = Comment.query.get_or_404(comment_id)
     comment.permissions.delete.test(403)
 
+    post = comment.post
+
     db.session.delete(comment)
+
+    update_num_comments(post)
+
     db.session.commit()
 
-    signals.comment_deleted.send(comment.post)
+    signals.comment_deleted.send(post)
 
     return jsonify(success=True,
                    comment_id=comment_id)
@@ -71,7 +80,8 @@ def report_abuse(comment_id):
                               sender=g.user.email,
                               recipients=admins)
 
-            mail.send(message)
+            mailer.send(message)
+            db.session.commit()
             
         flash(_("Your report has been sent to the admins"), "success")
 
@@ -83,12 +93,14 @@ def report_abuse(comment_id):
 
 @comment.route("/<int:comment_id>/upvote/", methods=("POST",))
 @auth.require(401)
+@retry_on_busy
 def upvote(comment_id):
     return _vote(comment_id, 1)
 
 
 @comment.route("/<int:comment_id>/downvote/", methods=("POST",))
 @auth.require(401)
+@retry_on_busy
 def downvote(comment_id):
     return _vote(comment_id, -1)
 
@@ -108,6 +120,9 @@ def _vote(comment_id, score):
 
     db.session.commit()
 
+    # karma is in the author's cached snapshot
+    comment.author.uncache_snapshot()
+
     return jsonify(success=True,
                    comment_id=comment_id,
                    score=comment.score)
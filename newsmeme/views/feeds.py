@@ -6,6 +6,8 @@ from flask import Module, request, url_for
 from werkzeug.contrib.atom import AtomFeed
 
 from newsmeme.models import User, Post, Tag
+from newsmeme.models.rankings import get_rankings
+from newsmeme.models.timelines import get_timeline
 from newsmeme.helpers import cached
 
 feeds = Module(__name__)
@@ -68,6 +70,49 @@ def deadpool():
     return feed.get_response()
 
 
+@feeds.route("/top/<window>/")
+@cached()
+def top(window):
+    feed = PostFeed("newsmeme - top %s" % window,
+                    feed_url=request.url,
+                    url=request.url_root)
+
+    post_ids = get_rankings(window)[:15]
+
+    posts = dict((post.id, post) for post in \
+                 Post.query.filter(Post.id.in_(post_ids)))
+
+    for post_id in post_ids:
+        if post_id in posts:
+            feed.add_post(posts[post_id])
+
+    return feed.get_response()
+
+
+@feeds.route("/timeline/<username>/")
+@cached()
+def timeline(username):
+    user = User.query.filter_by(username=username).first_or_404()
+
+    feed = PostFeed("newsmeme - %s following" % user.username,
+                    feed_url=request.url,
+                    url=request.url_root)
+
+    # public posts only, as feed readers are not logged in
+    post_ids = get_timeline(user, 15)
+    following = user.following or set()
+
+    posts = dict((post.id, post) for post in \
+                 Post.query.filter(Post.id.in_(post_ids)).public() \
+                 if post.author_id in following)
+
+    for post_id in post_ids:
+        if post_id in posts:
+            feed.add_post(posts[post_id])
+
+    return feed.get_response()
+
+
 @feeds.route("/tag/<slug>/")
 @cached()
 def tag(slug):
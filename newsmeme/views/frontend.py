@@ -4,11 +4,16 @@ from flask import Module, url_for, \
 from flaskext.mail import Message
 from flaskext.babel import gettext as _
 
-from newsmeme.models import Post, Tag
-from newsmeme.extensions import mail, db
+from newsmeme.models import Post, Tag, archive
+from newsmeme.models.rankings import paginate_rankings, WINDOWS
+from newsmeme.models.timelines import fan_out, uncache_celebrities, \
+    paginate_timeline
+from newsmeme.models.trending import get_trending
+from newsmeme import mailer
+from newsmeme.extensions import db
 from newsmeme.helpers import render_template, cached
 from newsmeme.forms import PostForm, ContactForm
-from newsmeme.decorators import keep_login_url
+from newsmeme.decorators import keep_login_url, retry_on_busy
 from newsmeme.permissions import auth
 
 frontend = Module(__name__)
@@ -61,8 +66,43 @@ def deadpool(page=1):
                            page_url=page_url)
 
 
+@frontend.route("/top/")
+@frontend.route("/top/<window>/")
+@frontend.route("/top/<window>/<int:page>/")
+@cached()
+@keep_login_url
+def top(window="week", page=1):
+
+    page_obj = paginate_rankings(window, page, Post.PER_PAGE)
+
+    page_url = lambda page: url_for("frontend.top", 
+                                    window=window,
+                                    page=page)
+
+    return render_template("top.html",
+                           page_obj=page_obj,
+                           page_url=page_url,
+                           window=window,
+                           windows=[name for name, hours in WINDOWS])
+
+
+@frontend.route("/timeline/")
+@frontend.route("/timeline/<int:page>/")
+@auth.require(401)
+def timeline(page=1):
+
+    page_obj = paginate_timeline(g.user, page, Post.PER_PAGE)
+
+    page_url = lambda page: url_for("frontend.timeline", page=page)
+
+    return render_template("timeline.html",
+                           page_obj=page_obj,
+                           page_url=page_url)
+
+
 @frontend.route("/submit/", methods=("GET", "POST"))
 @auth.require(401)
+@retry_on_busy
 def submit():
 
     form = PostForm()
@@ -73,8 +113,16 @@ def submit():
         form.populate_obj(post)
 
         db.session.add(post)
+        db.session.flush()
+
+        num_timelines, celebrity = fan_out(post)
+
         db.session.commit()
 
+        # after committing, so the old list is not cached again
+        if celebrity:
+            uncache_celebrities()
+
         flash(_("Thank you for posting"), "success")
 
         return redirect(url_for("frontend.latest"))
@@ -92,8 +140,10 @@ def search(page=1):
     if not keywords:
         return redirect(url_for("frontend.index"))
 
-    page_obj = Post.query.search(keywords).restricted(g.user).as_list().
-                          paginate(page, per_page=Post.PER_PAGE)
+    # archived posts are searched too
+    page_obj = archive.paginate(Post.query.search(keywords).\
+                                restricted(g.user),
+                                page, Post.PER_PAGE)
 
     if page_obj.total == 1:
 
@@ -135,7 +185,8 @@ def contact():
                               recipients=admins,
                               sender=from_address)
 
-            mail.send(message)
+            mailer.send(message)
+            db.session.commit()
         
         flash(_("Thanks, your message has been sent to us"), "success")
 
@@ -152,6 +203,13 @@ def tags():
     return render_template("tags.html", tag_cloud=tags)
 
 
+@frontend.route("/trending/")
+@cached()
+@keep_login_url
+def trending():
+    return render_template("trending.html", trending=get_trending())
+
+
 @frontend.route("/tags/<slug>/")
 @frontend.route("/tags/<slug>/<int:page>/")
 @cached()
@@ -8,6 +8,7 @@ from newsmeme.models import User
 from newsmeme.helpers import slugify, render_template
 from newsmeme.forms import OpenIdSignupForm, OpenIdLoginForm
 from newsmeme.extensions import oid, db
+from newsmeme.decorators import retry_on_busy
 
 openid = Module(__name__)
 
@@ -76,6 +77,7 @@ def login():
 
 
 @openid.route("/signup/", methods=("GET", "POST"))
+@retry_on_busy
 def signup():
     
     if 'openid' not in session:
@@ -87,12 +89,14 @@ def signup():
 
     if form.validate_on_submit():
 
-        user = User(openid=session.pop('openid'))
+        user = User(openid=session['openid'])
         form.populate_obj(user)
 
         db.session.add(user)
         db.session.commit()
 
+        session.pop('openid')
+
         session.permanent = True
 
         identity_changed.send(current_app._get_current_object(),
@@ -1,15 +1,18 @@
 from flask import Module, abort, jsonify, request,  \
-    g, url_for, redirect, flash
+    g, url_for, redirect, flash, current_app
 
 from flaskext.mail import Message
 from flaskext.babel import gettext as _
 
-from newsmeme import signals
-from newsmeme.models import Post, Comment
+from newsmeme import mailer, signals
+from newsmeme.models import Post, Comment, Notification, archive
+from newsmeme.models.comments import update_num_comments
+from newsmeme.models.rankings import record_vote
+from newsmeme.models.related import get_related
 from newsmeme.forms import CommentForm, PostForm
 from newsmeme.helpers import render_template
-from newsmeme.decorators import keep_login_url
-from newsmeme.extensions import db, mail, cache
+from newsmeme.decorators import keep_login_url, retry_on_busy
+from newsmeme.extensions import db, cache
 from newsmeme.permissions import auth
 
 post = Module(__name__)
@@ -19,7 +22,10 @@ post = Module(__name__)
 @cache.cached(unless=lambda: g.user is not None)
 @keep_login_url
 def view(post_id, slug=None):
-    post = Post.query.get_or_404(post_id)
+    post = Post.query.get(post_id) or archive.get_post(post_id)
+    if post is None:
+        abort(404)
+
     if not post.permissions.view:
         if not g.user:
             flash(_("You must be logged in to see this post"), "error")
@@ -31,20 +37,26 @@ def view(post_id, slug=None):
     def edit_comment_form(comment):
         return CommentForm(obj=comment)
 
+    related = get_related(post.id, g.user,
+                          current_app.config['RELATED_POSTS'])
+
     return render_template("post/post.html", 
                            comment_form=CommentForm(),
                            edit_comment_form=edit_comment_form,
+                           related=related,
                            post=post)
 
 
 @post.route("/<int:post_id>/upvote/", methods=("POST",))
 @auth.require(401)
+@retry_on_busy
 def upvote(post_id):
     return _vote(post_id, 1)
 
 
 @post.route("/<int:post_id>/downvote/", methods=("POST",))
 @auth.require(401)
+@retry_on_busy
 def downvote(post_id):
     return _vote(post_id, -1)
 
@@ -52,6 +64,7 @@ def downvote(post_id):
 @post.route("/<int:post_id>/addcomment/", methods=("GET", "POST"))
 @post.route("/<int:post_id>/<int:parent_id>/reply/", methods=("GET", "POST"))
 @auth.require(401)
+@retry_on_busy
 def add_comment(post_id, parent_id=None):
     post = Post.query.get_or_404(post_id)
     post.permissions.view.test(403)
@@ -68,32 +81,26 @@ def add_comment(post_id, parent_id=None):
         form.populate_obj(comment)
 
         db.session.add(comment)
-        db.session.commit()
-
-        signals.comment_added.send(post)
-
-        flash(_("Thanks for your comment"), "success")
 
         author = parent.author if parent else post.author
 
         if author.email_alerts and author.id != g.user.id:
             
-            subject = _("Somebody replied to your comment") if parent else \
-                      _("Somebody commented on your post")
+            kind = Notification.REPLIED if parent else \
+                   Notification.COMMENTED
 
-            template = "emails/comment_replied.html" if parent else \
-                       "emails/post_commented.html"
+            db.session.add(Notification(user=author,
+                                        actor=g.user,
+                                        comment=comment,
+                                        kind=kind))
 
-            body = render_template(template,
-                                   author=author,
-                                   post=post,
-                                   parent=parent,
-                                   comment=comment)
+        update_num_comments(post)
 
-            mail.send_message(subject=subject,
-                              body=body,
-                              recipients=[post.author.email])
+        db.session.commit()
 
+        signals.comment_added.send(post)
+
+        flash(_("Thanks for your comment"), "success")
 
         return redirect(comment.url)
     
@@ -105,6 +112,7 @@ def add_comment(post_id, parent_id=None):
 
 @post.route("/<int:post_id>/edit/", methods=("GET", "POST"))
 @auth.require(401)
+@retry_on_busy
 def edit(post_id):
 
     post = Post.query.get_or_404(post_id)
@@ -114,7 +122,6 @@ def edit(post_id):
     if form.validate_on_submit():
 
         form.populate_obj(post)
-        db.session.commit()
 
         if g.user.id != post.author_id:
             body = render_template("emails/post_edited.html",
@@ -124,8 +131,13 @@ def edit(post_id):
                               body=body,
                               recipients=[post.author.email])
 
-            mail.send(message)
+            mailer.send(message)
 
+        db.session.commit()
+
+        signals.post_updated.send(post)
+
+        if g.user.id != post.author_id:
             flash(_("The post has been updated"), "success")
         
         else:
@@ -139,6 +151,7 @@ def edit(post_id):
 
 @post.route("/<int:post_id>/delete/", methods=("POST",))
 @auth.require(401)
+@retry_on_busy
 def delete(post_id):
 
     post = Post.query.get_or_404(post_id)
@@ -146,9 +159,6 @@ def delete(post_id):
     
     Comment.query.filter_by(post=post).delete()
 
-    db.session.delete(post)
-    db.session.commit()
-
     if g.user.id != post.author_id:
         body = render_template("emails/post_deleted.html",
                                post=post)
@@ -157,8 +167,14 @@ def delete(post_id):
                           body=body,
                           recipients=[post.author.email])
 
-        mail.send(message)
+        mailer.send(message)
 
+    db.session.delete(post)
+    db.session.commit()
+
+    signals.post_deleted.send(post)
+
+    if g.user.id != post.author_id:
         flash(_("The post has been deleted"), "success")
     
     else:
@@ -180,8 +196,15 @@ def _vote(post_id, score):
 
     post.vote(g.user)
 
+    record_vote(post.id, score)
+
     db.session.commit()
 
+    # karma is in the author's cached snapshot
+    post.author.uncache_snapshot()
+
+    signals.post_updated.send(post)
+
     return jsonify(success=True,
                    post_id=post_id,
                    score=post.score)
@@ -6,8 +6,9 @@ from flaskext.babel import gettext as _
 from newsmeme.helpers import render_template, cached
 from newsmeme.models import Post, User, Comment
 from newsmeme.decorators import keep_login_url
+from newsmeme.extensions import db
+from newsmeme import mailer
 from newsmeme.forms import MessageForm
-from newsmeme.extensions import mail
 from newsmeme.permissions import auth
 
 user = Module(__name__)
@@ -35,7 +36,8 @@ def send_message(user_id):
                           body=body,
                           recipients=[user.email])
 
-        mail.send(message)
+        mailer.send(message)
+        db.session.commit()
 
         flash(_("Your message has been sent to %(name)s", 
                name=user.username), "success")
@@ -80,7 +82,7 @@ def comments(username, page=1):
     user = User.query.filter_by(username=username).first_or_404()
 
     page_obj = Comment.query.filter_by(author=user).\
-        order_by(Comment.id.desc()).restricted(g.user).\
+        order_by(Comment.id.desc()).restricted(g.user).as_list().\
         paginate(page, Comment.PER_PAGE)
     
     page_url = lambda page: url_for('user.comments',
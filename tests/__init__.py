@@ -8,6 +8,11 @@
     :copyright: (c) 2010 by Dan Jacob.
     :license: BSD, see LICENSE for more details.
 """
+import hashlib
+import threading
+import SocketServer
+import BaseHTTPServer
+
 from flask import g
 from flaskext.testing import TestCase as Base, Twill
 from flaskext.principal import identity_changed, Identity, AnonymousIdentity
@@ -15,7 +20,147 @@ from flaskext.principal import identity_changed, Identity, AnonymousIdentity
 from newsmeme import create_app
 from newsmeme.config import TestConfig
 from newsmeme.models import User, Post, Comment
-from newsmeme.extensions import db
+from newsmeme.extensions import db, mail
+from newsmeme.instrumentation import record_queries
+from newsmeme.mailer import process_outbox, send_digests
+
+class _SMTPHandler(SocketServer.StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write(line + "\r\n")
+        self.wfile.flush()
+
+    def handle(self):
+        server = self.server
+        self.reply("220 localhost")
+
+        mailfrom, rcpttos = None, []
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            command = line.strip().split(" ")[0].upper()
+
+            if command in ("HELO", "EHLO"):
+                self.reply("250 localhost")
+
+            elif command == "MAIL":
+                mailfrom, rcpttos = line.strip()[10:], []
+                self.reply("250 OK")
+
+            elif command == "RCPT":
+                rcpttos.append(line.strip()[8:])
+                self.reply("250 OK")
+
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line == ".\r\n":
+                        break
+                    data.append(line)
+
+                if server.disconnect_after is not None and \
+                    len(server.messages) >= server.disconnect_after:
+                    # simulates the mail server going away
+                    return
+
+                server.messages.append((mailfrom, rcpttos, "".join(data)))
+                self.reply("250 OK")
+
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+
+            else:
+                self.reply("250 OK")
+
+
+class _StandIn(object):
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+class SMTPStandIn(_StandIn, SocketServer.ThreadingTCPServer):
+    """
+    Local SMTP server collecting messages in a background thread.
+    If disconnect_after is set, the connection is dropped once that
+    many messages have been received.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, disconnect_after=None):
+        SocketServer.ThreadingTCPServer.__init__(self, ("localhost", 0),
+                                                 _SMTPHandler)
+        self.port = self.server_address[1]
+        self.messages = []
+        self.disconnect_after = disconnect_after
+
+
+class _HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, 
+                                self.headers.get("If-None-Match")))
+
+        body = server.pages.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/rss+xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class HTTPStandIn(_StandIn, SocketServer.ThreadingMixIn, 
+                  BaseHTTPServer.HTTPServer):
+    """
+    Local HTTP server serving `pages`, a dict of path to body, in
+    a background thread. Responses have an ETag and requests with
+    a matching If-None-Match get 304 Not Modified.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, pages=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ("localhost", 0),
+                                           _HTTPHandler)
+        self.port = self.server_address[1]
+        self.pages = pages or {}
+        self.requests = []
+
+    def url(self, path):
+        return "http://localhost:%d%s" % (self.port, path)
+
 
 class TestCase(Base):
     
@@ -39,11 +184,44 @@ class TestCase(Base):
     def assert_401(self, response):
         assert response.status_code == 401
 
+    def assert_max_queries(self, num_queries, url, method="get", **kwargs):
+        """
+        Requests url, asserting that no more than num_queries 
+        SQL statements are run. Returns the response.
+        """
+
+        with record_queries() as stats:
+            response = getattr(self.client, method)(url, **kwargs)
+
+        assert stats.count <= num_queries, \
+            "%s ran %d queries, expected at most %d" % (
+            url, stats.count, num_queries)
+
+        return response
+
+    def configure_mail(self, port):
+        """
+        Sends mail to a local server, e.g. an SMTPStandIn.
+        """
+        self.app.config.update(MAIL_SERVER="localhost",
+                               MAIL_PORT=port,
+                               MAIL_SUPPRESS_SEND=False,
+                               MAIL_FAIL_SILENTLY=False)
+        mail.init_app(self.app)
+
+    def deliver_outbox(self):
+        """
+        Queues digests of all pending notifications and sends all 
+        queued email, as the digest job and mail worker would
+        """
+        send_digests(window=0)
+        return process_outbox()
+
     def login(self, **kwargs):
         response = self.client.post("/acct/login/", data=kwargs)
         assert response.status_code in (301, 302)
 
     def logout(self):
-        response = self.client.get("/auth/logout/")
+        response = self.client.get("/acct/logout/")
 
 
@@ -9,11 +9,40 @@
     :license: BSD, see LICENSE for more details.
 """
 
+import os
+import Queue
+import random
+import sqlite3
+import shutil
+import logging
+import tempfile
+import threading
+
 from datetime import datetime, timedelta
 
-from newsmeme.helpers import timesince, domain, slugify
+from sqlalchemy.exc import OperationalError
+
+from newsmeme.extensions import db
+from newsmeme.models import User, Post, Comment, Tag, TagActivity, \
+    post_tags
+from newsmeme.importer import import_feeds
+from newsmeme.models.timelines import get_timeline
+from newsmeme.queryplans import check_plans, unchecked_methods
+from newsmeme.seeder import seed, SEED_PASSWORD
+from newsmeme.benchmark import measure, compare
+from newsmeme.loadtest import parse_mix, read_log, synthetic_requests, \
+    report
+from newsmeme.sqlite import is_busy, checkpoint
+from newsmeme.routing import create_read_engine
+from newsmeme.decorators import retry_on_busy
+from newsmeme.helpers import timesince, domain, slugify, canonical_url, \
+    link_hash
+from newsmeme.instrumentation import statement_shape, QueryStats, \
+    record_queries
+from newsmeme.loghandlers import QueueHandler, QueueListener, \
+    DigestSMTPHandler
 
-from tests import TestCase
+from tests import TestCase, HTTPStandIn
 
 
 class TestSlugify(TestCase):
@@ -22,6 +51,142 @@ class TestSlugify(TestCase):
 
         assert slugify("hello, this is a test") == "hello-this-is-a-test"
 
+class TestQueryStats(TestCase):
+
+    def test_statement_shape(self):
+
+        assert statement_shape("SELECT * FROM posts WHERE id = 5") == \
+            statement_shape("SELECT * FROM posts\n WHERE id = 10")
+
+        assert statement_shape("SELECT * FROM posts WHERE id IN (?, ?)") == \
+            statement_shape("SELECT * FROM posts WHERE id IN (?)")
+
+        assert statement_shape("SELECT * FROM users WHERE name = 'a'") != \
+            statement_shape("SELECT * FROM posts WHERE name = 'a'")
+
+    def test_repeated(self):
+
+        stats = QueryStats()
+
+        for i in xrange(5):
+            stats.add("SELECT * FROM users WHERE id = %d" % i, 0.1)
+
+        stats.add("SELECT * FROM posts", 0.1)
+
+        assert stats.count == 6
+        assert stats.repeated(5) == [("SELECT * FROM users WHERE id = ?", 5)]
+
+    def test_failed_statement(self):
+
+        conn = db.engine.connect()
+        try:
+            try:
+                conn.execute("SELECT * FROM no_such_table")
+            except Exception:
+                pass
+
+            assert conn.info["query_start"] == []
+        finally:
+            conn.close()
+
+    def test_record_queries_thread_local(self):
+
+        def run():
+            db.engine.execute("SELECT 1")
+
+        with record_queries() as stats:
+            thread = threading.Thread(target=run)
+            thread.start()
+            thread.join()
+
+            assert stats.count == 0
+
+            run()
+
+            assert stats.count == 1
+
+class _RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class _DigestHandler(DigestSMTPHandler):
+
+    def __init__(self, *args, **kwargs):
+        DigestSMTPHandler.__init__(self, *args, **kwargs)
+        self.digests = []
+
+    def send(self, records, dropped):
+        self.digests.append((len(records), dropped))
+
+
+class TestQueuedLogging(TestCase):
+
+    def make_logger(self, handler):
+        logger = logging.getLogger("newsmeme.tests.%d" % id(handler))
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        return logger
+
+    def test_queue_listener(self):
+
+        queue = Queue.Queue()
+        handler = _RecordingHandler()
+        handler.setLevel(logging.ERROR)
+
+        listener = QueueListener(queue, [handler])
+        listener.start()
+
+        logger = self.make_logger(handler)
+        logger.addHandler(QueueHandler(queue))
+
+        logger.info("ignored")
+        logger.error("error in %s", "view")
+
+        listener.stop()
+
+        assert len(handler.records) == 1
+        assert handler.records[0].getMessage() == "error in view"
+
+    def test_full_queue_drops_records(self):
+
+        queue = Queue.Queue(1)
+        handler = QueueHandler(queue)
+        logger = self.make_logger(handler)
+        logger.addHandler(handler)
+
+        logger.error("first")
+        logger.error("second")
+
+        assert queue.qsize() == 1
+
+    def test_digest(self):
+
+        handler = _DigestHandler("localhost", 
+                                 "error@example.com",
+                                 ["admin@example.com"],
+                                 "error",
+                                 interval=300,
+                                 capacity=2)
+
+        logger = self.make_logger(handler)
+        logger.addHandler(handler)
+
+        for i in xrange(5):
+            logger.error("error %d", i)
+
+        # first error sent at once, the rest wait for the interval
+        assert handler.digests == [(1, 0)]
+
+        handler.flush()
+
+        assert handler.digests == [(1, 0), (2, 2)]
+
 class TestDomain(TestCase):
 
     def test_valid_domain(self):
@@ -33,6 +198,26 @@ class TestDomain(TestCase):
         assert domain("jkjkjkjkj") == ""
         
 
+class TestCanonicalUrl(TestCase):
+
+    def test_canonical_url(self):
+
+        assert canonical_url("https://www.X.com/a/?utm_source=y&b=2&a=1") == \
+            "http://x.com/a?a=1&b=2"
+
+        assert canonical_url("http://x.com:80/a#comments") == "http://x.com/a"
+
+    def test_link_hash(self):
+
+        assert link_hash("http://x.com/a") == \
+            link_hash(u"https://www.x.com/a/?utm_source=feed")
+
+        assert link_hash("http://x.com/a") != link_hash("http://x.com/b")
+
+        assert link_hash("http://x.com/a?id=1") != \
+            link_hash("http://x.com/a?id=2")
+
+
 class TestTimeSince(TestCase):
 
     def test_years_ago(self):
@@ -58,3 +243,415 @@ class TestTimeSince(TestCase):
         now = datetime.utcnow()
         five_minutes_ago = now - timedelta(seconds=(60 * 5) + 40)
         assert timesince(five_minutes_ago) == "5 minutes ago"
+
+
+def _rss(links):
+    items = "".join("<item><title>%s</title><link>%s</link></item>" % (
+                    link, link) for link in links)
+
+    return '<?xml version="1.0"?><rss version="2.0"><channel>' \
+           '<title>test</title>%s</channel></rss>' % items
+
+
+class TestImportFeeds(TestCase):
+
+    def setUp(self):
+        super(TestImportFeeds, self).setUp()
+
+        self.user = User(username="tester",
+                         email="tester@example.com",
+                         password="test")
+
+        db.session.add(self.user)
+        db.session.commit()
+
+        post = Post(author=self.user,
+                    title="posted",
+                    link="http://example.com/posted")
+
+        db.session.add(post)
+        db.session.commit()
+
+        self.server = HTTPStandIn({
+            "/a.xml" : _rss(["http://example.com/1",
+                             "http://example.com/2",
+                             "http://example.com/posted"]),
+            "/b.xml" : _rss(["http://example.com/2",
+                             "http://example.com/3"]),
+        })
+
+        self.server.start()
+
+    def tearDown(self):
+        super(TestImportFeeds, self).tearDown()
+        self.server.stop()
+
+    def test_import_feeds(self):
+
+        sources = [self.server.url("/a.xml"), self.server.url("/b.xml")]
+
+        assert import_feeds(sources, self.user, batch_size=2) == (3, 0, 0)
+
+        links = sorted(post.link for post in Post.query)
+
+        assert links == ["http://example.com/1",
+                         "http://example.com/2",
+                         "http://example.com/3",
+                         "http://example.com/posted"]
+
+        post = Post.query.filter_by(link="http://example.com/3").first()
+        assert post.slug
+        assert post.domain == "example.com"
+
+        # conditional requests with stored ETags
+        assert import_feeds(sources, self.user) == (0, 2, 0)
+
+        assert len(self.server.requests) == 4
+        assert all(etag for path, etag in self.server.requests[2:])
+
+    def test_timelines(self):
+
+        follower = User(username="follower",
+                        email="follower@example.com",
+                        password="test")
+
+        db.session.add(follower)
+        db.session.commit()
+
+        follower.follow(self.user)
+        db.session.commit()
+
+        assert import_feeds([self.server.url("/a.xml")], self.user) == \
+            (2, 0, 0)
+
+        post_ids = [post.id for post in Post.query.filter(
+                    Post.link.in_(["http://example.com/1",
+                                   "http://example.com/2"]))]
+
+        assert get_timeline(follower, 10) == sorted(post_ids, reverse=True)
+
+    def test_canonical_duplicates(self):
+
+        self.server.pages["/c.xml"] = _rss([
+            "https://www.example.com/posted/?utm_source=rss",
+            "http://example.com/5",
+            "http://www.example.com/5/"])
+
+        assert import_feeds([self.server.url("/c.xml")], self.user) == \
+            (1, 0, 0)
+
+    def test_failed_feed(self):
+
+        assert import_feeds([self.server.url("/missing.xml"),
+                             "http://localhost:1/feed.xml"], 
+                            self.user) == (0, 0, 2)
+
+    def test_local_file(self):
+
+        path = tempfile.mkdtemp()
+
+        try:
+            filename = os.path.join(path, "feed.xml")
+
+            fp = open(filename, "w")
+            fp.write(_rss(["http://example.com/4"]))
+            fp.close()
+
+            assert import_feeds([filename], self.user) == (1, 0, 0)
+            assert import_feeds([filename], self.user) == (0, 1, 0)
+        finally:
+            shutil.rmtree(path)
+
+
+class TestQueryPlans(TestCase):
+
+    def test_all_methods_checked(self):
+
+        assert unchecked_methods() == []
+
+    def test_no_full_scans(self):
+
+        user = User(username="tester",
+                    email="tester@example.com",
+                    password="test")
+
+        db.session.add(user)
+        db.session.commit()
+
+        db.session.add(Post(author=user,
+                            title="test",
+                            link="http://example.com/"))
+        db.session.commit()
+
+        scans = dict((name, scans) for name, plan, scans in \
+                     check_plans(user))
+
+        assert scans["PostQuery.popular"] == []
+        assert scans["PostQuery.hottest"] == []
+        assert scans["PostQuery.public"] == []
+        assert scans["CommentQuery.as_list"] == []
+        assert scans["CommentQuery.restricted"] == []
+
+
+class TestSeed(TestCase):
+
+    def dump(self):
+        return [(post.title, post.link, post.votes, post.tags,
+                 [(comment.author_id, comment.parent_id, comment.comment) \
+                  for comment in Comment.query.filter_by(post_id=post.id).\
+                  order_by(Comment.id)]) \
+                for post in Post.query.order_by(Post.id)]
+
+    def test_seed(self):
+
+        counts = seed(20, 50, follows=3, num_tags=10, chunk_size=7)
+
+        assert counts['users'] == User.query.count() == 20
+        assert counts['posts'] == Post.query.count() == 50
+        assert counts['comments'] == Comment.query.count()
+        assert counts['tags'] == Tag.query.count() == 10
+
+        for post in Post.query:
+            assert post.num_comments == \
+                Comment.query.filter_by(post_id=post.id).count()
+            assert post.author_id not in post.votes
+
+        for comment in Comment.query.filter(Comment.parent_id != None):
+            assert comment.parent.post_id == comment.post_id
+
+        user = User.query.first()
+        assert User.query.authenticate(user.username, SEED_PASSWORD)[1]
+
+        for user in User.query:
+            for user_id in user.following:
+                assert user.id in User.query.get(user_id).followers
+
+    def test_seed_activity(self):
+
+        seed(10, 20, num_tags=5, days=7)
+
+        activity = TagActivity.query.all()
+
+        assert activity
+        assert sum(a.num_posts for a in activity) == \
+            db.session.execute(post_tags.count()).scalar()
+
+    def test_seed_existing(self):
+
+        user = User(username="tester",
+                    email="tester@example.com",
+                    password="test",
+                    karma=10)
+
+        db.session.add(user)
+        db.session.commit()
+
+        seed(10, 20)
+
+        assert User.query.filter_by(username="tester").one().karma == 10
+
+    def test_same_seed(self):
+
+        seed(20, 30, random_seed=1)
+        data = self.dump()
+
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+
+        seed(20, 30, random_seed=1)
+        assert self.dump() == data
+
+
+class TestBenchmark(TestCase):
+
+    def test_measure(self):
+
+        seed(10, 20)
+
+        user = User.query.first()
+
+        result = measure(self.app, "GET", ["/"] * 3, user.username, 
+                         warmup=1)
+
+        assert result['requests'] == 2
+        assert result['status'] == [200]
+        assert result['queries']['max'] > 0
+        assert result['latency']['min'] <= result['latency']['max']
+
+    def test_compare(self):
+
+        old = [dict(size=10, endpoint="frontend.index", logged_in=False,
+                    latency=dict(median=0.02), queries=dict(max=5)),
+               dict(size=10, endpoint="post.view", logged_in=False,
+                    error="IndexError()")]
+
+        new = [dict(size=10, endpoint="frontend.index", logged_in=False,
+                    latency=dict(median=0.01), queries=dict(max=3)),
+               dict(size=10, endpoint="post.view", logged_in=False,
+                    latency=dict(median=0.01), queries=dict(max=3))]
+
+        assert compare(old, new) == [(10, "frontend.index", False,
+                                      0.02, 0.01, 5, 3)]
+
+
+class TestLoadTest(TestCase):
+
+    def test_parse_mix(self):
+
+        assert parse_mix("index=3, upvote=1") == (("index", 3),
+                                                  ("upvote", 1))
+
+        self.assertRaises(ValueError, parse_mix, "vote=1")
+        self.assertRaises(ValueError, parse_mix, "index")
+
+    def test_synthetic_requests(self):
+
+        targets = dict(post_ids=[1, 2], tags=["python"], 
+                       usernames=["tester"])
+
+        requests = synthetic_requests(random.Random(0), 
+                                      (("post", 1), ("submit", 1)),
+                                      targets, 20)
+
+        assert len(requests) == 20
+
+        for action, method, path, data in requests:
+            if action == "post":
+                assert method == "GET"
+                assert path in ("/post/1/", "/post/2/")
+            else:
+                assert method == "POST"
+                assert path == "/submit/"
+                assert data['link']
+
+        links = [data['link'] for action, method, path, data in requests \
+                 if data]
+
+        assert len(set(links)) == len(links)
+
+    def test_read_log(self):
+
+        log = [
+            '127.0.0.1 - - [10/Oct/2010:13:55:36 +0000] '
+            '"GET /latest/?page=2 HTTP/1.1" 200 2326 "-" "Mozilla/5.0"',
+            '127.0.0.1 - - [10/Oct/2010:13:55:37 +0000] '
+            '"POST /post/1/upvote/ HTTP/1.1" 200 40 "-" "Mozilla/5.0"',
+            '127.0.0.1 - - [10/Oct/2010:13:55:38 +0000] '
+            '"POST /submit/ HTTP/1.1" 302 0 "-" "Mozilla/5.0"',
+            '127.0.0.1 - - [10/Oct/2010:13:55:39 +0000] '
+            '"GET /no/such/page/ HTTP/1.1" 404 0 "-" "Mozilla/5.0"',
+            'garbage',
+        ]
+
+        assert read_log(log, self.app.url_map) == [
+            ("frontend.latest", "GET", "/latest/?page=2", None),
+            ("post.upvote", "POST", "/post/1/upvote/", None)]
+
+    def test_report(self):
+
+        results = [("index", 200, 0.01),
+                   ("index", 200, 0.03),
+                   ("upvote", 500, 0.5),
+                   ("upvote", 0, 0.1)]
+
+        rv = report(results, 2.0, 1)
+
+        assert rv['requests'] == 4
+        assert rv['throughput'] == 2.0
+        assert rv['errors'] == 2
+        assert rv['lock_errors'] == 1
+        assert rv['actions']['index']['errors'] == 0
+        assert rv['actions']['upvote']['latency']['max'] == 0.5
+
+
+class TestSQLite(TestCase):
+
+    def locked(self):
+        return OperationalError("UPDATE posts", {}, 
+                                sqlite3.OperationalError(
+                                "database is locked"))
+
+    def test_pragmas(self):
+
+        # NORMAL and MEMORY
+        assert db.session.execute("PRAGMA synchronous").scalar() == 1
+        assert db.session.execute("PRAGMA temp_store").scalar() == 2
+
+    def test_is_busy(self):
+
+        assert is_busy(self.locked())
+        assert not is_busy(OperationalError("SELECT", {}, 
+                                            sqlite3.OperationalError(
+                                            "no such table: posts")))
+
+    def test_retry_on_busy(self):
+
+        self.app.config['SQLITE_BUSY_BACKOFF'] = 0
+
+        calls = []
+
+        @retry_on_busy
+        def view():
+            calls.append(1)
+            if len(calls) < 3:
+                raise self.locked()
+            return "ok"
+
+        assert view() == "ok"
+        assert len(calls) == 3
+
+    def test_retry_gives_up(self):
+
+        self.app.config['SQLITE_BUSY_BACKOFF'] = 0
+
+        calls = []
+
+        @retry_on_busy
+        def view():
+            calls.append(1)
+            raise self.locked()
+
+        self.assertRaises(OperationalError, view)
+        assert len(calls) == self.app.config['SQLITE_BUSY_RETRIES'] + 1
+
+    def test_checkpoint(self):
+
+        assert len(checkpoint("PASSIVE")) == 3
+        self.assertRaises(ValueError, checkpoint, "NOW")
+
+
+class TestRouting(TestCase):
+
+    def setUp(self):
+        super(TestRouting, self).setUp()
+        self.app.read_engine = create_read_engine("sqlite://")
+
+    def tearDown(self):
+        del self.app.read_engine
+        super(TestRouting, self).tearDown()
+
+    def get_bind(self):
+        return db.session.get_bind(User.__mapper__)
+
+    def test_get_reads_from_replica(self):
+
+        with self.app.test_request_context("/", method="GET"):
+            assert self.get_bind() is self.app.read_engine
+
+            db.session.add(User(username="tester",
+                                email="tester@example.com",
+                                password="test"))
+            db.session.flush()
+
+            # read after write
+            assert self.get_bind() is db.engine
+
+        db.session.remove()
+
+    def test_post_reads_from_primary(self):
+
+        with self.app.test_request_context("/", method="POST"):
+            assert self.get_bind() is db.engine
+
+        db.session.remove()
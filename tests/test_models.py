@@ -9,12 +9,29 @@
     :license: BSD, see LICENSE for more details.
 """
 
+from datetime import datetime, timedelta
+
 from flaskext.sqlalchemy import get_debug_queries
 from flaskext.principal import Identity, AnonymousIdentity
 
 from newsmeme import signals
-from newsmeme.models import User, Post, Comment, Tag, post_tags
-from newsmeme.extensions import db
+from newsmeme.models import User, Post, Comment, Tag, post_tags, \
+    posts_archive, comments_archive, post_tags_archive
+from newsmeme.models.rankings import PostScore, record_vote, \
+    compute_rankings, prune_scores
+from newsmeme.models.timelines import fan_out, get_timeline, \
+    celebrity_ids, uncache_celebrities
+from newsmeme.models.trending import TagActivity, add_activity, \
+    compute_trending
+from newsmeme.models.archive import archive_posts, get_post, get_posts, \
+    search
+from newsmeme.models.related import RelatedPost, compute_related, \
+    rebuild_related, get_related
+from newsmeme.extensions import db, cache
+from newsmeme.helpers import link_hash
+from newsmeme.instrumentation import record_queries
+from newsmeme.models.users import snapshot_key
+from newsmeme.models.comments import update_num_comments
 
 from tests import TestCase
 
@@ -87,6 +104,10 @@ class TestUser(TestCase):
 
         assert user.gravatar == "f40aca99b2ca1491dbf6ec55597c4397"
 
+        user.email = "Tester2@example.com "
+
+        assert user.gravatar == "d57920f7198f30fbaa7824d56b9bedd9"
+
     def test_gravatar_url(self):
 
         user = User()
@@ -474,6 +495,121 @@ class TestUser(TestCase):
         assert auth_user.id == user.id
         assert is_auth
 
+    def test_from_snapshot(self):
+
+        user = User(username=u"tester",
+                    email="tester@example.com")
+        
+        db.session.add(user)
+        db.session.commit()
+
+        user_id = user.id
+
+        db.session.expunge_all()
+
+        # first load caches the snapshot
+        assert User.query.from_snapshot(user_id).id == user_id
+        assert cache.get(snapshot_key(user_id))['username'] == "tester"
+
+        db.session.expunge_all()
+
+        with record_queries() as stats:
+            user = User.query.from_snapshot(user_id)
+
+            assert user.username == "tester"
+            assert user.role == User.MEMBER
+            assert user.karma == 0
+            assert user.num_friends == 0
+            assert user.provides
+
+        assert stats.count == 0
+
+        # other columns are loaded on access
+        with record_queries() as stats:
+            assert user.email == "tester@example.com"
+            assert user.followers == set()
+
+        assert stats.count == 1
+
+    def test_snapshot_invalidated(self):
+
+        user = User(username=u"tester",
+                    email="tester@example.com")
+
+        user2 = User(username=u"tester2",
+                     email="tester2@example.com")
+        
+        db.session.add_all([user, user2])
+        db.session.commit()
+
+        user_id, user2_id = user.id, user2.id
+
+        for u in (user_id, user2_id):
+            User.query.from_snapshot(u)
+
+        db.session.expunge_all()
+
+        user = User.query.from_snapshot(user_id)
+        user2 = User.query.from_snapshot(user2_id)
+
+        assert user.num_friends == 0
+
+        user.follow(user2)
+        user2.follow(user)
+
+        # counts are not stale within the request
+        assert user.num_friends == 1
+        assert user2.num_following == 1
+
+        db.session.commit()
+
+        assert cache.get(snapshot_key(user_id)) is None
+        assert cache.get(snapshot_key(user2_id)) is None
+
+        db.session.expunge_all()
+
+        user = User.query.from_snapshot(user_id)
+
+        assert user.num_friends == 1
+        assert cache.get(snapshot_key(user_id))['num_friends'] == 1
+
+        signals.user_updated.send(user)
+        assert cache.get(snapshot_key(user_id)) is None
+
+    def test_authenticate_ignores_case(self):
+
+        user = User(username=u"Tester",
+                    email="Tester@Example.com",
+                    password="test!")
+        
+        db.session.add(user)
+        db.session.commit()
+
+        for login in ("tester", "TESTER", "tester@example.com"):
+            auth_user, is_auth = User.query.authenticate(login, "test!")
+
+            assert auth_user.id == user.id
+            assert is_auth
+
+    def test_by_username(self):
+
+        user = User(username=u"a_c",
+                    email="tester@example.com")
+        
+        db.session.add(user)
+        db.session.commit()
+
+        assert user.username_lower == "a_c"
+        assert user.email_lower == "tester@example.com"
+
+        assert User.query.by_username("A_C").count() == 1
+
+        # no wildcards
+        assert User.query.by_username("abc").count() == 0
+        assert User.query.by_username("a%").count() == 0
+        assert User.query.by_email("%@example.com").count() == 0
+        assert User.query.by_email("TESTER@example.com").count() == 1
+
 
 class TestPost(TestCase):
 
@@ -502,6 +638,41 @@ class TestPost(TestCase):
 
         assert self.post.permalink == "http://localhost/post/1/s/testing/"
 
+    def test_stored_slug_and_domain(self):
+
+        assert self.post.slug == "testing"
+        assert self.post.domain == "reddit.com"
+
+        self.post.title = "Hello, World"
+        self.post.link = "http://www.example.com/foo"
+        db.session.commit()
+        db.session.expunge_all()
+
+        post = Post.query.as_list().get(self.post.id)
+
+        assert post.slug == "hello-world"
+        assert post.domain == "example.com"
+        assert post.link_hash == link_hash("https://example.com/foo/")
+
+    def test_comment_authors_email_deferred(self):
+
+        comment = Comment(post=self.post,
+                          author=self.user,
+                          comment="test")
+
+        db.session.add(comment)
+        db.session.commit()
+        db.session.expunge_all()
+
+        post = Post.query.get(self.post.id)
+        author = post.comments[0].author
+
+        # deferred columns are missing from the instance dict
+        assert "_email" not in author.__dict__
+        assert "_gravatar" in author.__dict__
+        assert author.gravatar_url(30)
+        assert "_email" not in author.__dict__
+
     def test_popular(self):
 
         assert Post.query.popular().count() == 1
@@ -524,6 +695,7 @@ class TestPost(TestCase):
         json = list(Post.query.jsonify())
 
         assert json[0]['title'] == self.post.title
+        assert json[0] == d
 
     def test_tags(self):
 
@@ -723,18 +895,18 @@ class TestPost(TestCase):
                           comment="test")
 
         db.session.add(comment)
-        db.session.commit()
 
-        signals.comment_added.send(self.post)
+        update_num_comments(self.post)
+        db.session.commit()
 
         post = Post.query.get(self.post.id)
 
         assert post.num_comments == 1
 
         db.session.delete(comment)
-        db.session.commit()
 
-        signals.comment_deleted.send(post)
+        update_num_comments(post)
+        db.session.commit()
 
         post = Post.query.get(post.id)
 
@@ -1108,3 +1280,451 @@ class TestComment(TestCase):
         assert self.comment.permalink == \
                 "http://localhost/post/1/s/testing/#comment-1"
 
+
+class TestArchive(TestCase):
+
+    def setUp(self):
+        super(TestArchive, self).setUp()
+
+        self.user = User(username="tester",
+                         email="tester@example.com",
+                         password="testing")
+
+        db.session.add(self.user)
+
+        self.old_post = Post(title="old testing",
+                             author=self.user,
+                             tags="python",
+                             date_created=datetime.utcnow() - \
+                                timedelta(days=30))
+
+        db.session.add(self.old_post)
+        db.session.commit()
+
+        self.comment = Comment(post=self.old_post,
+                               author=self.user,
+                               comment="first")
+
+        db.session.add(self.comment)
+        db.session.commit()
+
+        self.reply = Comment(post=self.old_post,
+                             parent=self.comment,
+                             author=self.user,
+                             comment="reply")
+
+        db.session.add(self.reply)
+        db.session.commit()
+
+        self.new_post = Post(title="new testing", author=self.user)
+
+        db.session.add(self.new_post)
+        db.session.commit()
+
+        self.new_comment = Comment(post=self.new_post,
+                                   author=self.user,
+                                   comment="new")
+
+        db.session.add(self.new_comment)
+        db.session.commit()
+
+        self.old_post_id = self.old_post.id
+        self.new_post_id = self.new_post.id
+        self.new_comment_id = self.new_comment.id
+
+    def archive(self):
+        num_posts = archive_posts(datetime.utcnow() - timedelta(days=7))
+        db.session.expunge_all()
+        return num_posts
+
+    def test_moves_old_posts(self):
+
+        assert self.archive() == 1
+
+        assert Post.query.get(self.old_post_id) is None
+        assert Post.query.get(self.new_post_id) is not None
+
+        assert Comment.query.count() == 1
+
+        assert db.session.execute(
+            posts_archive.count()).scalar() == 1
+        assert db.session.execute(
+            comments_archive.count()).scalar() == 2
+        assert db.session.execute(
+            post_tags_archive.count()).scalar() == 1
+
+        assert self.archive() == 0
+
+    def test_ids_not_reused(self):
+
+        num_posts = archive_posts(datetime.utcnow() + timedelta(days=1))
+
+        assert num_posts == 2
+        assert Post.query.count() == 0
+
+        post = Post(title="newer", author=self.user)
+        db.session.add(post)
+        db.session.commit()
+
+        comment = Comment(post=post, author=self.user, comment="newer")
+        db.session.add(comment)
+        db.session.commit()
+
+        assert post.id > self.new_post_id
+        assert comment.id > self.new_comment_id
+
+    def test_get_post(self):
+
+        self.archive()
+
+        post = get_post(self.old_post_id)
+
+        assert post.archived
+        assert post.title == "old testing"
+        assert post.author.username == "tester"
+        assert post.taglist == ["python"]
+        assert post.url == "/post/%d/s/old-testing/" % self.old_post_id
+
+        assert [c.comment for c in post.comments] == ["first"]
+        assert [c.comment for c in post.comments[0].comments] == ["reply"]
+        assert post.comments[0].comments[0].depth == 1
+        assert post.comments[0].comments[0].parent.comment == "first"
+
+        assert get_post(self.new_post_id) is None
+        assert get_posts([self.old_post_id]).keys() == [self.old_post_id]
+
+    def test_read_only(self):
+
+        self.archive()
+
+        post = get_post(self.old_post_id)
+
+        user = User.query.filter_by(username="tester").first()
+
+        identity = Identity(user.id)
+        identity.provides.update(user.provides)
+
+        assert post.permissions.view.allows(identity)
+        assert not post.permissions.edit.allows(identity)
+        assert not post.permissions.delete.allows(identity)
+        assert not post.permissions.vote.allows(identity)
+        assert not post.permissions.comment.allows(identity)
+        assert not post.comments[0].permissions.edit.allows(identity)
+
+    def test_search(self):
+
+        self.archive()
+
+        assert search(Post.query.search("testing").public(), 10) == \
+            [self.new_post_id, self.old_post_id]
+
+        assert search(Post.query.search("old").public(), 10) == \
+            [self.old_post_id]
+
+
+class TestRankings(TestCase):
+
+    def setUp(self):
+        super(TestRankings, self).setUp()
+
+        self.user = User(username="tester",
+                         email="tester@example.com",
+                         password="testing")
+
+        db.session.add(self.user)
+
+        self.posts = [Post(title="testing %d" % i, author=self.user) \
+                      for i in xrange(3)]
+
+        db.session.add_all(self.posts)
+        db.session.commit()
+
+        self.post_ids = [post.id for post in self.posts]
+
+    def test_record_vote(self):
+
+        now = datetime.utcnow()
+
+        record_vote(self.post_ids[0], 1, now)
+        record_vote(self.post_ids[0], 1, now)
+        record_vote(self.post_ids[0], -1, now - timedelta(hours=2))
+        db.session.commit()
+
+        assert sorted(score.score for score in PostScore.query) == [-1, 2]
+
+    def test_windows(self):
+
+        now = datetime.utcnow()
+
+        first, second, third = self.post_ids
+
+        record_vote(first, 1, now - timedelta(days=3))
+        record_vote(first, 1, now - timedelta(days=3))
+        record_vote(first, 1, now - timedelta(days=3))
+        record_vote(second, 1, now)
+        record_vote(second, 1, now)
+        record_vote(third, 1, now)
+        record_vote(third, -1, now)
+        db.session.commit()
+
+        assert compute_rankings("day", 10, now) == [second]
+        assert compute_rankings("week", 10, now) == [first, second]
+        assert compute_rankings("week", 1, now) == [first]
+
+        Post.query.get(first).access = Post.PRIVATE
+        db.session.commit()
+
+        assert compute_rankings("week", 10, now) == [second]
+
+    def test_all_time(self):
+
+        first, second, third = self.posts
+
+        second.score = 5
+        third.score = 0
+        db.session.commit()
+
+        assert compute_rankings("all", 10) == [second.id, first.id]
+
+    def test_prune_scores(self):
+
+        now = datetime.utcnow()
+
+        record_vote(self.post_ids[0], 1, now - timedelta(days=31))
+        record_vote(self.post_ids[0], 1, now)
+        db.session.commit()
+
+        assert prune_scores(now) == 1
+        assert PostScore.query.count() == 1
+
+
+class TestTimeline(TestCase):
+
+    def setUp(self):
+        super(TestTimeline, self).setUp()
+
+        self.author = User(username="author",
+                           email="author@example.com",
+                           password="testing")
+
+        self.followers = [User(username="follower%d" % i,
+                               email="follower%d@example.com" % i,
+                               password="testing") for i in xrange(3)]
+
+        db.session.add(self.author)
+        db.session.add_all(self.followers)
+        db.session.commit()
+
+        for follower in self.followers:
+            follower.follow(self.author)
+
+        db.session.commit()
+
+    def submit(self, access=Post.PUBLIC):
+        post = Post(title="testing", author=self.author, access=access)
+        db.session.add(post)
+        db.session.flush()
+        num_timelines, celebrity = fan_out(post)
+        db.session.commit()
+        if celebrity:
+            uncache_celebrities()
+        return post, num_timelines
+
+    def test_fan_out(self):
+
+        post, num_timelines = self.submit()
+
+        assert num_timelines == 3
+
+        for follower in self.followers:
+            assert get_timeline(follower, 10) == [post.id]
+
+        assert get_timeline(self.author, 10) == []
+
+    def test_private_posts(self):
+
+        post, num_timelines = self.submit(Post.PRIVATE)
+
+        assert num_timelines == 0
+
+    def test_friends_posts(self):
+
+        self.author.follow(self.followers[0])
+        db.session.commit()
+
+        post, num_timelines = self.submit(Post.FRIENDS)
+
+        assert num_timelines == 1
+        assert get_timeline(self.followers[0], 10) == [post.id]
+        assert get_timeline(self.followers[1], 10) == []
+
+    def test_capped(self):
+
+        self.app.config['TIMELINE_SIZE'] = 2
+
+        post_ids = [self.submit()[0].id for i in xrange(4)]
+
+        for follower in self.followers:
+            assert get_timeline(follower, 10) == \
+                sorted(post_ids, reverse=True)[:2]
+
+    def test_celebrity(self):
+
+        first, num_timelines = self.submit()
+
+        # cached before the author becomes a celebrity
+        assert celebrity_ids() == set()
+
+        self.app.config['TIMELINE_FANOUT_LIMIT'] = 2
+
+        second, num_timelines = self.submit()
+
+        assert num_timelines == 0
+
+        for follower in self.followers:
+            assert get_timeline(follower, 10) == [second.id, first.id]
+
+
+class TestTrending(TestCase):
+
+    def setUp(self):
+        super(TestTrending, self).setUp()
+
+        self.user = User(username="tester",
+                         email="tester@example.com",
+                         password="testing")
+
+        db.session.add(self.user)
+        db.session.commit()
+
+    def get_activity(self, slug):
+        activity = TagActivity.query.filter_by(slug=slug).one()
+        return activity.num_posts, activity.num_votes, activity.num_comments
+
+    def test_counted_on_flush(self):
+
+        post = Post(title="testing", author=self.user, tags="Python, web")
+        db.session.add(post)
+        db.session.commit()
+
+        assert self.get_activity(u"python") == (1, 0, 0)
+
+        post.score += 1
+        db.session.commit()
+
+        post.title = "changed"
+        db.session.commit()
+
+        comment = Comment(post=post, author=self.user, comment="test")
+        db.session.add(comment)
+        db.session.commit()
+
+        assert self.get_activity(u"python") == (1, 1, 1)
+        assert self.get_activity(u"web") == (1, 1, 1)
+
+    def test_compute_trending(self):
+
+        now = datetime.utcnow()
+        connection = db.session.connection()
+
+        # steady history
+        for day in xrange(8):
+            add_activity(connection, ["steady"],
+                         now - timedelta(days=day), num_votes=5)
+
+        # quiet until today
+        add_activity(connection, ["rising"],
+                     now - timedelta(days=3), num_votes=1)
+        add_activity(connection, ["rising"], now, num_votes=10)
+
+        # busier before
+        add_activity(connection, ["falling"],
+                     now - timedelta(days=2), num_votes=20)
+        add_activity(connection, ["falling"], now, num_votes=1)
+
+        db.session.commit()
+
+        trending = compute_trending(24, 7, 10, now)
+
+        assert [slug for slug, score in trending] == [u"rising"]
+
+        assert compute_trending(24, 7, 10, now + timedelta(days=1)) == []
+
+
+class TestRelated(TestCase):
+
+    def test_compute_related(self):
+
+        tags = {1 : set([1, 2]),
+                2 : set([1, 2]),
+                3 : set([1]),
+                4 : set([3])}
+
+        voters = {3 : set([10, 11]),
+                  4 : set([10, 11]),
+                  5 : set([12])}
+
+        related = dict((post_id, [other for other, score in scores]) \
+                       for post_id, scores in \
+                       compute_related(tags, voters, 5, 1000))
+
+        assert related[1] == [2, 3]
+        # equal scores go to the newest post
+        assert related[3] == [4, 2, 1]
+        assert related[5] == []
+
+        related = dict(compute_related(tags, voters, 1, 1000))
+
+        assert [other for other, score in related[1]] == [2]
+
+        # every tag and voter is too common
+        related = dict(compute_related(tags, voters, 5, 1))
+
+        assert related[1] == []
+
+    def test_rebuild_related(self):
+
+        user = User(username="tester",
+                    email="tester@example.com",
+                    password="testing")
+
+        db.session.add(user)
+        db.session.commit()
+
+        posts = []
+
+        for title, tags in (("first", "python, web"),
+                            ("second", "python, web"),
+                            ("third", "cooking")):
+
+            post = Post(title=title, author=user, tags=tags)
+            post.votes = set([user.id])
+
+            db.session.add(post)
+            db.session.commit()
+
+            posts.append(post)
+
+        first, second, third = posts
+
+        assert rebuild_related(5, 1000, 1) == 2
+
+        assert get_related(first.id) == [second]
+        assert get_related(second.id) == [first]
+        assert get_related(third.id) == []
+
+        # rows are replaced on rebuild
+        assert rebuild_related(5, 1000) == 2
+        assert RelatedPost.query.count() == 2
+
+        second.access = Post.PRIVATE
+        db.session.commit()
+
+        assert get_related(first.id) == []
+        assert get_related(first.id, user) == [second]
+
+        db.session.delete(second)
+        db.session.commit()
+
+        assert rebuild_related(5, 1000) == 0
+        assert RelatedPost.query.count() == 0
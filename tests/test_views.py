@@ -9,11 +9,28 @@
     :license: BSD, see LICENSE for more details.
 """
 
-from newsmeme.signals import comment_added
-from newsmeme.models import User, Post, Comment
-from newsmeme.extensions import db, mail
+import os
+import shutil
+import socket
+import sqlite3
+import tempfile
 
-from tests import TestCase
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import OperationalError
+
+from newsmeme import mailer, metrics
+from newsmeme.profiler import SamplingProfiler, list_samples
+from newsmeme.metrics import Registry, InstrumentedCache
+from newsmeme.models import User, Post, Comment, OutboxMessage, \
+    Notification
+from newsmeme.models.archive import archive_posts
+from newsmeme.models.related import rebuild_related
+from newsmeme.models.users import snapshot_key
+from newsmeme.models.comments import update_num_comments
+from newsmeme.extensions import db, mail, cache
+
+from tests import TestCase, SMTPStandIn
 
 class TestApi(TestCase):
 
@@ -37,6 +54,26 @@ class TestApi(TestCase):
 
         return post
 
+    def test_link(self):
+
+        post = self.create_post()
+        post.link = "http://example.com/a"
+
+        db.session.commit()
+
+        response = self.client.get("/api/link/?url=https://www.example.com/a/")
+        self.assert_200(response)
+
+        assert [p['post_id'] for p in response.json['posts']] == [post.id]
+
+        response = self.client.get("/api/link/?url=http://example.com/b")
+        self.assert_200(response)
+
+        assert response.json['posts'] == []
+
+        response = self.client.get("/api/link/")
+        assert response.status_code == 400
+
     def test_get_post(self):
 
         post = self.create_post()
@@ -48,6 +85,126 @@ class TestApi(TestCase):
         assert response.json['title'] == "test"
         assert response.json['author'] == "tester"
 
+    def test_get_posts(self):
+
+        post = self.create_post()
+
+        other = Post(author=post.author, title="other")
+        db.session.add(other)
+        db.session.commit()
+
+        response = self.client.get("/api/posts/?ids=%d,%d,%d,999" % (
+                                   other.id, post.id, other.id))
+        self.assert_200(response)
+
+        posts = response.json['posts']
+
+        assert [p['post_id'] for p in posts] == [other.id, post.id]
+        assert posts[1]['title'] == "test"
+        assert posts[1]['author'] == "tester"
+
+    def test_get_posts_score_changed(self):
+
+        post = self.create_post()
+
+        response = self.client.get("/api/posts/?ids=%d" % post.id)
+        assert response.json['posts'][0]['score'] == 1
+
+        voter = User(username="voter",
+                     email="voter@example.com",
+                     password="test")
+
+        db.session.add(voter)
+        db.session.commit()
+
+        self.login(login="voter", password="test")
+        self.client.post("/post/%d/upvote/" % post.id)
+
+        response = self.client.get("/api/posts/?ids=%d" % post.id)
+        assert response.json['posts'][0]['score'] == 2
+
+    def test_top(self):
+
+        post = self.create_post()
+
+        voter = User(username="voter",
+                     email="voter@example.com",
+                     password="test")
+
+        db.session.add(voter)
+        db.session.commit()
+
+        self.login(login="voter", password="test")
+        self.client.post("/post/%d/upvote/" % post.id)
+        self.logout()
+
+        response = self.client.get("/api/top/day/")
+        self.assert_200(response)
+
+        assert [p['post_id'] for p in response.json['posts']] == [post.id]
+
+        response = self.client.get("/api/top/year/")
+        self.assert_404(response)
+
+    def test_get_posts_title_changed(self):
+
+        post = self.create_post()
+
+        response = self.client.get("/api/posts/?ids=%d" % post.id)
+        assert response.json['posts'][0]['title'] == "test"
+
+        self.login(login="tester", password="test")
+        self.client.post("/post/%d/edit/" % post.id, 
+                         data={'title' : 'changed',
+                               'access' : Post.PUBLIC})
+
+        response = self.client.get("/api/posts/?ids=%d" % post.id)
+        assert response.json['posts'][0]['title'] == "changed"
+
+    def test_get_post_score_changed(self):
+
+        post = self.create_post()
+
+        response = self.client.get("/api/post/%d/" % post.id)
+        assert response.json['score'] == 1
+
+        voter = User(username="voter",
+                     email="voter@example.com",
+                     password="test")
+
+        db.session.add(voter)
+        db.session.commit()
+
+        self.login(login="voter", password="test")
+        self.client.post("/post/%d/upvote/" % post.id)
+        self.logout()
+
+        response = self.client.get("/api/post/%d/" % post.id)
+        assert response.json['score'] == 2
+
+    def test_get_posts_username_changed(self):
+
+        post = self.create_post()
+
+        response = self.client.get("/api/posts/?ids=%d" % post.id)
+        assert response.json['posts'][0]['author'] == "tester"
+
+        self.login(login="tester", password="test")
+        self.client.post("/acct/edit/", data={'username' : 'renamed',
+                                              'email' : 'tester@example.com'})
+
+        response = self.client.get("/api/posts/?ids=%d" % post.id)
+        assert response.json['posts'][0]['author'] == "renamed"
+
+    def test_get_posts_bad_ids(self):
+
+        response = self.client.get("/api/posts/?ids=1,foo")
+        assert response.status_code == 400
+
+        ids = ",".join(str(i) for i in xrange(1, 300))
+        response = self.client.get("/api/posts/?ids=%s" % ids)
+        assert response.status_code == 400
+
     def test_search(self):
 
         self.create_post()
@@ -84,9 +241,10 @@ class TestComment(TestCase):
                           comment="test")
 
         db.session.add_all([user, post, comment])
+
+        update_num_comments(post)
         db.session.commit()
 
-        comment_added.send(post)
         return comment
 
     def test_edit_comment_not_logged_in(self):
@@ -197,6 +355,39 @@ class TestFrontend(TestCase):
         response = self.client.get("/tags/")
         self.assert_200(response)
 
+    def test_trending(self):
+
+        user = User(username="tester",
+                    email="tester@example.com",
+                    password="test")
+
+        db.session.add(user)
+        db.session.commit()
+
+        post = Post(author=user, tags="python", title="test")
+
+        db.session.add(post)
+        db.session.commit()
+
+        response = self.client.get("/api/tags/trending/")
+        self.assert_200(response)
+
+        assert [tag['slug'] for tag in response.json['tags']] == ["python"]
+
+        response = self.client.get("/trending/")
+        self.assert_200(response)
+
+        # a tag named "trending" has its own page
+        post = Post(author=user, tags="trending", title="about trends")
+
+        db.session.add(post)
+        db.session.commit()
+
+        response = self.client.get("/tags/trending/")
+        self.assert_200(response)
+
+        assert "about trends" in response.data
+
     def test_rules(self):
         response = self.client.get("/rules/")
         self.assert_200(response)
@@ -242,6 +433,58 @@ class TestFrontend(TestCase):
 
         db.session.commit()
 
+    def test_top(self):
+
+        response = self.client.get("/top/")
+        self.assert_200(response)
+
+        for window in ("day", "week", "month", "all"):
+            response = self.client.get("/top/%s/" % window)
+            self.assert_200(response)
+
+        response = self.client.get("/top/year/")
+        self.assert_404(response)
+
+        response = self.client.get("/top/week/2/")
+        self.assert_404(response)
+
+    def test_timeline(self):
+
+        response = self.client.get("/timeline/")
+        self.assert_401(response)
+
+        author = User(username="author",
+                      email="author@example.com",
+                      password="test")
+
+        follower = User(username="follower",
+                        email="follower@example.com",
+                        password="test")
+
+        db.session.add(author)
+        db.session.add(follower)
+        db.session.commit()
+
+        follower.follow(author)
+        db.session.commit()
+
+        self.login(login="author", password="test")
+
+        response = self.client.post("/submit/", data={"title" : "followed",
+                                                      "description" : "test"})
+        self.assert_redirects(response, "/latest/")
+        self.logout()
+
+        self.login(login="follower", password="test")
+
+        response = self.client.get("/timeline/")
+        self.assert_200(response)
+
+        assert "followed" in response.data
+
+        response = self.client.get("/timeline/2/")
+        self.assert_404(response)
+
     def test_submit_not_logged_in(self):
 
         response = self.client.get("/submit/")
@@ -290,6 +533,35 @@ class TestFrontend(TestCase):
         self.assert_redirects(response, "/latest/")
 
         assert Post.query.count() == 1
+
+    def test_post_submit_duplicate_link(self):
+        
+        user = User(username="tester",
+                    password="test",
+                    email="tester@example.com")
+
+        db.session.add(user)
+        db.session.commit()
+
+        post = Post(author=user,
+                    title="test",
+                    link="http://example.com/a")
+
+        db.session.add(post)
+        db.session.commit()
+
+        self.login(login="tester", password="test")
+    
+        data = {
+                "title" : "testing",
+                "link" : "https://www.example.com/a/?utm_source=test",
+                }
+
+        response = self.client.post("/submit/", data=data)
+        self.assert_200(response)
+
+        assert "This link has already been posted" in response.data
+        assert Post.query.count() == 1
         
 class TestPost(TestCase):
 
@@ -401,6 +673,7 @@ class TestPost(TestCase):
 
         with mail.record_messages() as outbox:
             response = self.client.post("/post/%d/delete/" % post.id)
+            self.deliver_outbox()
         
             assert response.json['success']
             assert Post.query.count() == 0
@@ -515,6 +788,7 @@ class TestPost(TestCase):
 
         with mail.record_messages() as outbox:
             response = self.client.post("/post/%d/edit/" % post.id, data=data)
+            self.deliver_outbox()
         
             self.assert_redirects(response, "/post/%d/" % post.id)
             assert len(outbox) == 1
@@ -561,7 +835,139 @@ class TestPost(TestCase):
 
         response = self.client.get("/post/%d/" % post.id)
         self.assert_200(response)
+
+    def test_view_archived_post(self):
+
+        user = self.create_user(True)
+
+        for title, days in (("archived", 30), ("live", 0)):
+            post = Post(author=user,
+                        title=title,
+                        date_created=datetime.utcnow() - timedelta(days=days))
+
+            db.session.add(post)
+            db.session.commit()
+
+        comment = Comment(post=Post.query.filter_by(slug="archived").one(),
+                          author=user,
+                          comment="a comment")
+
+        db.session.add(comment)
+        db.session.commit()
+
+        post_id = comment.post_id
+
+        assert archive_posts(datetime.utcnow() - timedelta(days=7)) == 1
+
+        response = self.client.get("/post/%d/" % post_id)
+        self.assert_200(response)
+
+        assert "a comment" in response.data
+        assert "addcomment" not in response.data
+
+        response = self.client.get("/api/post/%d/" % post_id)
+        self.assert_200(response)
+
+        assert response.json['title'] == "archived"
+
+        response = self.client.post("/post/%d/upvote/" % post_id)
+        self.assert_404(response)
+
+        response = self.client.get("/search/?keywords=archived")
+        self.assert_redirects(response, "/post/%d/s/archived/" % post_id)
+
+        response = self.client.get("/api/search/?keywords=e")
+        self.assert_200(response)
+
+        assert len(response.json['results']) == 2
+
+    def test_vote_uncaches_karma(self):
+
+        author = User(username="author",
+                      email="author@example.com",
+                      password="test")
+
+        post = Post(author=author, title="test")
+
+        db.session.add(post)
+        db.session.commit()
+
+        post_id, author_id = post.id, author.id
+
+        db.session.expunge_all()
+
+        User.query.from_snapshot(author_id)
+        assert cache.get(snapshot_key(author_id))['karma'] == 0
+
+        self.create_user(True)
+
+        response = self.client.post("/post/%d/upvote/" % post_id)
+        self.assert_200(response)
+
+        assert cache.get(snapshot_key(author_id)) is None
+
+    def test_view_related_posts(self):
+
+        user = self.create_user(True)
+
+        for title in ("first", "second"):
+            post = Post(author=user, title=title, tags="python, web")
+            db.session.add(post)
+            db.session.commit()
+
+        # not sharing tags with the others
+        db.session.add(Post(author=user, title="third", tags="cooking"))
+        db.session.commit()
+
+        rebuild_related(5, 1000)
+
+        post = Post.query.filter_by(slug="first").one()
+
+        response = self.client.get("/post/%d/" % post.id)
+        self.assert_200(response)
+
+        assert "Related posts" in response.data
+        assert "/post/%d/s/second/" % (post.id + 1) in response.data
+        assert "/s/third/" not in response.data
     
+    def test_add_comment_retried(self):
+
+        self.app.config['SQLITE_BUSY_BACKOFF'] = 0
+
+        user = self.create_user(True)
+
+        post = Post(author=user, title="test")
+
+        db.session.add(post)
+        db.session.commit()
+
+        post_id = post.id
+
+        commits = []
+        commit = db.session.commit
+
+        # the database is locked from the second commit of the view
+        def busy_commit():
+            commits.append(1)
+            if len(commits) == 2:
+                raise OperationalError("COMMIT", {},
+                                       sqlite3.OperationalError(
+                                       "database is locked"))
+            commit()
+
+        db.session.commit = busy_commit
+
+        try:
+            response = self.client.post("/post/%d/addcomment/" % post_id,
+                                        data={"comment" : "testing"})
+        finally:
+            del db.session.commit
+
+        assert response.status_code == 302
+
+        assert Comment.query.filter_by(post_id=post_id).count() == 1
+        assert Post.query.get(post_id).num_comments == 1
+
     def test_add_comment(self):
 
         response = self.client.get("/post/1/addcomment/")
@@ -595,6 +1001,7 @@ class TestPost(TestCase):
         with mail.record_messages() as outbox:
             response = self.client.post("/post/%d/addcomment/" % post.id,
                 data={"comment" : "testing"})
+            self.deliver_outbox()
         
             assert len(outbox) == 0
 
@@ -611,6 +1018,7 @@ class TestPost(TestCase):
         with mail.record_messages() as outbox:
             response = self.client.post("/post/%d/%d/reply/" % (
                 post.id, comment.id), data={'comment':'hello'})
+            self.deliver_outbox()
 
             assert len(outbox) == 0
 
@@ -638,6 +1046,7 @@ class TestPost(TestCase):
         with mail.record_messages() as outbox:
             response = self.client.post("/post/%d/addcomment/" % post.id,
                 data={"comment" : "testing"})
+            self.deliver_outbox()
         
             assert len(outbox) == 0
 
@@ -650,6 +1059,7 @@ class TestPost(TestCase):
         with mail.record_messages() as outbox:
             response = self.client.post("/post/%d/addcomment/" % post.id,
                 data={"comment" : "testing"})
+            self.deliver_outbox()
         
             assert len(outbox) == 1
 
@@ -658,6 +1068,7 @@ class TestPost(TestCase):
             response = self.client.post(
                 "/post/%d/%d/reply/" % (post.id, comment.id),
                 data={"comment" : "testing"})
+            self.deliver_outbox()
         
             assert len(outbox) == 1
 
@@ -668,6 +1079,7 @@ class TestPost(TestCase):
         with mail.record_messages() as outbox:
             response = self.client.post("/post/%d/%d/reply/" % (
                 post.id, comment.id), data={'comment':'hello'})
+            self.deliver_outbox()
 
             assert len(outbox) == 0
 
@@ -705,6 +1117,22 @@ class TestFeeds(TestCase):
         response = self.client.get("/feeds/latest/")
         self.assert_200(response)
 
+    def test_timeline(self):
+
+        response = self.client.get("/feeds/timeline/danjac/")
+        self.assert_404(response)
+
+        response = self.client.get("/feeds/timeline/tester/")
+        self.assert_200(response)
+
+    def test_top(self):
+
+        response = self.client.get("/feeds/top/week/")
+        self.assert_200(response)
+
+        response = self.client.get("/feeds/top/year/")
+        self.assert_404(response)
+
     def test_user(self):
 
         response = self.client.get("/feeds/user/danjac/")
@@ -819,6 +1247,487 @@ class TestUser(TestCase):
         response = self.client.get("/user/tester/comments/")
         self.assert_200(response)
 
+    def test_posts_max_queries(self):
+
+        response = self.assert_max_queries(6, "/user/tester/")
+        self.assert_200(response)
+
+        assert "db;dur=" in response.headers['Server-Timing']
+
+    def test_comments_max_queries(self):
+
+        response = self.assert_max_queries(6, "/user/tester/comments/")
+        self.assert_200(response)
+
+class TestProfiler(TestCase):
+
+    def setUp(self):
+        super(TestProfiler, self).setUp()
+        self.profile_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(TestProfiler, self).tearDown()
+        shutil.rmtree(self.profile_dir)
+
+    def test_profile_endpoint(self):
+
+        self.app.wsgi_app = SamplingProfiler(self.app, 
+                                             self.profile_dir,
+                                             endpoints=["frontend.rules"],
+                                             max_files=2)
+
+        for i in xrange(3):
+            self.assert_200(self.client.get("/rules/"))
+
+        self.assert_200(self.client.get("/help/"))
+
+        assert len(list_samples(self.profile_dir)) == 2
+        assert len(list_samples(self.profile_dir, "frontend.rules")) == 2
+        assert len(list_samples(self.profile_dir, "frontend.help")) == 0
+
+    def test_slow_threshold(self):
+
+        self.app.wsgi_app = SamplingProfiler(self.app, 
+                                             self.profile_dir,
+                                             slow_threshold=60)
+
+        self.assert_200(self.client.get("/rules/"))
+
+        assert list_samples(self.profile_dir) == []
+
+    def test_slow_threshold_keeps_sampled(self):
+
+        self.app.wsgi_app = SamplingProfiler(self.app, 
+                                             self.profile_dir,
+                                             endpoints=["frontend.rules"],
+                                             slow_threshold=60)
+
+        self.assert_200(self.client.get("/rules/"))
+        self.assert_200(self.client.get("/help/"))
+
+        assert len(list_samples(self.profile_dir)) == 1
+        assert len(list_samples(self.profile_dir, "frontend.rules")) == 1
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        self.metrics_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(TestMetrics, self).tearDown()
+        shutil.rmtree(self.metrics_dir)
+
+    def test_merge_workers(self):
+
+        first = Registry(self.metrics_dir, buckets=(0.1, 1), pid=1)
+        second = Registry(self.metrics_dir, buckets=(0.1, 1), pid=2)
+
+        labels = (("endpoint", "frontend.index"),)
+
+        first.observe("latency", 0.05, labels)
+        second.observe("latency", 0.5, labels)
+        second.inc("hits")
+
+        first.flush(force=True)
+        second.flush(force=True)
+
+        counters, histograms = first.collect()
+
+        assert counters[("hits", ())] == 1
+        assert histograms[("latency", labels)] == [1, 2, 0.55, 2]
+
+        text = first.render()
+
+        assert 'latency_bucket{endpoint="frontend.index",le="0.1"} 1' in text
+        assert 'latency_count{endpoint="frontend.index"} 2' in text
+
+    def test_archive_dead_workers(self):
+
+        pid = os.getpid()
+
+        # a previous worker with the same pid
+        first = Registry(self.metrics_dir, pid=pid)
+        first.inc("hits")
+        first.flush(force=True)
+
+        second = Registry(self.metrics_dir, pid=pid)
+        second.inc("hits")
+        second.flush(force=True)
+
+        assert not os.path.exists(first.filename)
+        assert os.path.exists(second.filename)
+
+        counters, histograms = second.collect()
+        assert counters[("hits", ())] == 2
+
+        # a worker with a pid no longer running
+        dead = Registry(self.metrics_dir, pid=999999)
+        dead.inc("hits")
+        dead.flush(force=True)
+
+        third = Registry(self.metrics_dir, pid=pid)
+        third.flush(force=True)
+
+        assert not os.path.exists(dead.filename)
+
+        counters, histograms = third.collect()
+        assert counters[("hits", ())] == 3
+
+    def test_forked_worker(self):
+
+        registry = Registry(self.metrics_dir)
+        registry.inc("hits")
+        registry.flush(force=True)
+
+        parent = registry.filename
+
+        # as if the registry was inherited by a forked worker
+        registry.owner = -1
+        registry.inc("hits")
+        registry.flush(force=True)
+
+        assert registry.filename != parent
+        assert not os.path.exists(parent)
+
+        counters, histograms = registry.collect()
+        assert counters[("hits", ())] == 2
+
+    def test_init_app_twice(self):
+
+        self.app.config['METRICS_DIR'] = self.metrics_dir
+
+        metrics.init_app(self.app)
+        metrics.init_app(self.app)
+
+        assert isinstance(cache.cache, InstrumentedCache)
+        assert not isinstance(cache.cache.backend, InstrumentedCache)
+        assert cache.cache.registry is self.app.metrics
+
+    def test_metrics_admin_only(self):
+
+        self.app.config['METRICS_DIR'] = self.metrics_dir
+        metrics.init_app(self.app)
+
+        self.assert_200(self.client.get("/rules/"))
+
+        response = self.client.get("/admin/metrics/")
+        self.assert_403(response)
+
+        user = User(username="tester",
+                    email="tester@example.com",
+                    password="test",
+                    role=User.ADMIN)
+
+        db.session.add(user)
+        db.session.commit()
+
+        self.login(login="tester", password="test")
+
+        response = self.client.get("/admin/metrics/")
+        self.assert_200(response)
+
+        assert 'newsmeme_request_duration_seconds_count' \
+            '{endpoint="frontend.rules"} 1' in response.data
+
+
+class TestMailWorker(TestCase):
+
+    def queue_messages(self, num_messages):
+        for i in xrange(num_messages):
+            mailer.send_message(subject="test %d" % i,
+                                body="test",
+                                sender="support@example.com",
+                                recipients=["tester@example.com"])
+        db.session.commit()
+
+    def test_views_only_enqueue(self):
+
+        user = User(username="tester",
+                    email="tester@example.com",
+                    password="test")
+
+        db.session.add(user)
+        db.session.commit()
+
+        with mail.record_messages() as outbox:
+            response = self.client.post("/acct/forgotpass/",
+                                        data={'email' : user.email})
+            assert len(outbox) == 0
+
+        assert OutboxMessage.query.pending().count() == 1
+
+    def test_process_outbox(self):
+
+        server = SMTPStandIn()
+        server.start()
+
+        self.configure_mail(server.port)
+        self.queue_messages(5)
+
+        try:
+            assert mailer.process_outbox(batch_size=2) == (5, 0)
+        finally:
+            server.stop()
+
+        assert len(server.messages) == 5
+        assert OutboxMessage.query.pending().count() == 0
+        assert OutboxMessage.query.filter(
+            OutboxMessage.date_sent==None).count() == 0
+
+    def test_retry_with_backoff(self):
+
+        # find a port nobody is listening on
+        sock = socket.socket()
+        sock.bind(("localhost", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+
+        self.configure_mail(port)
+        self.queue_messages(1)
+
+        assert mailer.process_outbox() == (0, 1)
+
+        message = OutboxMessage.query.first()
+
+        assert message.attempts == 1
+        assert message.date_sent is None
+        assert message.last_error
+
+        delay = message.next_attempt - datetime.utcnow()
+
+        assert timedelta(seconds=0) < delay <= \
+            timedelta(seconds=OutboxMessage.RETRY_DELAY)
+
+        assert OutboxMessage.query.pending().count() == 0
+
+        later = datetime.utcnow() + timedelta(seconds=OutboxMessage.RETRY_DELAY)
+        assert OutboxMessage.query.pending(later).count() == 1
+
+        message.failed("again")
+        assert message.attempts == 2
+        assert message.next_attempt - datetime.utcnow() > \
+            timedelta(seconds=OutboxMessage.RETRY_DELAY)
+
+    def test_disconnect(self):
+
+        server = SMTPStandIn(disconnect_after=2)
+        server.start()
+
+        self.configure_mail(server.port)
+        self.queue_messages(4)
+
+        try:
+            assert mailer.process_outbox() == (2, 2)
+        finally:
+            server.stop()
+
+        assert len(server.messages) == 2
+
+        assert OutboxMessage.query.filter(
+            OutboxMessage.date_sent!=None).count() == 2
+
+        assert OutboxMessage.query.filter(
+            OutboxMessage.attempts==1).count() == 2
+
+
+class TestDigests(TestCase):
+
+    def setUp(self):
+        super(TestDigests, self).setUp()
+
+        self.user = User(username="tester",
+                         email="tester@example.com",
+                         password="test",
+                         email_alerts=True)
+
+        self.other = User(username="tester2",
+                          email="tester2@example.com",
+                          password="test")
+
+        db.session.add_all([self.user, self.other])
+        db.session.commit()
+
+        self.post = Post(author=self.user,
+                         title="test",
+                         description="test")
+
+        db.session.add(self.post)
+        db.session.commit()
+
+    def test_one_digest_per_user(self):
+
+        self.login(login="tester2", password="test")
+
+        for i in xrange(3):
+            self.client.post("/post/%d/addcomment/" % self.post.id,
+                             data={"comment" : "comment %d" % i})
+
+        self.client.post("/acct/follow/%d/" % self.user.id)
+
+        assert Notification.query.count() == 4
+
+        # not due until the window has passed
+        assert mailer.send_digests(window=3600) == 0
+
+        later = datetime.utcnow() + timedelta(seconds=3600)
+        assert mailer.send_digests(window=3600, now=later) == 1
+
+        assert Notification.query.count() == 0
+
+        with mail.record_messages() as outbox:
+            mailer.process_outbox()
+
+            assert len(outbox) == 1
+            assert outbox[0].recipients == ["tester@example.com"]
+
+            for i in xrange(3):
+                assert "comment %d" % i in outbox[0].body
+
+            assert "tester2" in outbox[0].body
+
+    def test_batches(self):
+
+        for i in xrange(5):
+            user = User(username="follower%d" % i,
+                        email="follower%d@example.com" % i,
+                        password="test")
+            db.session.add(user)
+            db.session.add(Notification(user=user,
+                                        actor=self.other,
+                                        kind=Notification.FOLLOWED))
+
+        db.session.commit()
+
+        assert mailer.send_digests(window=0, batch_size=2) == 5
+        assert OutboxMessage.query.count() == 5
+
+
+class TestBulkMail(TestCase):
+
+    def setUp(self):
+        super(TestBulkMail, self).setUp()
+
+        self.users = []
+        for i in xrange(6):
+            user = User(username="tester%d" % i,
+                        email="tester%d@example.com" % i,
+                        password="test")
+            db.session.add(user)
+            self.users.append(user)
+
+        db.session.commit()
+
+        self.checkpoint_dir = tempfile.mkdtemp()
+        self.checkpoint = mailer.Checkpoint(
+            os.path.join(self.checkpoint_dir, "mailall.checkpoint"))
+
+    def tearDown(self):
+        super(TestBulkMail, self).tearDown()
+        shutil.rmtree(self.checkpoint_dir)
+
+    def test_send_bulk(self):
+
+        server = SMTPStandIn()
+        server.start()
+
+        self.configure_mail(server.port)
+        self.checkpoint.start("test", "test", "support@example.com")
+
+        try:
+            assert mailer.send_bulk(self.checkpoint, 
+                                    connections=3, 
+                                    batch_size=4) == (6, 0)
+        finally:
+            server.stop()
+
+        assert len(server.messages) == 6
+        assert self.checkpoint.load()['last_id'] == self.users[-1].id
+
+    def test_resume(self):
+
+        server = SMTPStandIn()
+        server.start()
+
+        self.configure_mail(server.port)
+        self.checkpoint.start("test", "test", "support@example.com")
+
+        # interrupted after the first two users
+        self.checkpoint.mailing['last_id'] = self.users[1].id
+        self.checkpoint.save()
+        self.checkpoint.load()
+
+        try:
+            assert mailer.send_bulk(self.checkpoint) == (4, 0)
+        finally:
+            server.stop()
+
+        recipients = sorted(rcpttos[0] for mailfrom, rcpttos, data \
+                            in server.messages)
+
+        assert recipients == ["<tester%d@example.com>" % i \
+                              for i in xrange(2, 6)]
+
+    def test_failed_queued(self):
+
+        server = SMTPStandIn(disconnect_after=2)
+        server.start()
+
+        self.configure_mail(server.port)
+        self.checkpoint.start("test", "test", "support@example.com")
+
+        try:
+            assert mailer.send_bulk(self.checkpoint, connections=1) == (2, 4)
+        finally:
+            server.stop()
+
+        assert OutboxMessage.query.count() == 4
+        assert self.checkpoint.load()['last_id'] == self.users[-1].id
+
+    def test_worker_error(self):
+
+        server = SMTPStandIn()
+        server.start()
+
+        self.configure_mail(server.port)
+        self.checkpoint.start("test", "test", "support@example.com")
+
+        def wait(throttle):
+            raise ValueError("throttle failed")
+
+        original, mailer.Throttle.wait = mailer.Throttle.wait, wait
+
+        try:
+            assert mailer.send_bulk(self.checkpoint, connections=2) == (0, 6)
+        finally:
+            mailer.Throttle.wait = original
+            server.stop()
+
+        assert OutboxMessage.query.count() == 6
+        assert self.checkpoint.load()['last_id'] == self.users[-1].id
+
+    def test_checkpoint_order(self):
+
+        self.checkpoint.start("test", "test", "support@example.com")
+
+        for user_id in (1, 2, 3):
+            self.checkpoint.dispatch(user_id)
+
+        self.checkpoint.handle(2)
+        assert self.checkpoint.mailing['last_id'] == 0
+
+        self.checkpoint.handle(1)
+        assert self.checkpoint.mailing['last_id'] == 2
+
+        assert self.checkpoint.load()['last_id'] == 0
+
+        self.checkpoint.handle(3)
+        self.checkpoint.save()
+
+        assert self.checkpoint.load()['last_id'] == 3
+
+
 class TestOpenId(TestCase):
 
     def test_login(self):